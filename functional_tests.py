@@ -38,6 +38,7 @@ class TestRunBot(unittest.TestCase):
 
     def setUp(self):
         self.connection = db.DBConnection()
+        self.connection.migrate()
 
     def tearDown(self):
         self.connection.execute_query("DELETE FROM preferences", "w")
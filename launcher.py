@@ -26,26 +26,61 @@ SOFTWARE.
 ===============================================================================
 """
 
+import argparse
 import asyncio
 import os
 
-from lib.bot import BotRoot
+from lib.bot import BotRoot, cluster
+from lib.db import storage
 
 
 def main():
     """ Create bot object and add to Async I/O event loop to run forever
+        With --clusters, run the shards across that many processes instead
 """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--clusters", type=int, default=1,
+        help="number of worker processes to split the shards across")
+    parser.add_argument(
+        "--shards", type=int, default=None,
+        help="total number of shards (default: recommended by Discord)")
+    parser.add_argument(
+        "--metrics-port", type=int, default=None,
+        help="serve Prometheus metrics on this local port")
+    parser.add_argument(
+        "--lazy-members", action="store_true",
+        help="skip member chunking at startup and resolve members on demand")
+    parser.add_argument(
+        "--storage", choices=storage.BACKENDS, default="sqlite",
+        help="storage backend for preferences and ghost pings")
+    parser.add_argument(
+        "--partitions", type=int, default=4,
+        help="number of database files of the partitioned backend")
+    args = parser.parse_args()
     token = os.environ.get("token", None)
     if token is None:
         with open(os.path.join("lib", "bot", "token.txt")) as file:
             token = file.read()
     assert token is not None
+    if args.clusters > 1:
+        cluster.launch(
+            token.strip(), args.clusters, args.shards, args.metrics_port,
+            args.lazy_members, args.storage, args.partitions
+        )
+        return
     loop = asyncio.get_event_loop()
-    bot = BotRoot()
+    bot = BotRoot(
+        shard_count=args.shards, metrics_port=args.metrics_port,
+        lazy_members=args.lazy_members, backend=args.storage,
+        partitions=args.partitions
+    )
     loop.create_task(bot.start(token))
     try:
         loop.run_forever()
     except KeyboardInterrupt:
+        # Flush queued writes, the journal, alerts, and raid summaries
+        loop.run_until_complete(bot.close())
         bot.connection.close_connection()
 
 
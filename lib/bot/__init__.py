@@ -3,12 +3,19 @@
 
 """
 Anti-GhostPing Discord bot
-    - Listens for the on_message_delete event reference to be called
+    - Records messages which contain mentions in a compact mention store
+        - The store is journaled to disk and reloaded on startup, so
+          messages sent before a restart are still checked
+    - Listens for the on_raw_message_delete event reference to be called
     - Checks deleted message for the following:
         - raw_mentions
         - raw_role_mentions
         - mentions_everyone
+    - Records ghost pings in data/db with batched writes
     - Sends notifying message to configured channel in Discord guild
+        - Alerts to the same channel are coalesced into fewer messages
+    - With lazy_members, skips member chunking at startup and resolves
+      only mentioned members on demand
 ===============================================================================
 Authorization Flow:
     - Public Bot
@@ -38,30 +45,105 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 ===============================================================================
 """
+import asyncio
+import collections
 import glob
 import logging
 import os
+import time
 
 import discord
 from discord.ext import commands
 
-from lib.db import db
+from lib.bot import (
+    coalescer, journal, metrics, prompts, raid, resolver, store
+)
+from lib.db import cache, db, storage, writer
 
 logging.basicConfig(
     level=logging.INFO,
     format=' %(asctime)s - %(levelname)s - %(message)s')
 
+# Seconds a member name resolved on demand is trusted with lazy_members
+LAZY_NAME_TTL = 600
 
-class BotRoot(commands.Bot):
-    """ Create commands.Bot object and add appropriate cogs
+
+class BotRoot(commands.AutoShardedBot):
+    """ Create commands.AutoShardedBot object and add appropriate cogs
+        Runs every shard when shard_ids is None, otherwise only shard_ids
+        With lazy_members, guilds are not chunked at startup and only the
+        bot's own member is cached
+        The mention store is journaled to journal_path unless it is None
+        backend is one of lib.db.storage.BACKENDS, and the partitioned
+        backend splits database into partitions files
 """
-    def __init__(self, prefix="@."):
+    def __init__(
+            self, prefix="@.", max_messages=None, alert_window=1.0,
+            shard_ids=None, shard_count=None, cluster_id=0,
+            shard_log_interval=300, database=db.DATABASE_PATH,
+            metrics_port=None, lazy_members=False,
+            journal_path=journal.JOURNAL_PATH, journal_retention=86400,
+            max_mentions_per_guild=1000, max_mention_bytes=32 * 1024 * 1024,
+            backend="sqlite", partitions=4
+    ):
         intents = discord.Intents.default()
         intents.members = True
         intents.guilds = True
+        options = {}
+        if lazy_members:
+            options["chunk_guilds_at_startup"] = False
+            options["member_cache_flags"] = discord.MemberCacheFlags.none()
         super().__init__(
-            command_prefix=prefix, intents=intents)
-        self.connection = db.DBConnection()
+            command_prefix=prefix, intents=intents,
+            max_messages=max_messages,
+            shard_ids=shard_ids, shard_count=shard_count, **options)
+        self.member_mode = "lazy" if lazy_members else "chunked"
+        self.started = None
+        self.ready_seconds = None
+        self.cluster_id = cluster_id
+        self.shard_log_interval = shard_log_interval
+        self.shard_logger = None
+        self.reconciled = False
+        self.metrics = metrics.BotMetrics(self)
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = metrics.MetricsServer(
+                self.metrics, port=metrics_port
+            )
+        self.connection = db.AsyncDBConnection(
+            database, on_query=self.metrics.observe_query,
+            factory=storage.factory(backend, partitions)
+        )
+        self.preferences = cache.PreferencesCache(self.connection)
+        self.writer = writer.BatchWriter(self.connection)
+        self.journal = None
+        if journal_path is not None:
+            self.journal = journal.MentionJournal(
+                journal_path, retention=journal_retention,
+                max_per_guild=max_mentions_per_guild,
+                max_bytes=max_mention_bytes
+            )
+        self.message_store = store.MentionStore(
+            max_per_guild=max_mentions_per_guild,
+            max_bytes=max_mention_bytes, journal=self.journal
+        )
+        self.alerts = coalescer.AlertCoalescer(
+            self, window=alert_window, metrics=self.metrics
+        )
+        for event in ("on_guild_channel_update", "on_guild_role_update"):
+            self.add_listener(getattr(self.alerts, event), event)
+        self.raids = raid.RaidMonitor(self)
+        # Uncached members send no update events, so names must expire
+        self.resolver = resolver.EntityResolver(
+            ttl=LAZY_NAME_TTL if lazy_members else None
+        )
+        for event in (
+                "on_member_update", "on_member_remove",
+                "on_user_update", "on_guild_remove"
+        ):
+            self.add_listener(getattr(self.resolver, event), event)
+        self.prompts = prompts.PromptManager()
+        self.add_listener(self.prompts.on_message, "on_message")
         self.load_all_cogs()
 
     def load_all_cogs(self):
@@ -86,5 +168,85 @@ class BotRoot(commands.Bot):
             Change bot status message
 """
         logging.info("Ready: %s", self.user.name)
+        if self.ready_seconds is None:
+            self.ready_seconds = time.perf_counter() - self.started
+            memory = metrics.resident_memory()
+            logging.info(
+                "Ready in %.2f s with %d guilds and %d cached members "
+                "(%s members), %s resident",
+                self.ready_seconds, len(self.guilds),
+                sum(len(g.members) for g in self.guilds), self.member_mode,
+                "unknown" if memory is None else f"{memory / 2 ** 20:.1f} MiB"
+            )
+        if not self.reconciled:
+            await self.reconcile_guilds()
+            self.reconciled = True
         await self.change_presence(
             activity=discord.Game("Ghost Ping Hunting | @."))
+        if self.shard_logger is None:
+            self.shard_logger = self.loop.create_task(self.log_shards())
+
+    async def reconcile_guilds(self):
+        """ Create and delete preferences for guilds joined or left while
+            the bot was offline, then warm the preferences cache
+"""
+        start = time.perf_counter()
+        added, removed, preferences = (
+            await self.connection.reconcile_guilds(
+                [g.id for g in self.guilds],
+                None if self.shard_ids is None else self.owns_guild
+            )
+        )
+        self.preferences.warm(preferences)
+        logging.info(
+            "Reconciled %d guilds (%d added, %d removed) in %.3f s",
+            len(preferences), added, removed, time.perf_counter() - start
+        )
+
+    def owns_guild(self, guild_id):
+        """ Return whether the guild belongs to a shard run by this process
+"""
+        return (guild_id >> 22) % self.shard_count in self.shard_ids
+
+    async def log_shards(self):
+        """ Periodically log the latency and guild count of each shard
+"""
+        while not self.is_closed():
+            guilds = collections.Counter(g.shard_id for g in self.guilds)
+            for shard_id, latency in self.latencies:
+                logging.info(
+                    "Cluster %s Shard %s: %.0f ms latency, %d guilds",
+                    self.cluster_id, shard_id, latency * 1000,
+                    guilds[shard_id]
+                )
+            await asyncio.sleep(self.shard_log_interval)
+
+    async def close(self):
+        """ End raids, send buffered alerts, write queued database rows and
+            the mention journal, and stop background tasks before closing
+            the connection to Discord
+"""
+        await self.raids.close()
+        await self.alerts.flush_all()
+        await self.writer.close()
+        if self.journal is not None:
+            await self.journal.close()
+        if self.shard_logger is not None:
+            self.shard_logger.cancel()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        await super().close()
+
+    async def start(self, *args, **kwargs):
+        """ Migrate the database, start the metrics server, if enabled,
+            and reload the mention journal, then connect to Discord
+"""
+        self.started = time.perf_counter()
+        await self.connection.migrate()
+        if self.journal is not None:
+            for record in await self.journal.load():
+                self.message_store.restore(record)
+            self.journal.start()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        await super().start(*args, **kwargs)
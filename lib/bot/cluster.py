@@ -0,0 +1,136 @@
+#! python3
+# cluster.py
+
+"""
+Runs the Anti-GhostPing Discord bot as a cluster of processes
+- Splits the shards of the bot into contiguous ranges
+- Starts one worker process per range, each running a sharded BotRoot
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+
+import discord
+
+from lib.bot import BotRoot, journal
+
+
+def shard_ranges(shard_count, clusters):
+    """ Split shard IDs into contiguous ranges, one per cluster
+"""
+    clusters = max(1, min(clusters, shard_count))
+    size, extra = divmod(shard_count, clusters)
+    ranges, start = [], 0
+    for cluster_id in range(clusters):
+        stop = start + size + (1 if cluster_id < extra else 0)
+        ranges.append(list(range(start, stop)))
+        start = stop
+    return ranges
+
+
+def journal_path(cluster_id, path=journal.JOURNAL_PATH):
+    """ Return the mention journal path of a cluster
+        Every cluster needs its own journal, since compaction replaces the
+        file and loading replays every record in it
+"""
+    root, ext = os.path.splitext(path)
+    return f"{root}-{cluster_id}{ext}"
+
+
+async def recommended_shards(token):
+    """ Ask Discord for the recommended number of shards for the bot
+"""
+    http = discord.http.HTTPClient()
+    await http.static_login(token, bot=True)
+    try:
+        shard_count, _ = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return shard_count
+
+
+def run_cluster(token, cluster_id, shard_ids, shard_count,
+                metrics_port=None, lazy_members=False, backend="sqlite",
+                partitions=4):
+    """ Run a BotRoot which owns shard_ids in the current process
+        Each cluster serves metrics on metrics_port + cluster_id
+"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot = BotRoot(
+        shard_ids=shard_ids, shard_count=shard_count, cluster_id=cluster_id,
+        metrics_port=(
+            None if metrics_port is None else metrics_port + cluster_id
+        ),
+        lazy_members=lazy_members, journal_path=journal_path(cluster_id),
+        backend=backend, partitions=partitions
+    )
+    logging.info(
+        "Cluster %s starting shards %s of %s",
+        cluster_id, shard_ids, shard_count
+    )
+    try:
+        loop.run_until_complete(bot.start(token))
+    except KeyboardInterrupt:
+        loop.run_until_complete(bot.close())
+    finally:
+        bot.connection.close_connection()
+        loop.close()
+
+
+def launch(token, clusters, shard_count=None, metrics_port=None,
+           lazy_members=False, backend="sqlite", partitions=4):
+    """ Start one worker process per cluster and wait for them to exit
+"""
+    if shard_count is None:
+        loop = asyncio.new_event_loop()
+        try:
+            shard_count = loop.run_until_complete(recommended_shards(token))
+        finally:
+            loop.close()
+    # Spawn rather than fork so no worker inherits the database connection
+    # opened by the parent process
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(
+            target=run_cluster, name=f"cluster-{cluster_id}",
+            args=(
+                token, cluster_id, shard_ids, shard_count, metrics_port,
+                lazy_members, backend, partitions
+            )
+        )
+        for cluster_id, shard_ids in enumerate(
+            shard_ranges(shard_count, clusters)
+        )
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
@@ -0,0 +1,333 @@
+#! python3
+# coalescer.py
+
+"""
+Coalesces outgoing ghost ping alerts per notification channel
+- Buffers alerts for a short window before sending
+- Sends up to 10 embeds per message
+- Packs larger bursts into compact multi-field embeds
+- Checks channel permissions locally and remembers channels which failed,
+  rerouting their alerts to the origin channel or telling the guild owner
+  once, so requests which are certain to fail are never sent
+- Retries transient errors with jittered exponential backoff
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import asyncio
+import logging
+import random
+import time
+
+import aiohttp
+import discord
+from discord.http import Route
+
+from lib.bot.templates import (
+    MAX_EMBED_LENGTH, MAX_FIELD_NAME, MAX_FIELD_VALUE, MAX_FIELDS,
+    fit_data, truncate
+)
+
+MAX_EMBEDS = 10
+# The embeds of one message share the length limit of a single embed
+MAX_MESSAGE_LENGTH = MAX_EMBED_LENGTH
+# Seconds a channel which cannot receive alerts is skipped
+DENIED_TTL = 300
+# Errors after which sending the same request again may succeed
+TRANSIENT_ERRORS = (
+    discord.DiscordServerError, aiohttp.ClientError, asyncio.TimeoutError,
+    OSError
+)
+OWNER_NOTICE = (
+    "Ghost ping alerts for **{guild}** cannot be sent to #{channel}. "
+    "Please give the bot the View Channel, Send Messages, and Embed Links "
+    "permissions there, or choose another channel with `configure`."
+)
+
+
+class AlertCoalescer:
+    """ Buffer alerts per notification channel and send them in batches
+        Channels the bot cannot send to are skipped for denied_ttl seconds
+        Transient errors are retried up to retries times, waiting a random
+        time of up to backoff * 2 ** attempt seconds
+"""
+    def __init__(self, bot, window=1.0, max_embeds=MAX_EMBEDS,
+                 metrics=None, denied_ttl=DENIED_TTL, retries=3,
+                 backoff=0.5, max_backoff=30.0):
+        self.bot = bot
+        self.metrics = metrics
+        self.window = window
+        self.max_embeds = max_embeds
+        self.denied_ttl = denied_ttl
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.detections = 0
+        self.calls = 0
+        self.rerouted = 0
+        self.dropped = 0
+        self.denied = {}
+        self.notified = set()
+        self._pending = {}
+
+    @property
+    def saved(self):
+        """ Number of API calls saved by coalescing
+"""
+        return self.detections - self.dropped - self.calls - self.buffered
+
+    @property
+    def buffered(self):
+        """ Number of alerts waiting to be sent
+"""
+        return sum(len(p[1]) for p in self._pending.values())
+
+    def add(self, channel, embed, field, fallback=None):
+        """ Buffer an alert for a notification channel
+            field is a (name, value) summary used in compact embeds
+            The alert goes to fallback, usually the channel of the ghost
+            ping, when the bot cannot send to channel
+"""
+        self.detections += 1
+        self._route(channel, embed, field, fallback)
+
+    def _route(self, channel, embed, field, fallback):
+        if not self.sendable(channel):
+            if (
+                    fallback is None or fallback.id == channel.id
+                    or not self.sendable(fallback)
+            ):
+                self.dropped += 1
+                self.notify_owner(channel)
+                return
+            self.rerouted += 1
+            channel, fallback = fallback, None
+        pending = self._pending.get(channel.id)
+        if pending is None:
+            timer = asyncio.ensure_future(self._flush_later(channel.id))
+            self._pending[channel.id] = (
+                channel, [(embed, field, fallback)], timer
+            )
+        else:
+            pending[1].append((embed, field, fallback))
+
+    def sendable(self, channel):
+        """ Return whether alerts can be sent to a channel, judged by the
+            bot's permissions and channels which failed recently
+"""
+        expires = self.denied.get(channel.id)
+        if expires is not None:
+            if expires > time.monotonic():
+                return False
+            del self.denied[channel.id]
+        guild = getattr(channel, "guild", None)
+        me = None if guild is None else guild.me
+        if me is None:
+            return True
+        permissions = channel.permissions_for(me)
+        if (
+                permissions.read_messages and permissions.send_messages
+                and permissions.embed_links
+        ):
+            return True
+        self.deny(channel)
+        return False
+
+    def deny(self, channel):
+        """ Skip a channel for denied_ttl seconds
+"""
+        self.denied[channel.id] = time.monotonic() + self.denied_ttl
+
+    def notify_owner(self, channel):
+        """ Tell the guild owner once that alerts cannot be sent to a
+            channel
+"""
+        guild = getattr(channel, "guild", None)
+        if guild is None or channel.id in self.notified:
+            return
+        self.notified.add(channel.id)
+        asyncio.ensure_future(self._notify_owner(guild, channel))
+
+    async def _notify_owner(self, guild, channel):
+        try:
+            owner = (
+                guild.owner or self.bot.get_user(guild.owner_id)
+                or await self.bot.fetch_user(guild.owner_id)
+            )
+            await owner.send(OWNER_NOTICE.format(
+                guild=guild.name, channel=channel.name
+            ))
+        except discord.HTTPException as error:
+            logging.warning(
+                "Could not notify the owner of guild %s: %s", guild.id, error
+            )
+
+    async def on_guild_channel_update(self, before, after):
+        """ Recheck a channel whose permission overwrites may have changed
+"""
+        self.denied.pop(after.id, None)
+
+    async def on_guild_role_update(self, before, after):
+        """ Recheck every channel after a role's permissions changed
+"""
+        self.denied.clear()
+
+    async def _flush_later(self, channel_id):
+        await asyncio.sleep(self.window)
+        await self.flush(channel_id)
+
+    async def flush(self, channel_id):
+        """ Send every buffered alert of a notification channel
+"""
+        pending = self._pending.pop(channel_id, None)
+        if pending is None:
+            return
+        channel, alerts, timer = pending
+        if timer is not asyncio.current_task():
+            timer.cancel()
+        if len(alerts) <= self.max_embeds:
+            embeds = [embed for embed, _, _ in alerts]
+        else:
+            embeds = self.compact([field for _, field, _ in alerts])
+        sent = 0
+        for batch in self.batches(embeds):
+            try:
+                await self.deliver(channel, batch)
+            except (discord.Forbidden, discord.NotFound) as error:
+                logging.warning(
+                    "Cannot send alerts to %s: %s", channel_id, error
+                )
+                self.deny(channel)
+                # Alerts of this and later batches were not delivered
+                for embed, field, fallback in alerts[sent:]:
+                    self._route(channel, embed, field, fallback)
+                return
+            except discord.HTTPException:
+                logging.exception("Failed to send alerts to %s", channel_id)
+            except TRANSIENT_ERRORS:
+                logging.exception(
+                    "Gave up sending alerts to %s after %d retries",
+                    channel_id, self.retries
+                )
+            else:
+                self.notified.discard(channel_id)
+            # Compact embeds carry one field per alert
+            sent += sum(
+                1 if len(alerts) <= self.max_embeds else len(e.fields)
+                for e in batch
+            )
+
+    async def flush_all(self):
+        """ Send every buffered alert of every notification channel
+"""
+        for channel_id in list(self._pending):
+            await self.flush(channel_id)
+
+    def batches(self, embeds):
+        """ Group embeds into messages within the embed and length limits
+"""
+        batch, length = [], 0
+        for embed in embeds:
+            if batch and (
+                    len(batch) == self.max_embeds
+                    or length + len(embed) > MAX_MESSAGE_LENGTH
+            ):
+                yield batch
+                batch, length = [], 0
+            batch.append(embed)
+            length += len(embed)
+        if batch:
+            yield batch
+
+    @staticmethod
+    def compact(fields):
+        """ Pack (name, value) summaries into multi-field embeds
+"""
+        embeds = []
+        title = "Ghost Pings Detected :no_entry_sign: :ghost:"
+        embed, length = None, 0
+        for name, value in fields:
+            name = truncate(name, MAX_FIELD_NAME)
+            value = truncate(value, MAX_FIELD_VALUE)
+            if (
+                    embed is None or len(embed.fields) == MAX_FIELDS
+                    or length + len(name) + len(value) > MAX_MESSAGE_LENGTH
+            ):
+                embed = discord.Embed(title=title, color=0x0000ff)
+                embeds.append(embed)
+                length = len(title)
+            embed.add_field(name=name, value=value, inline=False)
+            length += len(name) + len(value)
+        return embeds
+
+    async def deliver(self, channel, embeds):
+        """ Send one message containing the embeds, retrying transient
+            errors with jittered exponential backoff
+"""
+        for attempt in range(self.retries + 1):
+            try:
+                await self.send(channel, embeds)
+                return
+            except TRANSIENT_ERRORS:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(random.uniform(
+                    0, min(self.max_backoff, self.backoff * 2 ** attempt)
+                ))
+
+    async def send(self, channel, embeds):
+        """ Send one message containing the embeds
+"""
+        self.calls += 1
+        if self.metrics is None:
+            await self._send(channel, embeds)
+            return
+        start = time.perf_counter()
+        try:
+            await self._send(channel, embeds)
+        except discord.HTTPException as error:
+            self.metrics.send_errors.labels(error.status).inc()
+            raise
+        finally:
+            self.metrics.send_latency.observe(time.perf_counter() - start)
+
+    async def _send(self, channel, embeds):
+        # Truncate every embed so an oversized alert never fails to send
+        payload = [fit_data(e.to_dict()) for e in embeds]
+        if len(payload) == 1:
+            await channel.send(embed=discord.Embed.from_dict(payload[0]))
+            return
+        route = Route(
+            "POST", "/channels/{channel_id}/messages",
+            channel_id=channel.id
+        )
+        await self.bot.http.request(route, json={"embeds": payload})
+
+    def stats(self):
+        """ Return the number of alerts, API calls, and API calls saved
+"""
+        return {
+            "detections": self.detections, "calls": self.calls,
+            "saved": self.saved, "buffered": self.buffered,
+            "rerouted": self.rerouted, "dropped": self.dropped,
+            "denied": len(self.denied)
+        }
@@ -0,0 +1,247 @@
+#! python3
+# journal.py
+
+"""
+On-disk journal of the mention store so ghost pings survive restarts
+- Appends stored and removed records as JSON lines in batches
+- Replays the journal into the mention store on startup, skipping records
+  older than the retention time and a partially written final line
+- Compacts the journal in the background by rewriting only the records
+  which are still stored, then atomically replacing the file
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import time
+
+from lib.bot.store import MentionRecord, MentionStore
+
+JOURNAL_PATH = os.path.join("data", "db", "mentions.journal")
+
+
+class MentionJournal:
+    """ Append-only journal of MentionStore changes on a dedicated thread
+        Each line is a record row, or a single-item [message ID] row when
+        the record was removed
+        The journal is replayed with the same per-guild and global limits
+        as the store, so evicted records are dropped on replay
+"""
+    def __init__(
+            self, path=JOURNAL_PATH, retention=86400, flush_interval=1.0,
+            batch_size=1000, compact_interval=3600,
+            compact_bytes=64 * 1024 * 1024, max_per_guild=1000,
+            max_bytes=32 * 1024 * 1024, fsync=False
+    ):
+        self.path = path
+        self.retention = retention
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.compact_interval = compact_interval
+        self.compact_bytes = compact_bytes
+        self.max_per_guild = max_per_guild
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.appended = 0
+        self.batches = 0
+        self.compactions = 0
+        self.file_size = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="journal"
+        )
+        self._pending = []
+        self._timer = None
+        self._written = None
+        self._compactor = None
+        self._file = None
+        self._compacted = 0
+        self._closed = False
+
+    def append(self, record):
+        """ Queue a stored record to be written
+"""
+        self._queue(record.to_row())
+
+    def remove(self, message_id):
+        """ Queue the removal of a record to be written
+"""
+        self._queue([message_id])
+
+    def _queue(self, row):
+        if self._closed:
+            return
+        self._pending.append(row)
+        if len(self._pending) >= self.batch_size:
+            self._submit()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(
+                self.flush_interval, self._submit
+            )
+
+    def _submit(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        rows, self._pending = self._pending, []
+        if rows:
+            # The executor runs writes in the order they are submitted
+            self._written = asyncio.get_event_loop().run_in_executor(
+                self.executor, self._write, rows
+            )
+        return self._written
+
+    async def flush(self):
+        """ Write the queued rows as one batch and wait for every batch
+            submitted before it
+"""
+        written = self._submit()
+        if written is not None:
+            await written
+
+    def _write(self, rows):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write("".join(
+            json.dumps(r, separators=(",", ":")) + "\n" for r in rows
+        ))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.file_size = self._file.tell()
+        self.appended += len(rows)
+        self.batches += 1
+        if self.file_size > max(self.compact_bytes, 2 * self._compacted):
+            self._compact()
+
+    async def load(self):
+        """ Replay the journal and return the records still within the
+            retention time, oldest first
+            The journal is compacted to those records
+"""
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        records = await loop.run_in_executor(self.executor, self._compact)
+        logging.info(
+            "Loaded %d journaled mentions in %.3f s",
+            len(records), time.perf_counter() - start
+        )
+        return records
+
+    async def compact(self):
+        """ Rewrite the journal with only the records which are still stored
+"""
+        self._submit()
+        loop = asyncio.get_event_loop()
+        records = await loop.run_in_executor(self.executor, self._compact)
+        logging.info("Compacted mention journal to %d records", len(records))
+
+    def _compact(self):
+        records = self.read()
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            for record in records:
+                file.write(
+                    json.dumps(record.to_row(), separators=(",", ":")) + "\n"
+                )
+            file.flush()
+            os.fsync(file.fileno())
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        os.replace(temporary, self.path)
+        self.file_size = self._compacted = os.path.getsize(self.path)
+        self.compactions += 1
+        return records
+
+    def read(self):
+        """ Replay the journal file into a new MentionStore with the
+            journal's limits and return its records
+"""
+        replay = MentionStore(self.max_per_guild, self.max_bytes)
+        cutoff = time.time() - self.retention
+        try:
+            file = open(self.path, encoding="utf-8")
+        except FileNotFoundError:
+            return []
+        with file:
+            for number, line in enumerate(file, 1):
+                try:
+                    row = json.loads(line)
+                    if len(row) == 1:
+                        replay.pop(row[0])
+                        continue
+                    record = MentionRecord.from_row(row)
+                except (ValueError, TypeError):
+                    # A crash while appending leaves a partial final line
+                    logging.warning(
+                        "Skipped malformed line %d of %s", number, self.path
+                    )
+                    continue
+                if record.timestamp >= cutoff:
+                    replay.restore(record)
+        return [r for r in replay.records() if r.timestamp >= cutoff]
+
+    def start(self):
+        """ Start compacting the journal every compact_interval seconds
+"""
+        if self._compactor is None:
+            self._compactor = asyncio.ensure_future(self._compact_forever())
+
+    async def _compact_forever(self):
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            try:
+                await self.compact()
+            except OSError:
+                logging.exception("Failed to compact mention journal")
+
+    async def close(self):
+        """ Stop compacting, write queued rows and close the journal file
+"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._compactor is not None:
+            self._compactor.cancel()
+            self._compactor = None
+        self._submit()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self._close)
+        self.executor.shutdown(wait=False)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self):
+        """ Return the write counters and size of the journal
+"""
+        return {
+            "pending": len(self._pending), "appended": self.appended,
+            "batches": self.batches, "compactions": self.compactions,
+            "bytes": self.file_size
+        }
@@ -0,0 +1,413 @@
+#! python3
+# metrics.py
+
+"""
+Collects runtime metrics of the Anti-GhostPing Discord bot
+- Counters, gauges, and latency histograms with optional labels
+- Renders every metric in the Prometheus text exposition format
+- Serves the metrics over HTTP on a local port
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import abc
+import bisect
+import contextlib
+import functools
+import logging
+import math
+import os
+import sys
+import threading
+import time
+
+from aiohttp import web
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+def format_labels(names, values, extra=()):
+    """ Render label names and values as {name="value",...}
+"""
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(n, str(v).replace('"', '\\"')) for n, v in pairs
+    ) + "}"
+
+
+def timed(event):
+    """ Decorate a cog listener to count and time the events it handles
+        The cog's bot must have a BotMetrics registry as bot.metrics
+"""
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(self, *args):
+            registry = self.bot.metrics
+            registry.events.labels(event).inc()
+            with registry.event_latency.labels(event).time():
+                return await function(self, *args)
+        return wrapper
+    return decorator
+
+
+def resident_memory():
+    """ Return the resident memory of this process in bytes, or None
+        Reads /proc where available and falls back to the peak RSS
+"""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Metric(abc.ABC):
+    """ Base class of metrics rendered in the Prometheus text format
+"""
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    @abc.abstractmethod
+    def samples(self):
+        """ Yield (suffix, label values, extra labels, value) of the metric
+"""
+
+    def render(self):
+        """ Render the metric in the Prometheus text format
+"""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}"
+        ]
+        for suffix, values, extra, value in self.samples():
+            labels = format_labels(self.labelnames, values, extra)
+            lines.append(f"{self.name}{suffix}{labels} {value!r}")
+        return "\n".join(lines)
+
+
+class LabelledMetric(Metric):
+    """ Base class of metrics holding one child per label values
+        Children are observed from the database thread as well as the
+        event loop, so they are created and listed under a lock
+"""
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """ Return the child metric for the label values
+"""
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self.child()
+        return child
+
+    @abc.abstractmethod
+    def child(self):
+        """ Return a new child metric
+"""
+
+    def items(self):
+        """ Return a list of (label values, child) pairs
+"""
+        with self._lock:
+            return list(self._children.items())
+
+    def children(self):
+        """ Return (label values, child) pairs sorted by label values
+"""
+        return sorted(self.items())
+
+
+class Counter(LabelledMetric):
+    """ Monotonically increasing count
+"""
+    kind = "counter"
+
+    class Child:
+        __slots__ = ("value",)
+
+        def __init__(self):
+            self.value = 0
+
+        def inc(self, amount=1):
+            self.value += amount
+
+    def child(self):
+        return self.Child()
+
+    def inc(self, amount=1):
+        """ Increase the unlabelled counter
+"""
+        self.labels().inc(amount)
+
+    def total(self):
+        """ Return the sum of every child of the counter
+"""
+        return sum(c.value for _, c in self.items())
+
+    def samples(self):
+        for values, child in self.items():
+            yield "_total", values, (), child.value
+
+
+class Gauge(Metric):
+    """ Value read from a callback whenever the metric is rendered
+        The callback returns a number, or (label values, number) pairs
+"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, function, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def samples(self):
+        value = self.function()
+        if not self.labelnames:
+            yield "", (), (), value
+            return
+        for values, number in value:
+            yield "", tuple(str(v) for v in values), (), number
+
+
+class Histogram(LabelledMetric):
+    """ Distribution of observed values in cumulative buckets
+"""
+    kind = "histogram"
+
+    class Child:
+        __slots__ = ("buckets", "counts", "sum", "count")
+
+        def __init__(self, buckets):
+            self.buckets = buckets
+            self.counts = [0] * (len(buckets) + 1)
+            self.sum = 0.0
+            self.count = 0
+
+        def observe(self, value):
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+        @contextlib.contextmanager
+        def time(self):
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.observe(time.perf_counter() - start)
+
+        def quantile(self, q):
+            """ Estimate a quantile as the upper bound of its bucket
+"""
+            if not self.count:
+                return math.nan
+            rank, seen = q * self.count, 0
+            for bound, count in zip(self.buckets, self.counts):
+                seen += count
+                if seen >= rank:
+                    return bound
+            return math.inf
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def child(self):
+        return self.Child(self.buckets)
+
+    def observe(self, value):
+        """ Observe a value in the unlabelled histogram
+"""
+        self.labels().observe(value)
+
+    def time(self):
+        """ Observe the duration of a with block in the unlabelled histogram
+"""
+        return self.labels().time()
+
+    def samples(self):
+        for values, child in self.items():
+            cumulative = 0
+            for bound, count in zip(
+                    self.buckets + (math.inf,), child.counts
+            ):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else repr(bound)
+                yield "_bucket", values, (("le", le),), cumulative
+            yield "_sum", values, (), child.sum
+            yield "_count", values, (), child.count
+
+
+class Registry:
+    """ Collection of metrics rendered together
+"""
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        """ Add a metric to the registry and return it
+"""
+        if metric.name in self.metrics:
+            raise ValueError(f"Duplicate metric: {metric.name}")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """ Render every metric in the Prometheus text format
+"""
+        return "\n".join(m.render() for m in self.metrics.values()) + "\n"
+
+
+class BotMetrics(Registry):
+    """ Metrics of the event, database, and alert pipelines of a bot
+"""
+    def __init__(self, bot):
+        super().__init__()
+        self.bot = bot
+        self.events = self.register(Counter(
+            "ghostping_events", "Gateway events handled by AntiGhostPing",
+            ["event"]
+        ))
+        self.event_latency = self.register(Histogram(
+            "ghostping_event_seconds",
+            "Time spent handling gateway events in AntiGhostPing", ["event"]
+        ))
+        self.detections = self.register(Counter(
+            "ghostping_detections", "Ghost pings detected"
+        ))
+        self.query_latency = self.register(Histogram(
+            "ghostping_query_seconds",
+            "Time spent running database operations", ["operation"]
+        ))
+        self.send_latency = self.register(Histogram(
+            "ghostping_send_seconds", "Latency of alert messages sent"
+        ))
+        self.send_errors = self.register(Counter(
+            "ghostping_send_errors", "Alert messages which failed to send",
+            ["status"]
+        ))
+        self.register(Gauge(
+            "ghostping_message_cache_messages",
+            "Messages in the discord.py message cache",
+            lambda: len(bot.cached_messages)
+        ))
+        self.register(Gauge(
+            "ghostping_mention_store_records",
+            "Records in the mention store", lambda: len(bot.message_store)
+        ))
+        self.register(Gauge(
+            "ghostping_mention_store_bytes",
+            "Estimated size of the mention store",
+            lambda: bot.message_store.size
+        ))
+        self.register(Gauge(
+            "ghostping_journal_bytes", "Size of the mention journal file",
+            lambda: 0 if bot.journal is None else bot.journal.file_size
+        ))
+        self.register(Gauge(
+            "ghostping_preferences_cache_guilds",
+            "Guilds in the preferences cache", lambda: len(bot.preferences)
+        ))
+        self.register(Gauge(
+            "ghostping_gateway_latency_seconds",
+            "Gateway heartbeat latency of each shard",
+            lambda: [((s,), l) for s, l in bot.latencies], ["shard"]
+        ))
+        self.register(Gauge(
+            "ghostping_cached_members", "Members in the member cache",
+            lambda: sum(len(g.members) for g in bot.guilds)
+        ))
+        self.register(Gauge(
+            "ghostping_ready_seconds",
+            "Time from connecting to the first ready event",
+            lambda: [] if bot.ready_seconds is None else [
+                ((bot.member_mode,), bot.ready_seconds)
+            ], ["members"]
+        ))
+        self.register(Gauge(
+            "process_resident_memory_bytes", "Resident memory size",
+            lambda: resident_memory() or 0
+        ))
+
+    def observe_query(self, operation, seconds):
+        """ Record the duration of a database operation
+"""
+        self.query_latency.labels(operation).observe(seconds)
+
+
+class MetricsServer:
+    """ Serve the metrics of a registry over HTTP at /metrics
+"""
+    def __init__(self, registry, host="127.0.0.1", port=9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        """ Start serving
+"""
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logging.info("Serving metrics on %s:%s", self.host, self.port)
+
+    async def stop(self):
+        """ Stop serving
+"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request):
+        """ Respond with the rendered metrics
+"""
+        return web.Response(
+            body=self.registry.render().encode(),
+            headers={"Content-Type": CONTENT_TYPE}
+        )
@@ -0,0 +1,223 @@
+#! python3
+# profiler.py
+
+"""
+Profiles the Anti-GhostPing Discord bot while it keeps running
+- Deterministic cProfile sessions or low-overhead stack sampling of the
+  event loop thread for a fixed number of seconds
+- Compares tracemalloc snapshots taken before and after the session
+- Formats the hottest functions and allocation sites as a text report
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import asyncio
+import collections
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+MODES = ("cprofile", "sample")
+TRACEMALLOC_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+)
+
+
+class Sampler:
+    """ Sample the stack of one thread from a background thread
+        Counts how often each function is running (self) and how often it
+        is anywhere on the stack (cumulative)
+"""
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.own = collections.Counter()
+        self.cumulative = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def key(frame):
+        """ Identify the function executing in a frame
+"""
+        code = frame.f_code
+        return (code.co_filename, frame.f_lineno, code.co_name)
+
+    def start(self):
+        """ Begin sampling in a daemon thread
+"""
+        self._thread = threading.Thread(
+            target=self._sample, name="profiler-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """ Stop sampling and wait for the sampling thread to exit
+"""
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.own[self.key(frame)] += 1
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                if code not in seen:
+                    seen.add(code)
+                    self.cumulative[
+                        (code.co_filename, code.co_firstlineno, code.co_name)
+                    ] += 1
+                frame = frame.f_back
+
+    def report(self, limit=30):
+        """ Format the most sampled functions as a text table
+"""
+        lines = [
+            f"{self.samples} samples every {self.interval * 1000:g} ms",
+            "",
+        ]
+        for title, counter in (
+                ("Running (self)", self.own),
+                ("On the stack (cumulative)", self.cumulative)
+        ):
+            lines.append(f"{title}:")
+            lines.append(f"{'samples':>9} {'percent':>8}  function")
+            for (filename, lineno, name), count in (
+                    counter.most_common(limit)
+            ):
+                lines.append(
+                    f"{count:>9} {count / max(self.samples, 1):>8.1%}  "
+                    f"{filename}:{lineno}({name})"
+                )
+            lines.append("")
+        return "\n".join(lines)
+
+
+class Profiler:
+    """ Profile the event loop thread of the running bot for a fixed time
+        Only one session may run at a time
+        Allocations are traced frames deep, and the report groups them by
+        line, so deeper traces only make snapshots slower
+"""
+    def __init__(self, limit=30, frames=1, interval=0.005):
+        self.limit = limit
+        self.frames = frames
+        self.interval = interval
+        self.lock = asyncio.Lock()
+
+    @property
+    def running(self):
+        """ Return whether a profiling session is in progress
+"""
+        return self.lock.locked()
+
+    async def profile(self, seconds, mode="cprofile"):
+        """ Profile the event loop for seconds while it keeps handling
+            events, then return the text report
+"""
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiler mode: {mode}")
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start(self.frames)
+            try:
+                # Snapshots of a long session take a while, so keep them
+                # off the event loop
+                before = await loop.run_in_executor(
+                    None, tracemalloc.take_snapshot
+                )
+                start = time.perf_counter()
+                if mode == "cprofile":
+                    collector = cProfile.Profile()
+                    collector.enable()
+                    try:
+                        await asyncio.sleep(seconds)
+                    finally:
+                        collector.disable()
+                else:
+                    collector = Sampler(
+                        threading.get_ident(), self.interval
+                    )
+                    collector.start()
+                    try:
+                        await asyncio.sleep(seconds)
+                    finally:
+                        collector.stop()
+                elapsed = time.perf_counter() - start
+                after = await loop.run_in_executor(
+                    None, tracemalloc.take_snapshot
+                )
+            finally:
+                if started_tracing:
+                    tracemalloc.stop()
+            return await loop.run_in_executor(
+                None, self.report, mode, elapsed, collector,
+                before, after
+            )
+
+    def report(self, mode, elapsed, collector, before, after):
+        """ Format the profile and memory comparison as a text report
+"""
+        sections = [
+            f"Profiled the event loop for {elapsed:.1f} s ({mode})",
+            "",
+            "=== Hot Functions ===",
+        ]
+        if mode == "cprofile":
+            stream = io.StringIO()
+            stats = pstats.Stats(collector, stream=stream)
+            stats.sort_stats("cumulative").print_stats(self.limit)
+            stats.sort_stats("tottime").print_stats(self.limit)
+            sections.append(stream.getvalue())
+        else:
+            sections.append(collector.report(self.limit))
+        sections.append("=== Allocation Sites (after - before) ===")
+        sections.append(self.compare(before, after))
+        return "\n".join(sections)
+
+    def compare(self, before, after):
+        """ Format the allocation sites whose memory grew the most
+"""
+        before = before.filter_traces(TRACEMALLOC_FILTERS)
+        after = after.filter_traces(TRACEMALLOC_FILTERS)
+        differences = after.compare_to(before, "lineno")
+        lines = [
+            str(d) for d in differences[:self.limit] if d.size_diff
+        ]
+        total = sum(d.size_diff for d in differences)
+        lines.append(f"Total change: {total / 1024:+.1f} KiB")
+        return "\n".join(lines)
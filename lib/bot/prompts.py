@@ -0,0 +1,156 @@
+#! python3
+# prompts.py
+
+"""
+Dispatches replies to interactive command prompts
+- Pending prompts are indexed by (guild, channel, author), so each message
+  needs one dictionary lookup instead of running every prompt's predicate
+- Only one prompt session may be open in a channel at a time
+- Sessions which are left idle past their timeout are closed
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import asyncio
+import time
+
+
+class PromptBusy(Exception):
+    """ Raised when a channel already has an open prompt session
+"""
+
+
+class PromptSession:
+    """ Prompt waiting for replies from one author in one channel
+        Use as a context manager so the session is closed on exit
+"""
+    __slots__ = ("manager", "key", "timeout", "expires", "_future", "_check")
+
+    def __init__(self, manager, key, timeout):
+        self.manager = manager
+        self.key = key
+        self.timeout = timeout
+        self.expires = time.monotonic() + timeout
+        self._future = None
+        self._check = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.manager.close(self)
+
+    @property
+    def waiting(self):
+        """ Return whether the session is waiting for a reply
+"""
+        return self._future is not None and not self._future.done()
+
+    def offer(self, message):
+        """ Resolve the pending wait with message if it passes the check
+"""
+        if not self.waiting or (
+                self._check is not None and not self._check(message)
+        ):
+            return False
+        self.expires = time.monotonic() + self.timeout
+        self._future.set_result(message)
+        return True
+
+    async def wait(self, check=None, timeout=None):
+        """ Return the next reply passing check
+            Raises asyncio.TimeoutError after timeout seconds
+"""
+        timeout = self.timeout if timeout is None else timeout
+        self._future = asyncio.get_running_loop().create_future()
+        self._check = check
+        self.expires = time.monotonic() + timeout
+        try:
+            return await asyncio.wait_for(self._future, timeout)
+        finally:
+            self._future = self._check = None
+
+    def cancel(self):
+        """ Cancel the pending wait, if any
+"""
+        if self.waiting:
+            self._future.cancel()
+
+
+class PromptManager:
+    """ Track open prompt sessions and route messages to them
+"""
+    def __init__(self, timeout=30.0):
+        self.timeout = timeout
+        self._sessions = {}
+        self._channels = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def open(self, guild_id, channel_id, author_id, timeout=None):
+        """ Open a session for author in channel
+            Raises PromptBusy if the channel already has an open session
+"""
+        self.expire()
+        if (guild_id, channel_id) in self._channels:
+            raise PromptBusy(
+                f"Channel {channel_id} already has an open prompt"
+            )
+        session = PromptSession(
+            self, (guild_id, channel_id, author_id),
+            self.timeout if timeout is None else timeout
+        )
+        self._sessions[session.key] = session
+        self._channels[session.key[:2]] = session
+        return session
+
+    def close(self, session):
+        """ Cancel and forget a session
+"""
+        session.cancel()
+        if self._sessions.get(session.key) is session:
+            del self._sessions[session.key]
+            del self._channels[session.key[:2]]
+
+    def expire(self):
+        """ Close idle sessions past their timeout and return how many
+"""
+        now = time.monotonic()
+        stale = [
+            s for s in self._sessions.values()
+            if not s.waiting and s.expires < now
+        ]
+        for session in stale:
+            self.close(session)
+        return len(stale)
+
+    async def on_message(self, message):
+        """ Route a message to the session of its author and channel
+"""
+        if message.guild is None:
+            return
+        session = self._sessions.get(
+            (message.guild.id, message.channel.id, message.author.id)
+        )
+        if session is not None:
+            session.offer(message)
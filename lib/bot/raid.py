@@ -0,0 +1,337 @@
+#! python3
+# raid.py
+
+"""
+Detects ghost ping floods and summarizes them while they last
+- Counts ghost pings per guild and per author in sliding windows of
+  fixed-size ring buffers, keeping a bounded number of counters
+- Switches a guild into raid mode when either count crosses the guild's
+  thresholds, sending one summary alert which is edited in place instead of
+  one alert per ghost ping
+- Leaves raid mode once the guild's rate falls below half of its thresholds
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import asyncio
+import collections
+import logging
+import time
+
+import discord
+
+from lib.bot.coalescer import TRANSIENT_ERRORS
+from lib.bot.templates import EmbedTemplate
+from lib.db.migrations import RAID_AUTHOR_THRESHOLD, RAID_THRESHOLD
+
+# Seconds covered by the sliding windows and the buckets they are split into
+WINDOW = 60
+BUCKETS = 12
+# Guild and author counters kept before the least recently used is dropped
+MAX_COUNTERS = 8192
+# Seconds between edits of a raid summary
+EDIT_INTERVAL = 5
+# Raid mode ends once the guild's rate falls below this share of the
+# smallest enabled threshold, so a rate hovering around a threshold does not
+# toggle raid mode
+EXIT_RATIO = 0.5
+# Members and channels listed in a raid summary
+TOP = 10
+
+RAID_SUMMARY = EmbedTemplate(
+    "Raid Mode :rotating_light: :ghost:", [
+        ("Ghost Pings", "{pings}"), ("Members", "{members}"),
+        ("Channels", "{channels}"),
+        ("Top Members", "{top_members}", False),
+        ("Top Channels", "{top_channels}", False)
+    ], description="{status}", footer="Started At: {started_at}"
+)
+
+
+class RingCounter:
+    """ Count events in a sliding window of fixed-size buckets
+        Each bucket remembers the tick it counts, so stale buckets are
+        reset when reused instead of being expired by a timer
+"""
+    __slots__ = ("width", "counts", "ticks")
+
+    def __init__(self, window=WINDOW, buckets=BUCKETS):
+        self.width = window / buckets
+        self.counts = [0] * buckets
+        self.ticks = [-1] * buckets
+
+    def add(self, now, n=1):
+        """ Count n events at time now
+"""
+        tick = int(now // self.width)
+        i = tick % len(self.counts)
+        if self.ticks[i] != tick:
+            self.ticks[i] = tick
+            self.counts[i] = 0
+        self.counts[i] += n
+
+    def total(self, now):
+        """ Return the number of events in the window ending at time now
+"""
+        oldest = int(now // self.width) - len(self.counts)
+        return sum(
+            count for count, tick in zip(self.counts, self.ticks)
+            if tick > oldest
+        )
+
+
+class Raid:
+    """ Ghost pings of a guild in raid mode and the summary alert of them
+"""
+    def __init__(self, guild, channel, fallback, trigger, thresholds):
+        self.guild = guild
+        self.channel = channel
+        self.fallback = fallback
+        self.trigger = trigger
+        self.thresholds = thresholds
+        self.started = time.time()
+        self.ended = None
+        self.pings = 0
+        self.members = collections.Counter()
+        self.channels = collections.Counter()
+        self.message = None
+        self.dirty = True
+        self.task = None
+
+    def add(self, author_name, channel_name):
+        """ Count a ghost ping in the summary
+"""
+        self.pings += 1
+        self.members[author_name] += 1
+        self.channels[channel_name] += 1
+        self.dirty = True
+
+    def render(self):
+        """ Return the summary embed
+"""
+        if self.ended is None:
+            status = (
+                f"Raid mode started after {self.trigger} ghost pings within "
+                f"{WINDOW} seconds. Ghost pings are summarized here instead "
+                f"of being alerted one by one."
+            )
+        else:
+            status = (
+                f"Raid mode ended after {self.ended - self.started:.0f} "
+                f"seconds."
+            )
+        return RAID_SUMMARY.render({
+            "status": status, "pings": self.pings,
+            "members": len(self.members), "channels": len(self.channels),
+            "top_members": self.top(self.members),
+            "top_channels": self.top(self.channels),
+            "started_at": time.strftime("%D %T", time.gmtime(self.started))
+        })
+
+    @staticmethod
+    def top(counter):
+        """ Format the most common names of a counter, one per line
+"""
+        return "\n".join(
+            f"{name}: {count}" for name, count in counter.most_common(TOP)
+        ) or "None"
+
+
+class RaidMonitor:
+    """ Count ghost pings and summarize those of guilds in raid mode
+        A guild enters raid mode when it or one author sends at least the
+        guild's raid_threshold or raid_author_threshold ghost pings within
+        window seconds, and leaves it once its rate falls below exit_ratio
+        of the smallest enabled threshold
+        The summary is sent to the notification channel, or fallback when
+        the bot cannot send there, and edited at most every edit_interval
+        seconds
+"""
+    def __init__(self, bot, window=WINDOW, buckets=BUCKETS,
+                 max_counters=MAX_COUNTERS, edit_interval=EDIT_INTERVAL,
+                 exit_ratio=EXIT_RATIO, clock=time.monotonic):
+        self.bot = bot
+        self.window = window
+        self.buckets = buckets
+        self.max_counters = max_counters
+        self.edit_interval = edit_interval
+        self.exit_ratio = exit_ratio
+        self.clock = clock
+        self.raids = {}
+        self.started = 0
+        self.summarized = 0
+        self.edits = 0
+        self._counters = collections.OrderedDict()
+
+    def count(self, key, now):
+        """ Count an event for key and return its total in the window
+"""
+        counter = self._counters.pop(key, None)
+        if counter is None:
+            counter = RingCounter(self.window, self.buckets)
+            if len(self._counters) >= self.max_counters:
+                self._counters.popitem(last=False)
+        self._counters[key] = counter
+        counter.add(now)
+        return counter.total(now)
+
+    @staticmethod
+    def thresholds(preferences):
+        """ Return the guild and author thresholds of guild preferences
+            Guilds without preferences use the defaults
+"""
+        if preferences is None:
+            return RAID_THRESHOLD, RAID_AUTHOR_THRESHOLD
+        return (
+            preferences.get("raid_threshold", RAID_THRESHOLD),
+            preferences.get("raid_author_threshold", RAID_AUTHOR_THRESHOLD)
+        )
+
+    def record(self, guild, record, preferences, channel, origin):
+        """ Count a ghost ping and return whether it belongs to a raid
+            Ghost pings of a raid are added to its summary, so the caller
+            must not alert them separately
+"""
+        thresholds = self.thresholds(preferences)
+        raid = self.raids.get(guild.id)
+        if raid is None and not any(thresholds):
+            return False
+        now = self.clock()
+        total = self.count(guild.id, now)
+        authored = self.count((guild.id, record.author_id), now)
+        if raid is None:
+            guild_threshold, author_threshold = thresholds
+            if not (
+                    0 < guild_threshold <= total
+                    or 0 < author_threshold <= authored
+            ):
+                return False
+            raid = self.start(guild, channel, origin, total, thresholds)
+        raid.thresholds = thresholds
+        raid.add(
+            record.author_name, origin.name if origin else "Unknown"
+        )
+        self.summarized += 1
+        return True
+
+    def start(self, guild, channel, fallback, trigger, thresholds):
+        """ Switch a guild into raid mode
+"""
+        logging.warning(
+            "Guild %s entered raid mode after %d ghost pings",
+            guild.id, trigger
+        )
+        raid = Raid(guild, channel, fallback, trigger, thresholds)
+        self.raids[guild.id] = raid
+        self.started += 1
+        raid.task = asyncio.ensure_future(self._run(raid))
+        return raid
+
+    def calm(self, raid):
+        """ Return whether the rate of a raid's guild fell low enough to
+            leave raid mode
+"""
+        enabled = [t for t in raid.thresholds if t > 0]
+        if not enabled:
+            return True
+        counter = self._counters.get(raid.guild.id)
+        total = 0 if counter is None else counter.total(self.clock())
+        # Authors never send more ghost pings than the whole guild
+        return total < self.exit_ratio * min(enabled)
+
+    async def _run(self, raid):
+        try:
+            while True:
+                if raid.dirty:
+                    await self.publish(raid)
+                await asyncio.sleep(self.edit_interval)
+                if self.calm(raid):
+                    break
+        finally:
+            # Never leave a guild in raid mode without a summary task
+            if self.raids.get(raid.guild.id) is raid:
+                del self.raids[raid.guild.id]
+        await self.end(raid)
+
+    async def end(self, raid):
+        """ Show the final summary of a raid which left raid mode
+"""
+        raid.ended = time.time()
+        raid.dirty = True
+        logging.info(
+            "Guild %s left raid mode after %d ghost pings",
+            raid.guild.id, raid.pings
+        )
+        await self.publish(raid)
+
+    async def publish(self, raid):
+        """ Send the summary of a raid, or edit the one already sent
+            Failures leave the summary dirty, so the next edit retries
+"""
+        raid.dirty = False
+        embed = raid.render()
+        alerts = self.bot.alerts
+        try:
+            if raid.message is not None:
+                channel = raid.message.channel
+                self.edits += 1
+                await raid.message.edit(embed=embed)
+                return
+            for channel in (raid.channel, raid.fallback):
+                if channel is not None and alerts.sendable(channel):
+                    break
+            else:
+                alerts.notify_owner(raid.channel)
+                return
+            raid.message = await channel.send(embed=embed)
+        except discord.NotFound:
+            # The summary was deleted, so send a new one
+            raid.message = None
+            raid.dirty = True
+        except discord.Forbidden:
+            alerts.deny(channel)
+            raid.message = None
+            raid.dirty = True
+        except (discord.HTTPException, *TRANSIENT_ERRORS):
+            logging.exception(
+                "Failed to send the raid summary of %s", raid.guild.id
+            )
+            raid.dirty = True
+
+    async def close(self):
+        """ End every raid, showing its final summary
+"""
+        raids = list(self.raids.values())
+        self.raids.clear()
+        for raid in raids:
+            raid.task.cancel()
+        await asyncio.gather(*(r.task for r in raids), return_exceptions=True)
+        for raid in raids:
+            await self.end(raid)
+
+    def stats(self):
+        """ Return the number of raids and the ghost pings they summarized
+"""
+        return {
+            "active": len(self.raids), "started": self.started,
+            "summarized": self.summarized, "edits": self.edits
+        }
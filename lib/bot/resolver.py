@@ -0,0 +1,184 @@
+#! python3
+# resolver.py
+
+"""
+Resolves mention and channel IDs to guild entities
+- Roles and channels are looked up through the guild's ID indexes
+- Member names are cached in a least-recently-used cache, optionally
+  expiring after a time to live
+- Uncached members are requested from Discord in one batch
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import asyncio
+import collections
+import logging
+import time
+
+import discord
+
+# Guild.query_members accepts at most 100 user IDs per request
+QUERY_LIMIT = 100
+
+
+class EntityResolver:
+    """ Resolve role, channel, and member IDs without scanning guild lists
+        Member names expire after ttl seconds when ttl is set, for bots
+        which do not receive updates of uncached members
+"""
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+        self._names = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._names)
+
+    @staticmethod
+    def channel(guild, channel_id):
+        """ Return the channel of the guild with the ID, or None
+"""
+        return guild.get_channel(channel_id)
+
+    @staticmethod
+    def role_names(guild, role_ids):
+        """ Return the names of the roles of the guild with the IDs
+"""
+        names = []
+        for role_id in role_ids:
+            role = guild.get_role(role_id)
+            names.append(
+                role.name if role is not None else f"Unknown Role ({role_id})"
+            )
+        return names
+
+    async def member_names(self, guild, member_ids):
+        """ Return the display names of the members of the guild with the IDs
+            Members which are not cached are requested in a single batch
+"""
+        names, missing = {}, []
+        for member_id in member_ids:
+            name = self._get(guild.id, member_id)
+            if name is None:
+                member = guild.get_member(member_id)
+                if member is not None:
+                    name = self._put(guild.id, member)
+            if name is None:
+                missing.append(member_id)
+            else:
+                names[member_id] = name
+        if missing:
+            for member in await self.query(guild, missing):
+                names[member.id] = self._put(guild.id, member)
+        return [
+            names.get(i, f"Unknown Member ({i})") for i in member_ids
+        ]
+
+    async def query(self, guild, member_ids):
+        """ Request uncached members of the guild from Discord
+"""
+        self.queries += 1
+        member_ids = list(dict.fromkeys(member_ids))[:QUERY_LIMIT]
+        try:
+            return await guild.query_members(
+                user_ids=member_ids, limit=len(member_ids), cache=False
+            )
+        except (asyncio.TimeoutError, discord.ClientException):
+            logging.warning(
+                "Failed to query %d members of guild %s",
+                len(member_ids), guild.id
+            )
+            return []
+
+    def _get(self, guild_id, member_id):
+        key = (guild_id, member_id)
+        name, expires = self._names.get(key, (None, None))
+        if expires is not None and expires < time.monotonic():
+            del self._names[key]
+            name = None
+        if name is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._names.move_to_end(key)
+        return name
+
+    def _put(self, guild_id, member):
+        self._names[(guild_id, member.id)] = (
+            member.display_name,
+            None if self.ttl is None else time.monotonic() + self.ttl
+        )
+        self._names.move_to_end((guild_id, member.id))
+        while len(self._names) > self.maxsize:
+            self._names.popitem(last=False)
+        return member.display_name
+
+    def invalidate_member(self, guild_id, member_id):
+        """ Drop the cached name of a member of a guild
+"""
+        self._names.pop((guild_id, member_id), None)
+
+    def invalidate_user(self, user_id):
+        """ Drop the cached names of a user in every guild
+"""
+        for key in [k for k in self._names if k[1] == user_id]:
+            del self._names[key]
+
+    def invalidate_guild(self, guild_id):
+        """ Drop the cached names of every member of a guild
+"""
+        for key in [k for k in self._names if k[0] == guild_id]:
+            del self._names[key]
+
+    async def on_member_update(self, before, after):
+        """ Drop the cached name when a member changes nickname
+"""
+        if before.display_name != after.display_name:
+            self.invalidate_member(after.guild.id, after.id)
+
+    async def on_member_remove(self, member):
+        """ Drop the cached name when a member leaves
+"""
+        self.invalidate_member(member.guild.id, member.id)
+
+    async def on_user_update(self, before, after):
+        """ Drop the cached names when a user changes username
+"""
+        if before.name != after.name:
+            self.invalidate_user(after.id)
+
+    async def on_guild_remove(self, guild):
+        """ Drop the cached names of a guild the bot was removed from
+"""
+        self.invalidate_guild(guild.id)
+
+    def stats(self):
+        """ Return the cache counters of the resolver
+"""
+        return {
+            "hits": self.hits, "misses": self.misses,
+            "queries": self.queries, "size": len(self._names)
+        }
@@ -0,0 +1,265 @@
+#! python3
+# store.py
+
+"""
+Compact store of recently sent messages which contain mentions
+- Only keeps messages with member, role, or everyone mentions
+- Records hold ids, mention ids, and truncated content in __slots__
+- Bounded per guild and by an estimated global memory limit
+- Optionally mirrors changes to an on-disk MentionJournal
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import collections
+import datetime
+import sys
+
+DISCORD_EPOCH = 1420070400000
+
+
+class MentionRecord:
+    """ Compact copy of the parts of a discord.Message needed for detection
+"""
+    __slots__ = (
+        "id", "guild_id", "channel_id", "author_id", "author_name",
+        "mentions", "role_mentions", "mention_everyone", "content",
+        "timestamp"
+    )
+
+    def __init__(
+            self, id, guild_id, channel_id, author_id, author_name,
+            mentions, role_mentions, mention_everyone, content, timestamp
+    ):
+        self.id = id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.mentions = mentions
+        self.role_mentions = role_mentions
+        self.mention_everyone = mention_everyone
+        self.content = content
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_message(cls, message, content_limit=1024):
+        """ Create a record from a message
+            Returns None if the message does not contain any mentions
+"""
+        mentions = tuple(message.raw_mentions)
+        role_mentions = tuple(message.raw_role_mentions)
+        if not (mentions or role_mentions or message.mention_everyone):
+            return None
+        return cls(
+            message.id, message.guild.id, message.channel.id,
+            message.author.id, message.author.name,
+            mentions, role_mentions, message.mention_everyone,
+            message.content[:content_limit],
+            ((message.id >> 22) + DISCORD_EPOCH) / 1000
+        )
+
+    @classmethod
+    def from_data(cls, data, content_limit=1024):
+        """ Create a record from a raw MESSAGE_CREATE or MESSAGE_UPDATE payload
+            Returns None if the message is from a bot or has no mentions
+            Raises ValueError if the payload is partial and lacks the fields
+            needed to tell which mentions it holds
+"""
+        try:
+            author = data["author"]
+            guild_id = int(data["guild_id"])
+            content = data["content"]
+            mentions = tuple(int(u["id"]) for u in data["mentions"])
+            role_mentions = tuple(int(i) for i in data["mention_roles"])
+            mention_everyone = data["mention_everyone"]
+        except KeyError as e:
+            raise ValueError(f"Partial message payload, missing {e}")
+        if author.get("bot", False):
+            return None
+        if not (mentions or role_mentions or mention_everyone):
+            return None
+        message_id = int(data["id"])
+        return cls(
+            message_id, guild_id, int(data["channel_id"]),
+            int(author["id"]), author["username"],
+            mentions, role_mentions, mention_everyone,
+            content[:content_limit],
+            ((message_id >> 22) + DISCORD_EPOCH) / 1000
+        )
+
+    def removed(self, after):
+        """ Return a copy of the record holding only the mentions which are
+            missing from the edited record after
+            Returns None if no mentions were removed
+"""
+        if after is None:
+            mentions, role_mentions = self.mentions, self.role_mentions
+            mention_everyone = self.mention_everyone
+        else:
+            mentions = tuple(
+                i for i in self.mentions if i not in after.mentions
+            )
+            role_mentions = tuple(
+                i for i in self.role_mentions if i not in after.role_mentions
+            )
+            mention_everyone = (
+                self.mention_everyone and not after.mention_everyone
+            )
+        if not (mentions or role_mentions or mention_everyone):
+            return None
+        return type(self)(
+            self.id, self.guild_id, self.channel_id, self.author_id,
+            self.author_name, mentions, role_mentions, mention_everyone,
+            self.content, self.timestamp
+        )
+
+    def to_row(self):
+        """ Return the record as a list of JSON serializable values
+"""
+        return [
+            self.id, self.guild_id, self.channel_id, self.author_id,
+            self.author_name, self.mentions, self.role_mentions,
+            self.mention_everyone, self.content, self.timestamp
+        ]
+
+    @classmethod
+    def from_row(cls, row):
+        """ Create a record from a list returned by to_row
+"""
+        (
+            id, guild_id, channel_id, author_id, author_name, mentions,
+            role_mentions, mention_everyone, content, timestamp
+        ) = row
+        return cls(
+            id, guild_id, channel_id, author_id, author_name,
+            tuple(mentions), tuple(role_mentions), mention_everyone,
+            content, timestamp
+        )
+
+    @property
+    def created_at(self):
+        """ Return the naive UTC datetime the message was created at
+"""
+        return datetime.datetime.utcfromtimestamp(self.timestamp)
+
+    def sizeof(self):
+        """ Estimate the number of bytes held by the record
+"""
+        return (
+            sys.getsizeof(self) + sys.getsizeof(self.author_name)
+            + sys.getsizeof(self.content) + sys.getsizeof(self.mentions)
+            + sys.getsizeof(self.role_mentions)
+        )
+
+
+class MentionStore:
+    """ Bounded store of MentionRecord objects keyed by message ID
+        The oldest records are evicted first, within a guild when the guild
+        is full, and across all guilds when the memory limit is reached
+        Records put and popped are also written to the journal, if any
+"""
+    def __init__(
+            self, max_per_guild=1000, max_bytes=32 * 1024 * 1024,
+            content_limit=1024, journal=None
+    ):
+        self.max_per_guild = max_per_guild
+        self.max_bytes = max_bytes
+        self.content_limit = content_limit
+        self.journal = journal
+        self.size = 0
+        self._records = collections.OrderedDict()
+        self._guilds = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, message_id):
+        return message_id in self._records
+
+    def add(self, message):
+        """ Store a record of the message if it contains mentions
+"""
+        record = MentionRecord.from_message(message, self.content_limit)
+        if record is not None:
+            self.put(record)
+        return record
+
+    def put(self, record):
+        """ Store a record, evicting old records to respect the limits
+"""
+        self.restore(record)
+        if self.journal is not None:
+            self.journal.append(record)
+
+    def restore(self, record):
+        """ Store a record without writing it to the journal
+"""
+        self._remove(record.id)
+        guild = self._guilds.setdefault(
+            record.guild_id, collections.OrderedDict()
+        )
+        self._records[record.id] = record
+        guild[record.id] = None
+        self.size += record.sizeof()
+        while len(guild) > self.max_per_guild:
+            self._remove(next(iter(guild)))
+        while self.size > self.max_bytes and self._records:
+            self._remove(next(iter(self._records)))
+
+    def get(self, message_id):
+        """ Return the record of a message without removing it
+"""
+        return self._records.get(message_id)
+
+    def pop(self, message_id):
+        """ Remove and return the record of a message
+            Returns None if the message is not stored
+"""
+        record = self._remove(message_id)
+        if record is not None and self.journal is not None:
+            self.journal.remove(message_id)
+        return record
+
+    def records(self):
+        """ Return the stored records from oldest to newest
+"""
+        return list(self._records.values())
+
+    def _remove(self, message_id):
+        record = self._records.pop(message_id, None)
+        if record is None:
+            return None
+        guild = self._guilds[record.guild_id]
+        del guild[message_id]
+        if not guild:
+            del self._guilds[record.guild_id]
+        self.size -= record.sizeof()
+        return record
+
+    def stats(self):
+        """ Return the number of records and estimated size of the store
+"""
+        return {
+            "records": len(self._records), "guilds": len(self._guilds),
+            "bytes": self.size, "max_bytes": self.max_bytes
+        }
@@ -0,0 +1,215 @@
+#! python3
+# templates.py
+
+"""
+Embed templates for every message the bot sends
+- Definitions are loaded from data/Configuration once and never modified
+- Each use renders a new discord.Embed from the template
+- Embeds are truncated to Discord's limits before they are sent
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import json
+import string
+
+import discord
+
+# Discord's embed limits
+MAX_TITLE = 256
+MAX_DESCRIPTION = 2048
+MAX_FIELDS = 25
+MAX_FIELD_NAME = 256
+MAX_FIELD_VALUE = 1024
+MAX_FOOTER = 2048
+MAX_AUTHOR = 256
+MAX_EMBED_LENGTH = 6000
+# Shortest length a text is truncated to when an embed is too long overall
+MIN_TRUNCATED = 32
+ELLIPSIS = "…"
+# Discord rejects fields with empty names or values
+BLANK = "\u200b"
+
+FORMATTER = string.Formatter()
+
+
+def truncate(text, limit):
+    """ Return text, shortened with an ellipsis if it exceeds limit
+"""
+    if len(text) <= limit:
+        return text
+    return text[:limit - 1] + ELLIPSIS
+
+
+def with_inline(field):
+    """ Return a (name, value) field as (name, value, True)
+"""
+    return field if len(field) == 3 else (*field, True)
+
+
+class Text:
+    """ Template string which is only formatted if it has placeholders
+"""
+    __slots__ = ("text", "formatted")
+
+    def __init__(self, text):
+        self.text = text
+        self.formatted = any(
+            field is not None for _, field, _, _ in FORMATTER.parse(text)
+        )
+
+    def render(self, values):
+        return self.text.format_map(values) if self.formatted else self.text
+
+
+class EmbedTemplate:
+    """ Immutable definition of an embed with str.format placeholders
+        Fields are (name, value[, inline]) tuples
+        Rendering never modifies the template, so it can be shared
+"""
+    __slots__ = ("title", "description", "color", "fields", "footer")
+
+    def __init__(self, title, fields=(), description=None, color=0xff0000,
+                 footer=None):
+        self.title = Text(title)
+        self.description = None if description is None else Text(description)
+        self.color = color
+        self.fields = tuple(
+            (Text(name), Text(value), inline)
+            for name, value, inline in map(with_inline, fields)
+        )
+        self.footer = None if footer is None else Text(footer)
+
+    @classmethod
+    def load(cls, path, title, **options):
+        """ Create a template from a JSON file mapping field names to values
+"""
+        with open(path, encoding="utf-8") as file:
+            return cls(title, json.load(file).items(), **options)
+
+    def render(self, values=None, fields=()):
+        """ Return a new embed with the placeholders filled from values,
+            truncated to Discord's limits
+            fields are (name, value[, inline]) tuples appended after the
+            template's own fields
+"""
+        values = {} if values is None else values
+        data = {
+            "type": "rich", "color": self.color,
+            "title": self.title.render(values),
+            "fields": [
+                {
+                    "name": name.render(values),
+                    "value": value.render(values),
+                    "inline": field_inline
+                }
+                for name, value, field_inline in self.fields
+            ] + [
+                {"name": str(name), "value": str(value), "inline": inline}
+                for name, value, inline in map(with_inline, fields)
+            ]
+        }
+        if self.description is not None:
+            data["description"] = self.description.render(values)
+        if self.footer is not None:
+            data["footer"] = {"text": self.footer.render(values)}
+        return discord.Embed.from_dict(fit_data(data))
+
+
+def length(data):
+    """ Return the length of an embed dict as counted by Discord
+"""
+    return (
+        len(data.get("title", "")) + len(data.get("description", ""))
+        + len(data.get("footer", {}).get("text", ""))
+        + len(data.get("author", {}).get("name", ""))
+        + sum(len(f["name"]) + len(f["value"]) for f in data.get("fields", ()))
+    )
+
+
+def fits(data):
+    """ Return whether an embed dict is already within Discord's limits
+"""
+    fields = data.get("fields", ())
+    if len(fields) > MAX_FIELDS:
+        return False
+    total = 0
+    for field in fields:
+        name, value = len(field["name"]), len(field["value"])
+        if not 0 < name <= MAX_FIELD_NAME or not 0 < value <= MAX_FIELD_VALUE:
+            return False
+        total += name + value
+    for text, limit in (
+            (data.get("title", ""), MAX_TITLE),
+            (data.get("description", ""), MAX_DESCRIPTION),
+            (data.get("footer", {}).get("text", ""), MAX_FOOTER),
+            (data.get("author", {}).get("name", ""), MAX_AUTHOR)
+    ):
+        if len(text) > limit:
+            return False
+        total += len(text)
+    return total <= MAX_EMBED_LENGTH
+
+
+def fit_data(data):
+    """ Truncate an embed dict in place to Discord's limits and return it
+        Fields beyond the limit are dropped, and the longest texts are
+        shortened until the embed fits in the overall length limit
+"""
+    if fits(data):
+        return data
+    if "title" in data:
+        data["title"] = truncate(data["title"], MAX_TITLE)
+    if "description" in data:
+        data["description"] = truncate(data["description"], MAX_DESCRIPTION)
+    if "text" in data.get("footer", {}):
+        data["footer"]["text"] = truncate(data["footer"]["text"], MAX_FOOTER)
+    if "name" in data.get("author", {}):
+        data["author"]["name"] = truncate(data["author"]["name"], MAX_AUTHOR)
+    fields = data.get("fields", [])
+    del fields[MAX_FIELDS:]
+    for field in fields:
+        field["name"] = truncate(field["name"], MAX_FIELD_NAME) or BLANK
+        field["value"] = truncate(field["value"], MAX_FIELD_VALUE) or BLANK
+    excess = length(data) - MAX_EMBED_LENGTH
+    while excess > 0:
+        # Shorten the longest of the description and field values first
+        texts = [(len(f["value"]), f, "value") for f in fields]
+        if "description" in data:
+            texts.append((len(data["description"]), data, "description"))
+        size, owner, key = max(texts, key=lambda t: t[0], default=(0,) * 3)
+        if size <= MIN_TRUNCATED:
+            if not fields:
+                break
+            field = fields.pop()
+            excess -= len(field["name"]) + len(field["value"])
+            continue
+        target = max(size - excess, MIN_TRUNCATED)
+        owner[key] = truncate(owner[key], target)
+        excess -= size - target
+    return data
+
+
+def fit(embed):
+    """ Return a copy of the embed truncated to Discord's limits
+"""
+    return discord.Embed.from_dict(fit_data(embed.to_dict()))
@@ -3,9 +3,12 @@
 
 """
 Anti-GhostPing discord.exts.commands.Cog Cog
+- Records messages with mentions in the mention store
 - Parse delete messages for ghost pings
 - Flags all mentions which are set to 1 in data/db/db.sqlite
     - Bot preferences can be modified with the configuration cog
+- Bulk deletes are parsed in one pass and summarized in one alert
+- Edits which remove mentions from a message are flagged as ghost pings
 - Sends notification to specified channel
     - Default channel is the channel where the message occurred
 ===============================================================================
@@ -31,9 +34,28 @@ SOFTWARE.
 ===============================================================================
 """
 
-import discord
+import time
+
 from discord.ext import commands
 
+from lib.bot import store
+from lib.bot.metrics import timed
+from lib.bot.templates import EmbedTemplate
+
+GHOST_PING = EmbedTemplate(
+    "Ghost Ping Detected :no_entry_sign: :ghost:", [
+        ("Member", "{member}"), ("Message", "{message}"),
+        ("Channel", "{channel}")
+    ], color=0x0000ff, footer="Detect At: {detected_at}"
+)
+BULK_GHOST_PINGS = EmbedTemplate(
+    "Bulk Ghost Pings Detected :no_entry_sign: :ghost:",
+    description=(
+        "{messages} deleted messages from {members} members contained "
+        "mentions"
+    ), color=0x0000ff
+)
+
 
 class AntiGhostPing(commands.Cog):
     """ Listen for and handle ghost pings
@@ -42,92 +64,248 @@ class AntiGhostPing(commands.Cog):
         self.bot = bot
 
     @commands.Cog.listener()
-    async def on_message_delete(self, message):
+    @timed("message")
+    async def on_message(self, message):
+        """ Record messages which contain mentions in the mention store
+"""
+        if message.guild is None or message.author.bot:
+            return
+        self.bot.message_store.add(message)
+
+    @commands.Cog.listener()
+    @timed("raw_message_delete")
+    async def on_raw_message_delete(self, payload):
         """ Notify logging of event reference
             Check for and handle host ping
 """
-        if message.author.bot:
+        if payload.guild_id is None:
+            return
+        record = self.bot.message_store.pop(payload.message_id)
+        if record is None and payload.cached_message is not None:
+            if payload.cached_message.author.bot:
+                return
+            record = store.MentionRecord.from_message(payload.cached_message)
+        if record is None:
+            return
+        guild = self.bot.get_guild(payload.guild_id)
+        if guild is None:
+            return
+        flags = await self.parse(guild, record)
+        if flags:
+            await self.detected(guild, record, flags)
+
+    @commands.Cog.listener()
+    @timed("raw_message_edit")
+    async def on_raw_message_edit(self, payload):
+        """ Check for mentions which were edited out of a message
+            Compares the mention IDs of the stored record with those of the
+            raw edit payload, so the message cache is not needed
+"""
+        data = payload.data
+        if "content" not in data or "guild_id" not in data:
+            return
+        message_store = self.bot.message_store
+        try:
+            after = store.MentionRecord.from_data(
+                data, message_store.content_limit
+            )
+        except ValueError:
+            # A partial update cannot show which mentions are left, so the
+            # stored record is kept for the next edit or delete
+            return
+        before = message_store.pop(payload.message_id)
+        cached = payload.cached_message
+        if before is None and cached is not None and not cached.author.bot:
+            before = store.MentionRecord.from_message(cached)
+        if after is not None:
+            message_store.put(after)
+        if before is None:
+            return
+        removed = before.removed(after)
+        if removed is None:
             return
-        flags = await self.parse(message)
+        guild = self.bot.get_guild(removed.guild_id)
+        if guild is None:
+            return
+        flags = await self.parse(guild, removed)
         if flags:
-            await self.detected(message, flags)
+            flags["Edited To"] = data["content"][:1024] or "(empty)"
+            await self.detected(guild, removed, flags)
 
-    async def parse(self, message):
-        """ Parse message for all specified mentions
+    @commands.Cog.listener()
+    @timed("raw_bulk_message_delete")
+    async def on_raw_bulk_message_delete(self, payload):
+        """ Check all messages of a bulk delete for ghost pings in one pass
+            Send one summary alert instead of one alert per message
 """
-        # Get guild preferences from db.sqlite
-        select_preferences_table = """
-        SELECT 
-            roles,
-            members,
-            everyone
-        FROM 
-            preferences
-        WHERE GuildID=?"""
-        columns, prefs = self.bot.connection.execute_query(
-            select_preferences_table, "rr",
-            message.guild.id
+        if payload.guild_id is None:
+            return
+        guild = self.bot.get_guild(payload.guild_id)
+        if guild is None:
+            return
+        cached = {m.id: m for m in payload.cached_messages}
+        records = []
+        for message_id in payload.message_ids:
+            record = self.bot.message_store.pop(message_id)
+            message = cached.get(message_id)
+            if (
+                    record is None and message is not None
+                    and not message.author.bot
+            ):
+                record = store.MentionRecord.from_message(message)
+            if record is not None:
+                records.append(record)
+        if not records:
+            return
+        preferences = await self.bot.preferences.get(guild.id)
+        if preferences is None:
+            return
+        offenders = {}
+        for record in records:
+            counts = self.count_mentions(record, preferences)
+            if not any(counts):
+                continue
+            totals = offenders.setdefault(
+                (record.channel_id, record.author_id),
+                [record.author_name, 0, 0, 0, 0]
+            )
+            totals[1] += 1
+            for i, count in enumerate(counts, start=2):
+                totals[i] += count
+            self.audit(record, counts)
+        if offenders:
+            self.bot.metrics.detections.inc(
+                sum(t[1] for t in offenders.values())
+            )
+            await self.bulk_detected(guild, preferences, offenders)
+
+    @staticmethod
+    def count_mentions(record, preferences):
+        """ Count the flagged member, role, and everyone mentions of a record
+"""
+        return (
+            len(record.mentions) if preferences["members"] else 0,
+            len(record.role_mentions) if preferences["roles"] else 0,
+            int(record.mention_everyone) if preferences["everyone"] else 0
         )
-        preferences = dict(zip(columns, prefs[0]))
+
+    def audit(self, record, counts):
+        """ Queue a ghost ping to be written to the ghostpings table and
+            counted in the daily, author, and channel rollups
+"""
+        members, roles, everyone = counts
+        self.bot.writer.add("insert_ghostpings", (
+            record.guild_id, record.channel_id, record.author_id, record.id,
+            record.author_name, record.content, members, roles, everyone,
+            record.timestamp, time.time()
+        ))
+
+    async def parse(self, guild, record):
+        """ Parse message record for all specified mentions
+"""
+        # Get guild preferences from the preferences cache
+        preferences = await self.bot.preferences.get(guild.id)
+        if preferences is None:
+            return {}
         # Parse message for raw mentions and flags for specified preferences
         flags = {}
         # Check for role mentions
-        if preferences["roles"] and message.raw_role_mentions:
-            role_mentions = [
-                discord.utils.get(message.guild.roles, id=i).name
-                for i in message.raw_role_mentions
-            ]
+        if preferences["roles"] and record.role_mentions:
+            role_mentions = self.bot.resolver.role_names(
+                guild, record.role_mentions
+            )
             flags.setdefault("Roles Mentioned", ", ".join(role_mentions))
         # Check for member mentions
-        if preferences["members"] and message.raw_mentions:
-            raw_mentions = [
-                discord.utils.get(message.guild.members, id=i).name
-                for i in message.raw_mentions
-            ]
+        if preferences["members"] and record.mentions:
+            raw_mentions = await self.bot.resolver.member_names(
+                guild, record.mentions
+            )
             flags.setdefault("Members Mentioned", ", ".join(raw_mentions))
         # Check for everyone mentions
-        if preferences["everyone"] and message.mention_everyone:
+        if preferences["everyone"] and record.mention_everyone:
             flags.setdefault("Other Groups Mentioned", "everyone")
         return flags
 
-    async def detected(self, message, flags):
+    async def detected(self, guild, record, flags):
         """ Alert guild by sending message to specified channel
 """
-        # Get guild preferences from db.sqlite
-        select_preferences_table = """
-        SELECT channel
-        FROM preferences
-        WHERE GuildID=?"""
-        columns, prefs = self.bot.connection.execute_query(
-            select_preferences_table, "rr",
-            message.guild.id
-        )
-        preferences = dict(zip(columns, prefs[0]))
         # Get notification channel preferences from guild preferences
-        if preferences is None:
-            channel = message.channel
-        else:
-            channel = discord.utils.get(
-                message.guild.channels,
-                id=preferences["channel"]
-            )
-            if channel is None:
-                channel = message.channel
+        origin = self.bot.resolver.channel(guild, record.channel_id)
+        preferences = await self.bot.preferences.get(guild.id)
+        if preferences is not None:
+            self.audit(record, self.count_mentions(record, preferences))
+        channel = self.notification_channel(guild, preferences, origin)
+        if channel is None:
+            return
+        self.bot.metrics.detections.inc()
+        # Ghost pings of a raid are summarized instead of alerted
+        if self.bot.raids.record(guild, record, preferences, channel, origin):
+            return
         # Send notifying embed to specified channel
-        embed = discord.Embed(
-            title="Ghost Ping Detected :no_entry_sign: :ghost:",
-            color=0x0000ff
-        )
-        fields = {
-            "Member": message.author.name, "Message": message.content,
-            "Channel": message.channel.name
-        }
-        fields = {**fields, **flags}
-        for field in fields:
-            embed.add_field(name=field, value=fields[field])
-        embed.set_footer(
-            text=f"Detect At: {message.created_at.strftime('%D %T')}")
-        await channel.send(embed=embed)
+        channel_name = origin.name if origin is not None else "Unknown"
+        detected_at = record.created_at.strftime('%D %T')
+        embed = GHOST_PING.render({
+            "member": record.author_name, "message": record.content,
+            "channel": channel_name, "detected_at": detected_at
+        }, fields=flags.items())
+        # Queue the alert so bursts to the channel share messages
+        summary = "\n".join(f"{f}: {flags[f]}" for f in flags)
+        self.bot.alerts.add(channel, embed, (
+            f"{record.author_name} in {channel_name} at {detected_at}",
+            f"{summary}\nMessage: {record.content}"
+        ), fallback=origin)
+
+    async def bulk_detected(self, guild, preferences, offenders):
+        """ Alert guild with one summary per notification channel
+            offenders maps (channel ID, author ID) to the author name,
+            message count, and member, role, and everyone mention counts
+"""
+        summaries = {}
+        for (channel_id, author_id), totals in offenders.items():
+            origin = self.bot.resolver.channel(guild, channel_id)
+            channel = self.notification_channel(guild, preferences, origin)
+            if channel is not None:
+                summaries.setdefault(channel, []).append(
+                    (origin, author_id, totals)
+                )
+        for channel, entries in summaries.items():
+            entries.sort(key=lambda e: e[2][1], reverse=True)
+            fields = []
+            for origin, _, totals in entries[:24]:
+                name, messages, members, roles, everyone = totals
+                fields.append((name, (
+                    f"Channel: {origin.name if origin else 'Unknown'}\n"
+                    f"Messages: {messages}\n"
+                    f"Members Mentioned: {members}\n"
+                    f"Roles Mentioned: {roles}\n"
+                    f"Everyone Mentioned: {everyone}"
+                )))
+            # Entries are per member and channel, so members may repeat
+            if len(entries) > 24:
+                fields.append((
+                    "Not Listed",
+                    f"{len(entries) - 24} more member and channel entries",
+                    False
+                ))
+            embed = BULK_GHOST_PINGS.render({
+                "messages": sum(e[2][1] for e in entries),
+                "members": len({e[1] for e in entries})
+            }, fields=fields)
+            # Fall back to the channel with the most ghost pings
+            self.bot.alerts.add(channel, embed, (
+                embed.title, embed.description
+            ), fallback=entries[0][0])
+
+    def notification_channel(self, guild, preferences, origin):
+        """ Return the configured notification channel of the guild
+            Defaults to the channel where the message was sent
+"""
+        if preferences is None:
+            return origin
+        channel = self.bot.resolver.channel(guild, preferences["channel"])
+        if channel is None:
+            return origin
+        return channel
 
 
 def setup(bot):
@@ -0,0 +1,159 @@
+#! python3
+# audit.py
+
+"""
+Audit discord.exts.commands.Cog Cog
+- Allow moderators to page through the ghost pings recorded in a guild
+- Pages are read by keyset on the ghostpings ID, so every page is an
+  index range scan no matter how many ghost pings are recorded
+- Summarizes ghost pings by day, author, and channel from rollup tables
+  which are updated as ghost pings are detected
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import datetime
+import time
+import typing
+
+import discord
+from discord.ext import commands
+
+from lib.bot.templates import fit
+
+PAGE_SIZE = 10
+MAX_DAYS = 365
+# Days listed in the daily breakdown of the leaderboard
+DAILY_ROWS = 14
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+# Keeps a full page within the 6000 character limit of an embed
+CONTENT_LIMIT = 400
+
+
+class Audit(commands.Cog):
+    """ Show recorded ghost pings and their statistics to moderators
+"""
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.command(name="history", pass_context=True, aliases=["h"])
+    @commands.guild_only()
+    @commands.has_permissions(manage_messages=True)
+    async def history(
+            self, ctx, member: typing.Optional[discord.Member] = None,
+            before: int = None
+    ):
+        """ View the ghost pings of the guild or of a member, newest first
+"""
+        rows = await self.bot.connection.history(
+            ctx.guild.id, None if member is None else member.id,
+            before, PAGE_SIZE
+        )
+        title = f"Ghost Pings in {ctx.guild.name}"
+        if member is not None:
+            title = f"Ghost Pings by {member.display_name}"
+        embed = discord.Embed(title=title, color=0xff0000)
+        if not rows:
+            embed.description = "No more ghost pings recorded"
+        for row in rows:
+            channel = self.bot.resolver.channel(ctx.guild, row["ChannelID"])
+            created = datetime.datetime.utcfromtimestamp(row["created"])
+            embed.add_field(
+                name=f"#{row['ID']} {row['author']}",
+                value=(
+                    f"Channel: {channel.name if channel else 'Unknown'}\n"
+                    f"Sent At: {created.strftime('%D %T')}\n"
+                    f"Members: {row['members']} | Roles: {row['roles']} | "
+                    f"Everyone: {row['everyone']}\n"
+                    f"Message: {row['content'][:CONTENT_LIMIT] or '(empty)'}"
+                ),
+                inline=False
+            )
+        if len(rows) == PAGE_SIZE:
+            target = "" if member is None else f"{member.id} "
+            embed.set_footer(
+                text=f"Next page: {ctx.prefix}history {target}"
+                     f"{rows[-1]['ID']}"
+            )
+        await ctx.channel.send(embed=fit(embed))
+
+    @commands.command(
+        name="leaderboard", pass_context=True, aliases=["ghoststats", "top"]
+    )
+    @commands.guild_only()
+    @commands.has_permissions(manage_messages=True)
+    async def leaderboard(self, ctx, days: int = 7):
+        """ View the top ghost pingers, channels, and daily totals of the
+            guild over the last days
+"""
+        days = max(1, min(days, MAX_DAYS))
+        today = int(time.time() // 86400)
+        stats = await self.bot.connection.guild_stats(
+            ctx.guild.id, today - days + 1
+        )
+        daily = stats["daily"]
+        embed = discord.Embed(
+            title=f"Ghost Pings in {ctx.guild.name}",
+            description=f"Last {days} day{'s' if days != 1 else ''}",
+            color=0xff0000
+        )
+        embed.add_field(
+            name="Total",
+            value=(
+                f"Ghost Pings: {sum(d['pings'] for d in daily)}\n"
+                f"Members Mentioned: {sum(d['members'] for d in daily)}\n"
+                f"Roles Mentioned: {sum(d['roles'] for d in daily)}\n"
+                f"Everyone Mentioned: {sum(d['everyone'] for d in daily)}"
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name="Top Ghost Pingers",
+            value="\n".join(
+                f"{i}. {a['author']}: {a['pings']}"
+                for i, a in enumerate(stats["authors"], start=1)
+            ) or "None",
+        )
+        channels = []
+        for i, c in enumerate(stats["channels"], start=1):
+            channel = self.bot.resolver.channel(ctx.guild, c["ChannelID"])
+            name = channel.name if channel else "Unknown"
+            channels.append(f"{i}. {name}: {c['pings']}")
+        embed.add_field(
+            name="Top Channels", value="\n".join(channels) or "None"
+        )
+        embed.add_field(
+            name="Daily",
+            value="\n".join(
+                f"{datetime.date.fromordinal(EPOCH_ORDINAL + d['day'])}: "
+                f"{d['pings']}"
+                for d in daily[:DAILY_ROWS]
+            ) or "None",
+            inline=False
+        )
+        await ctx.channel.send(embed=fit(embed))
+
+
+def setup(bot):
+    """ Allow lib.bot.__init__.py to add Audit cog as an extension
+"""
+    bot.add_cog(Audit(bot))
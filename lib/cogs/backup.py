@@ -0,0 +1,138 @@
+#! python3
+# backup.py
+
+"""
+Backup discord.exts.Cogs Cog
+- Allow the bot owner to export the preferences of every guild as JSON
+  Lines or CSV, and to import them again to migrate or restore them
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+
+import discord
+from discord.ext import commands
+
+from lib.db import transfer
+
+EXPORT_DIRECTORY = os.path.join("data", "db", "exports")
+# Discord rejects attachments larger than 8 MiB
+MAX_ATTACHMENT = 8 * 1024 * 1024
+
+
+class Backup(commands.Cog):
+    """ Export and import the preferences of every guild
+"""
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.command(name="export", pass_context=True)
+    @commands.is_owner()
+    async def export_preferences(self, ctx, fmt="jsonl"):
+        """ Export guild preferences to data/db/exports as jsonl or csv
+"""
+        fmt = fmt.lower()
+        if fmt not in transfer.FORMATS:
+            await ctx.channel.send(
+                f"Format must be one of: {', '.join(transfer.FORMATS)}"
+            )
+            return
+        os.makedirs(EXPORT_DIRECTORY, exist_ok=True)
+        path = os.path.join(
+            EXPORT_DIRECTORY,
+            f"preferences-{time.strftime('%Y%m%d-%H%M%S')}.{fmt}"
+        )
+        start = time.perf_counter()
+        count = await self.bot.connection.export_preferences(path, fmt)
+        elapsed = time.perf_counter() - start
+        logging.info("Exported %d guild preferences to %s", count, path)
+        content = (
+            f"Exported {count} guild preferences to `{path}` "
+            f"in {elapsed:.2f} s"
+        )
+        if os.path.getsize(path) <= MAX_ATTACHMENT:
+            await ctx.channel.send(content, file=discord.File(path))
+        else:
+            await ctx.channel.send(content)
+
+    @commands.command(name="import", pass_context=True)
+    @commands.is_owner()
+    async def import_preferences(self, ctx, path=None):
+        """ Import guild preferences from an attached file or a path on the
+            bot's host, overwriting the preferences of the guilds it lists
+            Refused when running as clusters, since the other clusters would
+            keep serving their cached preferences
+"""
+        if self.bot.shard_ids is not None:
+            await ctx.channel.send(
+                "Import is disabled when running as clusters, import with "
+                "a single process and then restart the clusters"
+            )
+            return
+        if ctx.message.attachments:
+            attachment = ctx.message.attachments[0]
+            try:
+                fmt = transfer.detect_format(attachment.filename)
+            except ValueError as error:
+                await ctx.channel.send(str(error))
+                return
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, attachment.filename)
+                await attachment.save(path)
+                await self.load(ctx, path, fmt)
+        elif path is not None:
+            try:
+                fmt = transfer.detect_format(path)
+            except ValueError as error:
+                await ctx.channel.send(str(error))
+                return
+            await self.load(ctx, path, fmt)
+        else:
+            await ctx.channel.send("Attach a .jsonl or .csv file to import")
+
+    async def load(self, ctx, path, fmt):
+        """ Import preferences from path and report the result
+"""
+        start = time.perf_counter()
+        try:
+            count = await self.bot.connection.import_preferences(path, fmt)
+        except (OSError, ValueError, sqlite3.Error) as error:
+            await ctx.channel.send(f"Import failed, nothing changed: {error}")
+            return
+        elapsed = time.perf_counter() - start
+        # Imported rows overwrite preferences which may be cached
+        self.bot.preferences.clear()
+        logging.info("Imported %d guild preferences from %s", count, path)
+        await ctx.channel.send(
+            f"Imported {count} guild preferences in {elapsed:.2f} s"
+        )
+
+
+def setup(bot):
+    """ Allow lib.bot.__init__.py to add Backup cog as an extension
+"""
+    bot.add_cog(Backup(bot))
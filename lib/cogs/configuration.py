@@ -27,12 +27,53 @@ SOFTWARE.
 ===============================================================================
 """
 import asyncio
-import json
 import os
 
 import discord
 from discord.ext import commands
 
+from lib.bot import raid
+from lib.bot.prompts import PromptBusy
+from lib.bot.templates import EmbedTemplate, fit
+
+CONFIGURE_MENTION = EmbedTemplate("Configure `{setting}`", [
+    ("Current Configuration", "`{setting}`={current}"),
+    ("Configure Setting", "ON/OFF")
+])
+CONFIGURE_CHANNEL = EmbedTemplate("Configure `channel`", [
+    ("Current Configuration", "`channel`={channel}"),
+    ("Configure Setting", "Mention a channel")
+])
+CONFIRM_DEFAULTS = EmbedTemplate(
+    ":x: Set Guild Preferences to Default :x:",
+    description="Are you sure you want to revert bot preferences to defaults?",
+    footer="(y/n)"
+)
+DEFAULTS_REVERTED = EmbedTemplate("Bot Preferences Reverted to Default")
+CONFIGURE_THRESHOLD = EmbedTemplate("Configure `{setting}`", [
+    ("Current Configuration", "`{setting}`={current}"),
+    ("Configure Setting", (
+        "Ghost pings within {window} seconds which start raid mode, "
+        "from 0 (OFF) to {maximum}"
+    ))
+])
+RAID_SETTINGS = ("raid_threshold", "raid_author_threshold")
+MAX_RAID_THRESHOLD = 1000
+
+
+def threshold(text):
+    """ Return the raid threshold written in text, or None if invalid
+"""
+    if not text.isdecimal() or int(text) > MAX_RAID_THRESHOLD:
+        return None
+    return int(text)
+
+
+def administrator(message):
+    """ Return whether a prompt reply was sent by a guild administrator
+"""
+    return message.author.guild_permissions.administrator
+
 
 class Configuration(commands.Cog):
     """ Allow guild owners to configure bot preferences
@@ -40,32 +81,26 @@ class Configuration(commands.Cog):
     def __init__(self, bot):
         self.directory = os.path.join("data", "Configuration")
         self.bot = bot
-        with open(
-                os.path.join(self.directory, "join_message.txt")
-        ) as file:
-            self.guild_join_fields = json.load(file)
-        with open(
-                os.path.join(self.directory, "remove_message.txt")
-        ) as file:
-            self.guild_remove_fields = json.load(file)
-        with open(os.path.join(
-                self.directory, "configure.txt"
-        )) as file:
-            self.configure_fields = json.load(file)
+        self.join_template = EmbedTemplate.load(
+            os.path.join(self.directory, "join_message.txt"),
+            "Thank you for choosing the Anti-GhostPing bot!"
+        )
+        self.remove_template = EmbedTemplate.load(
+            os.path.join(self.directory, "remove_message.txt"),
+            "We are sorry to see you go!"
+        )
+        self.configure_template = EmbedTemplate.load(
+            os.path.join(self.directory, "configure.txt"),
+            "Bot Preference Configuration", footer="Type 'quit' to quit"
+        )
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
         """ Send message to owner when the bot is added to a guild
 """
         # Insert default values
-        query = """
-        INSERT INTO preferences (GuildID)
-        VALUES (?)
-        """
-        self.bot.connection.execute_query(
-            query, "w",
-            guild.id
-        )
+        await self.bot.connection.create_guild(guild.id)
+        self.bot.preferences.invalidate(guild.id)
         await self.join_message(guild)
 
     @commands.Cog.listener()
@@ -73,15 +108,8 @@ class Configuration(commands.Cog):
         """ Send message to owner when the bot is removed from a guild
 """
         # Delete guild table
-        query = """
-        DELETE
-        FROM preferences
-        WHERE GuildID=?
-        """.format(guild.id)
-        self.bot.connection.execute_query(
-            query, "w",
-            guild.id
-        )
+        await self.bot.connection.delete_guild(guild.id)
+        self.bot.preferences.invalidate(guild.id)
         await self.remove_message(guild)
 
     @commands.command(
@@ -89,16 +117,8 @@ class Configuration(commands.Cog):
     async def preferences(self, ctx):
         """ View bot preference settings
 """
-        # Get data from db preferences table
-        select_preferences_table = """
-        SELECT *
-        FROM preferences
-        WHERE GuildID=?"""
-        columns, prefs = self.bot.connection.execute_query(
-            select_preferences_table, "rr",
-            ctx.guild.id
-        )
-        preferences = dict(zip(columns, prefs[0]))
+        # Get data from the preferences cache
+        preferences = await self.bot.preferences.get(ctx.guild.id)
         # Send preferences data to channel
         embed = discord.Embed(
             title=f"Preferences for {ctx.guild.name}",
@@ -108,16 +128,23 @@ class Configuration(commands.Cog):
             if pref in ["everyone", "members", "roles"]:
                 sett = "ON" if preferences[pref] == 1 else "OFF"
             elif pref == "channel":
-                sett = discord.utils.get(
-                    ctx.guild.channels, id=preferences[pref]
+                sett = self.bot.resolver.channel(
+                    ctx.guild, preferences[pref]
+                )
+            elif pref in RAID_SETTINGS:
+                sett = (
+                    f"{preferences[pref]} per {raid.WINDOW} seconds"
+                    if preferences[pref] else "OFF"
                 )
             else:
                 sett = preferences[pref]
             embed.add_field(name=pref, value=sett)
-        await ctx.channel.send(embed=embed)
+        await ctx.channel.send(embed=fit(embed))
 
     @commands.command(
         name="configure", pass_context=True, aliases=["config", "c"])
+    @commands.guild_only()
+    @commands.has_permissions(administrator=True)
     async def configure(self, ctx, setting="", set_to=""):
         """ Configure bot preference settings
 """
@@ -125,7 +152,9 @@ class Configuration(commands.Cog):
                 setting.lower() in ["everyone", "members", "roles"]
                 and set_to.upper() in ["ON", "OFF"]
         ):
-            self.configure_mention(ctx, setting.lower(), set_to.upper())
+            await self.configure_mention(
+                ctx, setting.lower(), set_to.upper()
+            )
             await ctx.send(
                 f"`{setting.lower()}` configured to {set_to.upper()}"
             )
@@ -133,294 +162,230 @@ class Configuration(commands.Cog):
                 setting.lower() == "channel"
                 and ctx.message.channel_mentions
         ):
-            self.configure_channel(ctx, ctx.message.channel_mentions[0])
+            await self.configure_channel(
+                ctx, ctx.message.channel_mentions[0]
+            )
             await ctx.send(
                 f"`channel` configured to {set_to.upper()}"
             )
+        elif (
+                setting.lower() in RAID_SETTINGS
+                and threshold(set_to) is not None
+        ):
+            await self.configure_threshold(
+                ctx, setting.lower(), threshold(set_to)
+            )
+            await ctx.send(
+                f"`{setting.lower()}` configured to {threshold(set_to)}"
+            )
         else:
             await self.configuration_prompt(ctx)
 
     async def configuration_prompt(self, ctx):
         """ Send prompt with instructions for configuring bot preferences
 """
-        def check(mess):
-            return (
-                not mess.author.bot
-                and mess.author.guild_permissions.administrator
+        try:
+            session = self.bot.prompts.open(
+                ctx.guild.id, ctx.channel.id, ctx.author.id
             )
+        except PromptBusy:
+            await ctx.send(
+                "A configuration prompt is already open in this channel"
+            )
+            return
+        with session:
+            # List the possible settings guild owner can configure
+            message = await ctx.channel.send(
+                embed=self.configure_template.render()
+            )
+            while True:
+                try:
+                    msg = await session.wait(administrator)
+                except asyncio.TimeoutError:
+                    break
+                setting = msg.content.lower()
+                if setting in ["everyone", "roles", "members"]:
+                    await self.process_mention_config(ctx, session, setting)
+                    await msg.delete()
+                elif setting == "channel":
+                    await self.process_channel_config(ctx, session)
+                    await msg.delete()
+                elif setting in RAID_SETTINGS:
+                    await self.process_threshold_config(
+                        ctx, session, setting
+                    )
+                    await msg.delete()
+                elif setting == "defaults":
+                    await self.process_default_config(ctx, session)
+                    await msg.delete()
+                    break
+                else:
+                    await msg.delete()
+                    break
+            await message.delete()
 
-        # List the possible settings guild owner can configure
-        embed = discord.Embed(
-            title="Bot Preference Configuration",
-            color=0xff0000
-        )
-        for field in self.configure_fields:
-            embed.add_field(
-                name=field,
-                value=self.configure_fields[field])
-        embed.set_footer(text="Type 'quit' to quit")
-        message = await ctx.channel.send(embed=embed)
-        while True:
-            try:
-                msg = await self.bot.wait_for(
-                    "message",
-                    timeout=30.0,
-                    check=check)
-            except asyncio.TimeoutError:
-                break
-            setting = msg.content.lower()
-            if setting in ["everyone", "roles", "members"]:
-                await self.process_mention_config(ctx, setting)
-                await msg.delete()
-            elif setting == "channel":
-                await self.process_channel_config(ctx)
-                await msg.delete()
-            elif setting == "defaults":
-                await self.process_default_config(ctx)
-                await msg.delete()
-                break
-            else:
-                await msg.delete()
-                break
-        await message.delete()
-
-    async def process_mention_config(self, ctx, setting):
+    async def process_mention_config(self, ctx, session, setting):
         """ Send specific prompt for user to manage mention preferences
 """
         messages = {"ON": True, "OFF": False}
 
         def check(mess):
             return (
-                not mess.author.bot
-                and (mess.content.upper() in messages)
-                and mess.author.guild_permissions.administrator
+                mess.content.upper() in messages and administrator(mess)
             )
 
         # Get current preference setting
-        current_settings_query = """
-        SELECT *
-        FROM preferences
-        WHERE GuildID=?
-        """
-        columns, prefs = self.bot.connection.execute_query(
-            current_settings_query, "rr",
-            ctx.guild.id
-        )
-        current = "ON" if dict(zip(columns, prefs[0]))[setting] else "OFF"
+        preferences = await self.bot.preferences.get(ctx.guild.id)
+        current = "ON" if preferences[setting] else "OFF"
         # Send an embed with reactions for guild owner to use
-        embed = discord.Embed(
-            gtitle=f"Confiure `{setting}`",
-            color=0xff0000
-        )
-        fields = {
-            "Current Configuration": f"`{setting}`={current}",
-            "Configure Setting": "ON/OFF"
-        }
-        for field in fields:
-            embed.add_field(name=field, value=fields[field])
-        message = await ctx.channel.send(embed=embed)
+        message = await ctx.channel.send(embed=CONFIGURE_MENTION.render(
+            {"setting": setting, "current": current}
+        ))
         # Use guild owner input to configure setting in database
         try:
-            msg = await self.bot.wait_for(
-                "message",
-                timeout=30.0,
-                check=check)
+            msg = await session.wait(check)
         except asyncio.TimeoutError:
             await message.delete()
             return
         set_to = "ON" if messages[msg.content.upper()] else "OFF"
-        self.configure_mention(ctx, setting, set_to)
+        await self.configure_mention(ctx, setting, set_to)
         await message.edit(
             content=f"`{setting}` configured to {set_to}",
             embed=None
         )
         await msg.delete()
 
-    async def process_channel_config(self, ctx):
+    async def process_channel_config(self, ctx, session):
         """ Send specific prompt for user to manage channel preference
 """
         def check(mess):
-            return (
-                not mess.author.bot
-                and (len(mess.channel_mentions) == 1)
-                and mess.author.guild_permissions.administrator
-            )
+            return len(mess.channel_mentions) == 1 and administrator(mess)
 
         # Get current preference setting
-        current_settings = """
-        SELECT channel
-        FROM preferences
-        WHERE GuildID=?
-        """
-        columns, prefs = self.bot.connection.execute_query(
-            current_settings, "rr",
-            ctx.guild.id
-        )
-        current = dict(zip(columns, prefs[0]))["channel"]
+        preferences = await self.bot.preferences.get(ctx.guild.id)
+        current = preferences["channel"]
         try:
-            channel = discord.utils.get(
-                ctx.guild.channels, id=current
-            ).name
+            channel = self.bot.resolver.channel(ctx.guild, current).name
         except AttributeError:
             channel = "NOT SET"
-        # Send an embed with configuratio instructions
-        embed = discord.Embed(
-            title="Configure `channel`",
-            color=0xff0000
-        )
-        fields = {
-            "Current Configuration": f"`channel`={channel}",
-            "Configure Setting": "Mention a channel"
-        }
-        for field in fields:
-            embed.add_field(name=field, value=fields[field])
-        message = await ctx.channel.send(embed=embed)
+        # Send an embed with configuration instructions
+        message = await ctx.channel.send(embed=CONFIGURE_CHANNEL.render(
+            {"channel": channel}
+        ))
         # User guild owner input to configure setting in database
         try:
-            msg = await self.bot.wait_for(
-                "message",
-                timeout=30.0,
-                check=check
-            )
+            msg = await session.wait(check)
         except asyncio.TimeoutError:
             await message.delete()
             return
         set_to = msg.channel_mentions[0]
-        self.configure_channel(ctx, set_to)
+        await self.configure_channel(ctx, set_to)
         await message.edit(
             content=f"`channel` configured to {set_to}",
             embed=None
         )
         await msg.delete()
 
-    async def process_default_config(self, ctx):
-        """ Confirm that user desires to revert bot preferences to defaults
+    async def process_threshold_config(self, ctx, session, setting):
+        """ Send specific prompt for user to manage a raid threshold
 """
         def check(mess):
-            return (
-                not mess.author.bot
-                and mess.author.guild_permissions.administrator
-            )
+            return threshold(mess.content) is not None and administrator(mess)
 
-        desc = "Are you sure you want to revert bot preferences to defaults?"
-        embed = discord.Embed(
-            title=":x: Set Guild Preferences to Default :x:",
-            description=desc,
-            footer_text="(y/n)",
-            color=0xff0000
+        # Get current preference setting
+        preferences = await self.bot.preferences.get(ctx.guild.id)
+        # Send an embed with configuration instructions
+        message = await ctx.channel.send(embed=CONFIGURE_THRESHOLD.render({
+            "setting": setting, "current": preferences[setting],
+            "window": raid.WINDOW, "maximum": MAX_RAID_THRESHOLD
+        }))
+        # Use guild owner input to configure setting in database
+        try:
+            msg = await session.wait(check)
+        except asyncio.TimeoutError:
+            await message.delete()
+            return
+        set_to = threshold(msg.content)
+        await self.configure_threshold(ctx, setting, set_to)
+        await message.edit(
+            content=f"`{setting}` configured to {set_to}",
+            embed=None
         )
-        message = await ctx.channel.send(embed=embed)
+        await msg.delete()
+
+    async def process_default_config(self, ctx, session):
+        """ Confirm that user desires to revert bot preferences to defaults
+"""
+        message = await ctx.channel.send(embed=CONFIRM_DEFAULTS.render())
         try:
-            msg = await self.bot.wait_for(
-                "message",
-                timeout=30.0,
-                check=check
-            )
+            msg = await session.wait(administrator)
         except asyncio.TimeoutError:
             await message.delete()
             return
         if msg.content.lower().startswith('y'):
-            self.default_preferences(ctx)
-            embed = discord.Embed(
-                title="Bot Preferences Reverted to Default",
-                color=0xff0000
-            )
-            await message.edit(
-                embed=embed
-            )
+            await self.default_preferences(ctx)
+            await message.edit(embed=DEFAULTS_REVERTED.render())
         await msg.delete()
 
-    def configure_mention(self, ctx, setting, set_to):
+    async def configure_mention(self, ctx, setting, set_to):
         """ Update database to match new guild mention preferences
 """
-        if setting == "everyone":
-            new_setting_query = """
-            UPDATE preferences
-            SET everyone=?
-            WHERE GuildID=?
-            """
-        elif setting == "roles":
-            new_setting_query = """
-            UPDATE preferences
-            SET roles=?
-            WHERE GuildID=?
-            """
-        elif setting == "members":
-            new_setting_query = """
-            UPDATE preferences
-            SET members=?
-            WHERE GuildID=?
-            """
-        else:
+        if setting not in ["everyone", "roles", "members"]:
             return
         set_to = 1 if set_to == "ON" else 0
-        self.bot.connection.execute_query(
-            new_setting_query, "w",
-            set_to, ctx.guild.id
+        await self.bot.connection.set_preference(
+            ctx.guild.id, setting, set_to
         )
+        self.bot.preferences.update(ctx.guild.id, **{setting: set_to})
 
-    def configure_channel(self, ctx, channel):
+    async def configure_channel(self, ctx, channel):
         """ Update database to match new guild channel preference
 """
-        new_setting_query = """
-        UPDATE preferences
-        SET channel=?
-        WHERE GuildID=?
-        """
-        self.bot.connection.execute_query(
-            new_setting_query, "w",
-            channel.id, ctx.guild.id
+        await self.bot.connection.set_preference(
+            ctx.guild.id, "channel", channel.id
         )
+        self.bot.preferences.update(ctx.guild.id, channel=channel.id)
 
-    def default_preferences(self, ctx):
-        """ Set guild bot preferences to default settings
+    async def configure_threshold(self, ctx, setting, set_to):
+        """ Update database to match a new guild raid threshold
 """
-        delete_guild_query = """
-        DELETE FROM preferences
-        """
-        self.bot.connection.execute_query(
-            delete_guild_query, "w"
+        await self.bot.connection.set_preference(
+            ctx.guild.id, setting, set_to
         )
-        create_guild_query = """
-        INSERT INTO preferences (GuildID)
-        VALUES (?)
-        """
-        self.bot.connection.execute_query(
-            create_guild_query, "w",
-            ctx.guild.id
+        self.bot.preferences.update(ctx.guild.id, **{setting: set_to})
+
+    async def default_preferences(self, ctx):
+        """ Set guild bot preferences to default settings
+"""
+        await self.bot.connection.reset_guild(ctx.guild.id)
+        self.bot.preferences.invalidate(ctx.guild.id)
+
+    async def owner(self, guild):
+        """ Return the owner of the guild, fetching the user when the owner
+            is not in the member cache
+"""
+        if guild.owner is not None:
+            return guild.owner
+        return (
+            self.bot.get_user(guild.owner_id)
+            or await self.bot.fetch_user(guild.owner_id)
         )
 
     async def join_message(self, guild):
         """ Send embed in direct message channel to guild owner
 """
-        direct_message = await guild.owner.create_dm()
-        embed = discord.Embed(
-            title="Thank you for choosing the Anti-GhostPing bot!",
-            color=0xff0000
-        )
-        fields = self.guild_join_fields
-        fields["Added to Guild"] = fields["Added to Guild"].format(
-            guild.name, guild.id
-        )
-        for field in fields:
-            embed.add_field(name=field, value=fields[field])
-        await direct_message.send(embed=embed)
+        direct_message = await (await self.owner(guild)).create_dm()
+        await direct_message.send(embed=self.join_template.render(
+            {"name": guild.name, "id": guild.id}
+        ))
 
     async def remove_message(self, guild):
         """ Send embed in direct message channel to guild owner
 """
-        direct_message = await guild.owner.create_dm()
-        embed = discord.Embed(
-            title="We are sorry to see you go!",
-            color=0xff0000
-        )
-        fields = self.guild_remove_fields
-        fields["Removed from Guild"] = fields["Removed from Guild"].format(
-            guild.name, guild.id
-        )
-        for field in fields:
-            embed.add_field(name=field, value=fields[field])
-        await direct_message.send(embed=embed)
+        direct_message = await (await self.owner(guild)).create_dm()
+        await direct_message.send(embed=self.remove_template.render(
+            {"name": guild.name, "id": guild.id}
+        ))
 
 
 def setup(bot):
@@ -0,0 +1,138 @@
+#! python3
+# monitoring.py
+
+"""
+Monitoring discord.exts.commands.Cog Cog
+- Allow the bot owner to view runtime metrics of the bot
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import discord
+from discord.ext import commands
+
+from lib.bot.metrics import resident_memory
+from lib.bot.templates import fit
+
+
+def milliseconds(seconds):
+    """ Format a duration in seconds as milliseconds
+"""
+    return f"{seconds * 1000:.2f} ms"
+
+
+def mebibytes(size):
+    """ Format a size in bytes as MiB
+"""
+    return "unknown" if size is None else f"{size / 2 ** 20:.1f} MiB"
+
+
+def summarize(histogram):
+    """ Summarize each child of a histogram as count, mean, p50 and p99
+"""
+    lines = []
+    for values, child in histogram.children():
+        if not child.count:
+            continue
+        name = ", ".join(values) or "all"
+        lines.append(
+            f"`{name}`: {child.count} | "
+            f"mean {milliseconds(child.sum / child.count)} | "
+            f"p50 ≤{milliseconds(child.quantile(0.5))} | "
+            f"p99 ≤{milliseconds(child.quantile(0.99))}"
+        )
+    return "\n".join(lines) or "None"
+
+
+class Monitoring(commands.Cog):
+    """ Report runtime metrics to the bot owner
+"""
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.command(name="stats", pass_context=True)
+    @commands.is_owner()
+    async def stats(self, ctx):
+        """ View event, database, alert, cache, process and gateway metrics
+"""
+        metrics = self.bot.metrics
+        alerts = self.bot.alerts.stats()
+        raids = self.bot.raids.stats()
+        preferences = self.bot.preferences.stats()
+        store = self.bot.message_store.stats()
+        journal = "disabled"
+        if self.bot.journal is not None:
+            stats = self.bot.journal.stats()
+            journal = (
+                f"{stats['bytes'] // 1024} KiB, "
+                f"{stats['batches']} batches, "
+                f"{stats['compactions']} compactions"
+            )
+        fields = {
+            "Events": summarize(metrics.event_latency),
+            "Database Operations": summarize(metrics.query_latency),
+            "Alerts": (
+                f"Detections: {alerts['detections']}\n"
+                f"Messages sent: {alerts['calls']} "
+                f"({alerts['saved']} saved by coalescing)\n"
+                f"Rerouted: {alerts['rerouted']}, "
+                f"dropped: {alerts['dropped']}, "
+                f"channels skipped: {alerts['denied']}\n"
+                f"Send errors: {metrics.send_errors.total()}\n"
+                f"Send latency: {summarize(metrics.send_latency)}"
+            ),
+            "Raids": (
+                f"Active: {raids['active']}, started: {raids['started']}\n"
+                f"Ghost pings summarized: {raids['summarized']} "
+                f"({raids['edits']} summary edits)"
+            ),
+            "Caches": (
+                f"Message cache: {len(self.bot.cached_messages)} messages\n"
+                f"Mention store: {store['records']} records, "
+                f"{store['bytes'] // 1024} KiB\n"
+                f"Mention journal: {journal}\n"
+                f"Preferences: {preferences['size']} guilds, "
+                f"{preferences['hits']} hits, "
+                f"{preferences['misses']} misses"
+            ),
+            "Process": (
+                f"Ready in {self.bot.ready_seconds or 0:.2f} s "
+                f"({self.bot.member_mode} members)\n"
+                f"Cached members: "
+                f"{sum(len(g.members) for g in self.bot.guilds)}\n"
+                f"Resident memory: {mebibytes(resident_memory())}"
+            ),
+            "Gateway Latency": "\n".join(
+                f"Shard {s}: {milliseconds(l)}"
+                for s, l in self.bot.latencies
+            ) or "None",
+        }
+        embed = discord.Embed(title="Bot Statistics", color=0xff0000)
+        for field in fields:
+            embed.add_field(name=field, value=fields[field], inline=False)
+        await ctx.channel.send(embed=fit(embed))
+
+
+def setup(bot):
+    """ Allow lib.bot.__init__.py to add Monitoring cog as an extension
+"""
+    bot.add_cog(Monitoring(bot))
@@ -0,0 +1,82 @@
+#! python3
+# profiling.py
+
+"""
+Profiling discord.exts.commands.Cog Cog
+- Allow the bot owner to profile the running bot without restarting it
+- Sends the hottest functions and allocation sites as an attachment
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import io
+import logging
+
+import discord
+from discord.ext import commands
+
+from lib.bot import profiler
+
+MAX_SECONDS = 300
+
+
+class Profiling(commands.Cog):
+    """ Profile the event loop of the running bot on demand
+"""
+    def __init__(self, bot):
+        self.bot = bot
+        self.profiler = profiler.Profiler()
+
+    @commands.command(name="profile", pass_context=True)
+    @commands.is_owner()
+    async def profile(self, ctx, seconds: int = 30, mode="cprofile"):
+        """ Profile the bot for seconds with cprofile or sample mode
+"""
+        mode = mode.lower()
+        if mode not in profiler.MODES:
+            await ctx.channel.send(
+                f"Mode must be one of: {', '.join(profiler.MODES)}"
+            )
+            return
+        if not 0 < seconds <= MAX_SECONDS:
+            await ctx.channel.send(
+                f"Seconds must be between 1 and {MAX_SECONDS}"
+            )
+            return
+        if self.profiler.running:
+            await ctx.channel.send("A profiling session is already running")
+            return
+        await ctx.channel.send(f"Profiling for {seconds} s ({mode})...")
+        logging.info("Profiling for %d s (%s)", seconds, mode)
+        report = await self.profiler.profile(seconds, mode)
+        await ctx.channel.send(
+            "Profiling complete",
+            file=discord.File(
+                io.BytesIO(report.encode()), filename=f"profile-{mode}.txt"
+            )
+        )
+
+
+def setup(bot):
+    """ Allow lib.bot.__init__.py to add Profiling cog as an extension
+"""
+    bot.add_cog(Profiling(bot))
@@ -2,7 +2,9 @@
 # db/__init__.py
 
 """
-Initialize SQLite database in data/db
+Storage of guild preferences and ghost pings in data/db
+- Importing the package has no side effects; BotRoot opens the database
+  and applies lib.db.migrations when it starts
 ===============================================================================
 Copyright (c) 2021 Jacob Lee
 
@@ -25,17 +27,3 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 ===============================================================================
 """
-
-from . import db
-
-
-PREFERENCES_QUERY = """CREATE TABLE IF NOT EXISTS preferences (
-    GuildID integer PRIMARY KEY,
-    everyone integer DEFAULT 1,
-    roles integer DEFAULT 1,
-    members integer DEFAULT 0,
-    channel integer DEFAULT 0
-);"""
-
-CONNECTION = db.DBConnection()
-CONNECTION.execute_query(PREFERENCES_QUERY, "w")
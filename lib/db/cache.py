@@ -0,0 +1,109 @@
+#! python3
+# cache.py
+
+"""
+Caches guild preferences from data/db in memory
+- Bounded in size with least-recently-used eviction
+- Configuration writes through to the cache so reads never go stale
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import collections
+
+
+class PreferencesCache:
+    """ Least-recently-used cache of guild preferences keyed by GuildID
+"""
+    def __init__(self, connection, maxsize=65536):
+        self.connection = connection
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._preferences = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._preferences)
+
+    def __contains__(self, guild_id):
+        return guild_id in self._preferences
+
+    async def get(self, guild_id):
+        """ Return the preferences of a guild, reading the database on a miss
+            Returns None if the guild has no preferences row
+"""
+        try:
+            preferences = self._preferences[guild_id]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._preferences.move_to_end(guild_id)
+            return preferences
+        preferences = await self.load(guild_id)
+        if preferences is not None:
+            self.put(guild_id, preferences)
+        return preferences
+
+    async def load(self, guild_id):
+        """ Read the preferences of a guild from the database
+"""
+        return await self.connection.get_preferences(guild_id)
+
+    def put(self, guild_id, preferences):
+        """ Store the preferences of a guild, evicting the oldest if full
+"""
+        self._preferences[guild_id] = preferences
+        self._preferences.move_to_end(guild_id)
+        while len(self._preferences) > self.maxsize:
+            self._preferences.popitem(last=False)
+
+    def warm(self, preferences):
+        """ Store the preferences of many guilds, up to the size of the cache
+"""
+        for prefs in preferences[-self.maxsize:]:
+            self.put(prefs["GuildID"], prefs)
+
+    def update(self, guild_id, **settings):
+        """ Write changed settings through to a cached guild
+"""
+        preferences = self._preferences.get(guild_id)
+        if preferences is not None:
+            preferences.update(settings)
+
+    def invalidate(self, guild_id):
+        """ Drop a guild from the cache
+"""
+        self._preferences.pop(guild_id, None)
+
+    def clear(self):
+        """ Drop every guild from the cache
+"""
+        self._preferences.clear()
+
+    def stats(self):
+        """ Return the hit and miss counters of the cache
+"""
+        return {
+            "hits": self.hits, "misses": self.misses,
+            "size": len(self._preferences), "maxsize": self.maxsize
+        }
@@ -26,17 +26,241 @@ SOFTWARE.
 ===============================================================================
 """
 
+import abc
+import asyncio
+import concurrent.futures
+import contextlib
+import itertools
 import os
 import sqlite3
+import time
 
+from . import migrations, transfer
 
-class DBConnection:
+DATABASE_PATH = os.path.join('data', 'db', 'db.sqlite')
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8192",
+    "PRAGMA foreign_keys=ON",
+)
+
+# Settings which may be changed with DBConnection.set_preference
+PREFERENCE_COLUMNS = (
+    "everyone", "roles", "members", "channel", "raid_threshold",
+    "raid_author_threshold"
+)
+
+SELECT_PREFERENCES = """
+SELECT *
+FROM preferences
+WHERE GuildID=?"""
+INSERT_PREFERENCES = """
+INSERT OR IGNORE INTO preferences (GuildID)
+VALUES (?)"""
+DELETE_PREFERENCES = """
+DELETE
+FROM preferences
+WHERE GuildID=?"""
+RESET_PREFERENCES = """
+INSERT OR REPLACE INTO preferences (GuildID)
+VALUES (?)"""
+UPSERT_PREFERENCES = """
+INSERT INTO preferences (
+    GuildID, everyone, roles, members, channel, raid_threshold,
+    raid_author_threshold
+)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (GuildID) DO UPDATE SET
+    everyone=excluded.everyone, roles=excluded.roles,
+    members=excluded.members, channel=excluded.channel,
+    raid_threshold=excluded.raid_threshold,
+    raid_author_threshold=excluded.raid_author_threshold"""
+SELECT_PREFERENCE_ROWS = """
+SELECT GuildID, everyone, roles, members, channel, raid_threshold,
+    raid_author_threshold
+FROM preferences
+ORDER BY GuildID"""
+SELECT_GUILD_IDS = """
+SELECT GuildID
+FROM preferences"""
+SELECT_ALL_PREFERENCES = """
+SELECT *
+FROM preferences"""
+INSERT_GHOSTPING = """
+INSERT INTO ghostpings (
+    GuildID, ChannelID, AuthorID, MessageID, author, content,
+    members, roles, everyone, created, detected
+)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+SELECT_GUILD_HISTORY = """
+SELECT *
+FROM ghostpings
+WHERE GuildID=? AND ID<?
+ORDER BY ID DESC
+LIMIT ?"""
+SELECT_AUTHOR_HISTORY = """
+SELECT *
+FROM ghostpings
+WHERE GuildID=? AND AuthorID=? AND ID<?
+ORDER BY ID DESC
+LIMIT ?"""
+UPSERT_DAILY_STATS = """
+INSERT INTO daily_stats (GuildID, day, pings, members, roles, everyone)
+VALUES (?, ?, 1, ?, ?, ?)
+ON CONFLICT (GuildID, day) DO UPDATE
+SET pings=pings + 1,
+    members=members + excluded.members,
+    roles=roles + excluded.roles,
+    everyone=everyone + excluded.everyone"""
+UPSERT_AUTHOR_STATS = """
+INSERT INTO author_stats (GuildID, day, AuthorID, author, pings)
+VALUES (?, ?, ?, ?, 1)
+ON CONFLICT (GuildID, day, AuthorID) DO UPDATE
+SET pings=pings + 1, author=excluded.author"""
+UPSERT_CHANNEL_STATS = """
+INSERT INTO channel_stats (GuildID, day, ChannelID, pings)
+VALUES (?, ?, ?, 1)
+ON CONFLICT (GuildID, day, ChannelID) DO UPDATE
+SET pings=pings + 1"""
+SELECT_DAILY_STATS = """
+SELECT *
+FROM daily_stats
+WHERE GuildID=? AND day>=?
+ORDER BY day DESC"""
+# With a single max() aggregate SQLite reads bare columns from the row holding
+# the maximum, so author is the name from the newest day
+SELECT_TOP_AUTHORS = """
+SELECT AuthorID, author, max(day) AS last_day, sum(pings) AS pings
+FROM author_stats
+WHERE GuildID=? AND day>=?
+GROUP BY AuthorID
+ORDER BY pings DESC
+LIMIT ?"""
+SELECT_TOP_CHANNELS = """
+SELECT ChannelID, sum(pings) AS pings
+FROM channel_stats
+WHERE GuildID=? AND day>=?
+GROUP BY ChannelID
+ORDER BY pings DESC
+LIMIT ?"""
+# Cursor which is greater than every ghostpings ID
+FIRST_PAGE = 2 ** 63 - 1
+# Rows fetched or written per call when streaming the preferences table
+CHUNK_SIZE = 10000
+# Methods which write-behind batches may run, see write_batch
+# The first column of their rows must be GuildID, which partitioned storage
+# routes rows by
+WRITE_OPERATIONS = ("insert_ghostpings",)
+UPDATE_PREFERENCE = {
+    column: f"""
+UPDATE preferences
+SET {column}=?
+WHERE GuildID=?"""
+    for column in PREFERENCE_COLUMNS
+}
+
+
+class Storage(abc.ABC):
+    """ Interface of the storage backends AsyncDBConnection runs, see
+        lib.db.storage for the backends besides DBConnection
+        Methods run on one thread, so backends need no locking
+"""
+    @abc.abstractmethod
+    def close_connection(self):
+        """ Release the files or connections of the backend
+"""
+
+    @abc.abstractmethod
+    def migrate(self):
+        """ Bring the schema up to date and return the versions before and
+            after
+"""
+
+    @abc.abstractmethod
+    def transaction(self):
+        """ Return a context manager grouping writes into one transaction
+"""
+
+    @abc.abstractmethod
+    def write_batch(self, batch):
+        """ Run (operation, rows) pairs of a write-behind batch, where every
+            operation is one of WRITE_OPERATIONS
+"""
+
+    @abc.abstractmethod
+    def insert_ghostpings(self, rows):
+        """ Insert ghost pings and count them in the rollups
+"""
+
+    @abc.abstractmethod
+    def history(self, guild_id, author_id=None, before=None, limit=10):
+        """ Return a page of the ghost pings of a guild, newest first
+"""
+
+    @abc.abstractmethod
+    def guild_stats(self, guild_id, since, limit=10):
+        """ Return the ghost ping rollups of a guild since a day
+"""
+
+    @abc.abstractmethod
+    def get_preferences(self, guild_id):
+        """ Return the preferences of a guild as a dict, or None
+"""
+
+    @abc.abstractmethod
+    def set_preference(self, guild_id, key, value):
+        """ Change one preference setting of a guild
+"""
+
+    @abc.abstractmethod
+    def create_guild(self, guild_id):
+        """ Insert default preferences for a guild if it has none
+"""
+
+    @abc.abstractmethod
+    def delete_guild(self, guild_id):
+        """ Delete the preferences of a guild
+"""
+
+    @abc.abstractmethod
+    def reset_guild(self, guild_id):
+        """ Replace the preferences of a guild with the defaults
+"""
+
+    @abc.abstractmethod
+    def iter_preferences(self, chunk_size=CHUNK_SIZE):
+        """ Yield every preferences row as a tuple, ordered by GuildID
+"""
+
+    @abc.abstractmethod
+    def import_preferences(self, rows, chunk_size=CHUNK_SIZE):
+        """ Insert or overwrite preferences from rows and return how many
+"""
+
+    @abc.abstractmethod
+    def reconcile_guilds(self, guild_ids, owns=None):
+        """ Match the preferences to the guilds the bot is in
+"""
+
+
+class DBConnection(Storage):
     """ Connect to data/db/db.sqlite
+        Rows are sqlite3.Row objects which can be indexed by column name
+        Writes commit immediately unless made inside transaction()
 """
-    def __init__(self):
+    def __init__(self, path=DATABASE_PATH):
+        # Clustered bots share the database file between processes, so wait
+        # on locks instead of failing and let readers run beside the writer
+        # Transactions are managed explicitly, see transaction()
         self.connection = sqlite3.connect(
-            os.path.join('data', 'db', 'db.sqlite')
+            path, timeout=30, isolation_level=None, cached_statements=256
         )
+        self.connection.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            self.connection.execute(pragma)
         self.cursor = self.connection.cursor()
 
     def close_connection(self):
@@ -44,13 +268,35 @@ class DBConnection:
 """
         self.connection.close()
 
+    def migrate(self):
+        """ Apply pending schema migrations and return the versions before
+            and after
+"""
+        return migrations.migrate(self)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Run every query inside the block in one transaction
+            The transaction rolls back if the block raises
+            Nested blocks join the outermost transaction
+"""
+        if self.connection.in_transaction:
+            yield self
+            return
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+        except BaseException:
+            self.connection.rollback()
+            raise
+        self.connection.commit()
+
     def execute_query(self, query, mode, *args):
         """ Pass the given query to the cursor under the determined mode
 """
         mode = mode.lower()
         if mode == "w":
             self.cursor.execute(query, tuple(args))
-            self.connection.commit()
             values = []
         elif mode == "r":
             self.cursor.execute(query, tuple(args))
@@ -64,3 +310,288 @@ class DBConnection:
         else:
             values = []
         return values
+
+    def execute_many(self, query, rows):
+        """ Execute a write query once for every row of parameters
+            All rows are written in a single transaction
+"""
+        with self.transaction():
+            self.cursor.executemany(query, rows)
+        return self.cursor.rowcount
+
+    def write_batch(self, batch):
+        """ Run (operation, rows) pairs of a write-behind batch in a single
+            transaction
+            operation names one of the WRITE_OPERATIONS methods
+"""
+        with self.transaction():
+            for operation, rows in batch:
+                if operation not in WRITE_OPERATIONS:
+                    raise ValueError(f"Unknown write operation: {operation}")
+                getattr(self, operation)(rows)
+
+    def insert_ghostpings(self, rows):
+        """ Insert ghost pings and count them in the daily, author, and
+            channel rollups of the UTC day they were detected
+            Rows are in the column order of INSERT_GHOSTPING
+"""
+        with self.transaction():
+            self.cursor.executemany(INSERT_GHOSTPING, rows)
+            days = [int(r[10] // 86400) for r in rows]
+            self.cursor.executemany(UPSERT_DAILY_STATS, (
+                (r[0], day, r[6], r[7], r[8]) for r, day in zip(rows, days)
+            ))
+            self.cursor.executemany(UPSERT_AUTHOR_STATS, (
+                (r[0], day, r[2], r[4]) for r, day in zip(rows, days)
+            ))
+            self.cursor.executemany(UPSERT_CHANNEL_STATS, (
+                (r[0], day, r[1]) for r, day in zip(rows, days)
+            ))
+
+    def history(self, guild_id, author_id=None, before=None, limit=10):
+        """ Return up to limit ghost pings of a guild as dicts, newest first
+            Only ghost pings with an ID below before are returned, so the
+            ID of the last row is the cursor of the next page
+"""
+        before = FIRST_PAGE if before is None else before
+        if author_id is None:
+            rows = self.connection.execute(
+                SELECT_GUILD_HISTORY, (guild_id, before, limit)
+            )
+        else:
+            rows = self.connection.execute(
+                SELECT_AUTHOR_HISTORY, (guild_id, author_id, before, limit)
+            )
+        return [dict(r) for r in rows]
+
+    def guild_stats(self, guild_id, since, limit=10):
+        """ Return the daily totals, top authors, and top channels of a
+            guild from day since onwards, read from the rollup tables
+"""
+        return {
+            "daily": [
+                dict(r) for r in self.connection.execute(
+                    SELECT_DAILY_STATS, (guild_id, since)
+                )
+            ],
+            "authors": [
+                dict(r) for r in self.connection.execute(
+                    SELECT_TOP_AUTHORS, (guild_id, since, limit)
+                )
+            ],
+            "channels": [
+                dict(r) for r in self.connection.execute(
+                    SELECT_TOP_CHANNELS, (guild_id, since, limit)
+                )
+            ],
+        }
+
+    def get_preferences(self, guild_id):
+        """ Return the preferences of a guild as a dict
+            Returns None if the guild has no preferences row
+"""
+        row = self.connection.execute(
+            SELECT_PREFERENCES, (guild_id,)
+        ).fetchone()
+        return None if row is None else dict(row)
+
+    def set_preference(self, guild_id, key, value):
+        """ Change one preference setting of a guild
+"""
+        try:
+            query = UPDATE_PREFERENCE[key]
+        except KeyError:
+            raise ValueError(f"Unknown preference: {key}") from None
+        self.connection.execute(query, (value, guild_id))
+
+    def create_guild(self, guild_id):
+        """ Insert default preferences for a guild if it has none
+"""
+        self.connection.execute(INSERT_PREFERENCES, (guild_id,))
+
+    def delete_guild(self, guild_id):
+        """ Delete the preferences of a guild
+"""
+        self.connection.execute(DELETE_PREFERENCES, (guild_id,))
+
+    def reset_guild(self, guild_id):
+        """ Replace the preferences of a guild with the defaults
+"""
+        self.connection.execute(RESET_PREFERENCES, (guild_id,))
+
+    def iter_preferences(self, chunk_size=CHUNK_SIZE):
+        """ Yield every preferences row as a (GuildID, everyone, roles,
+            members, channel, raid_threshold, raid_author_threshold) tuple,
+            fetching chunk_size rows at a time
+"""
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute(SELECT_PREFERENCE_ROWS)
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
+
+    def import_preferences(self, rows, chunk_size=CHUNK_SIZE):
+        """ Insert or overwrite preferences from (GuildID, everyone, roles,
+            members, channel, raid_threshold, raid_author_threshold) rows
+            in a single transaction
+            Rows are written chunk_size at a time, so rows may be a
+            generator streaming from a file
+            Returns the number of rows written
+"""
+        rows = iter(rows)
+        count = 0
+        with self.transaction():
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    break
+                self.cursor.executemany(UPSERT_PREFERENCES, chunk)
+                count += len(chunk)
+        return count
+
+    def reconcile_guilds(self, guild_ids, owns=None):
+        """ Match the preferences table to the guilds the bot is in
+            Creates default preferences for new guilds and deletes the
+            preferences of guilds the bot left, all in one transaction
+            owns(guild_id) limits deletion to guilds served by this process
+            Returns the number of guilds added and removed and the
+            preferences of every connected guild
+"""
+        connected = set(guild_ids)
+        with self.transaction():
+            self.cursor.executemany(
+                INSERT_PREFERENCES, ((i,) for i in connected)
+            )
+            added = self.cursor.rowcount
+            stale = [
+                (i,) for (i,) in self.connection.execute(SELECT_GUILD_IDS)
+                if i not in connected and (owns is None or owns(i))
+            ]
+            self.cursor.executemany(DELETE_PREFERENCES, stale)
+            preferences = [
+                dict(r)
+                for r in self.connection.execute(SELECT_ALL_PREFERENCES)
+                if r["GuildID"] in connected
+            ]
+        return added, len(stale), preferences
+
+
+class AsyncDBConnection:
+    """ Run DBConnection queries on a dedicated executor thread
+        The connection is created on and only used by that thread, so
+        database latency never blocks the event loop
+        factory(path) creates the connection, which may be any Storage
+        backend, see lib.db.storage
+        Only Storage methods are wrapped; raw SQL of DBConnection can be
+        run with run()
+        on_query(operation, seconds) is called with the duration of every
+        operation run on the executor thread
+"""
+    def __init__(self, path=DATABASE_PATH, on_query=None,
+                 factory=DBConnection):
+        self.on_query = on_query
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="db"
+        )
+        self.connection = self.executor.submit(factory, path).result()
+
+    def close_connection(self):
+        """ Close database connection and stop the executor thread
+"""
+        self.executor.submit(self.connection.close_connection).result()
+        self.executor.shutdown(wait=True)
+
+    async def run(self, function, *args, name=None):
+        """ Await function(*args) on the executor thread
+"""
+        def timed():
+            start = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                if self.on_query is not None:
+                    self.on_query(
+                        name or function.__name__,
+                        time.perf_counter() - start
+                    )
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, timed)
+
+    async def migrate(self):
+        """ Await DBConnection.migrate on the executor thread
+"""
+        return await self.run(self.connection.migrate)
+
+    async def write_batch(self, batch):
+        """ Await DBConnection.write_batch on the executor thread
+"""
+        return await self.run(self.connection.write_batch, batch)
+
+    async def history(self, guild_id, author_id=None, before=None,
+                      limit=10):
+        """ Await DBConnection.history on the executor thread
+"""
+        return await self.run(
+            self.connection.history, guild_id, author_id, before, limit
+        )
+
+    async def guild_stats(self, guild_id, since, limit=10):
+        """ Await DBConnection.guild_stats on the executor thread
+"""
+        return await self.run(
+            self.connection.guild_stats, guild_id, since, limit
+        )
+
+    async def get_preferences(self, guild_id):
+        """ Await DBConnection.get_preferences on the executor thread
+"""
+        return await self.run(self.connection.get_preferences, guild_id)
+
+    async def set_preference(self, guild_id, key, value):
+        """ Await DBConnection.set_preference on the executor thread
+"""
+        return await self.run(
+            self.connection.set_preference, guild_id, key, value
+        )
+
+    async def create_guild(self, guild_id):
+        """ Await DBConnection.create_guild on the executor thread
+"""
+        return await self.run(self.connection.create_guild, guild_id)
+
+    async def delete_guild(self, guild_id):
+        """ Await DBConnection.delete_guild on the executor thread
+"""
+        return await self.run(self.connection.delete_guild, guild_id)
+
+    async def reset_guild(self, guild_id):
+        """ Await DBConnection.reset_guild on the executor thread
+"""
+        return await self.run(self.connection.reset_guild, guild_id)
+
+    async def export_preferences(self, path, fmt="jsonl"):
+        """ Await transfer.export_file on the executor thread
+"""
+        return await self.run(
+            transfer.export_file, self.connection, path, fmt
+        )
+
+    async def import_preferences(self, path, fmt="jsonl"):
+        """ Await transfer.import_file on the executor thread
+"""
+        return await self.run(
+            transfer.import_file, self.connection, path, fmt
+        )
+
+    async def reconcile_guilds(self, guild_ids, owns=None):
+        """ Await DBConnection.reconcile_guilds on the executor thread
+"""
+        return await self.run(
+            self.connection.reconcile_guilds, guild_ids, owns
+        )
@@ -0,0 +1,157 @@
+#! python3
+# migrations.py
+
+"""
+Versioned schema migrations for the SQLite databases in data/db
+- The schema version of a database is stored in PRAGMA user_version
+- Each migration runs in one transaction together with its version bump,
+  so an interrupted migration leaves the database at the previous version
+- Migrations are only ever appended; the first creates the original schema
+  with IF NOT EXISTS, so databases created before versioning adopt it
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import logging
+
+PREFERENCES_QUERY = """CREATE TABLE IF NOT EXISTS preferences (
+    GuildID integer PRIMARY KEY,
+    everyone integer DEFAULT 1,
+    roles integer DEFAULT 1,
+    members integer DEFAULT 0,
+    channel integer DEFAULT 0
+);"""
+
+GHOSTPINGS_QUERY = """CREATE TABLE IF NOT EXISTS ghostpings (
+    ID integer PRIMARY KEY,
+    GuildID integer NOT NULL,
+    ChannelID integer NOT NULL,
+    AuthorID integer NOT NULL,
+    MessageID integer NOT NULL,
+    author text,
+    content text,
+    members integer DEFAULT 0,
+    roles integer DEFAULT 0,
+    everyone integer DEFAULT 0,
+    created real,
+    detected real
+);"""
+
+# Indexes end with the implicit ID column, so pages ordered by ID are
+# read straight from the index
+GHOSTPINGS_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ghostpings_guild "
+    "ON ghostpings (GuildID);",
+    "CREATE INDEX IF NOT EXISTS ghostpings_author "
+    "ON ghostpings (GuildID, AuthorID);",
+    "CREATE INDEX IF NOT EXISTS ghostpings_detected "
+    "ON ghostpings (GuildID, detected);",
+)
+
+# Rollups of the ghostpings table by UTC day (days since the Unix epoch),
+# clustered by guild and day so a range of days is one index range
+DAILY_STATS_QUERY = """CREATE TABLE IF NOT EXISTS daily_stats (
+    GuildID integer NOT NULL,
+    day integer NOT NULL,
+    pings integer DEFAULT 0,
+    members integer DEFAULT 0,
+    roles integer DEFAULT 0,
+    everyone integer DEFAULT 0,
+    PRIMARY KEY (GuildID, day)
+) WITHOUT ROWID;"""
+
+AUTHOR_STATS_QUERY = """CREATE TABLE IF NOT EXISTS author_stats (
+    GuildID integer NOT NULL,
+    day integer NOT NULL,
+    AuthorID integer NOT NULL,
+    author text,
+    pings integer DEFAULT 0,
+    PRIMARY KEY (GuildID, day, AuthorID)
+) WITHOUT ROWID;"""
+
+CHANNEL_STATS_QUERY = """CREATE TABLE IF NOT EXISTS channel_stats (
+    GuildID integer NOT NULL,
+    day integer NOT NULL,
+    ChannelID integer NOT NULL,
+    pings integer DEFAULT 0,
+    PRIMARY KEY (GuildID, day, ChannelID)
+) WITHOUT ROWID;"""
+
+# Ghost pings per raid window which switch a guild into raid mode; 0 turns
+# the threshold off
+RAID_THRESHOLD = 20
+RAID_AUTHOR_THRESHOLD = 8
+# Default preferences of a guild, matching the column defaults
+PREFERENCE_DEFAULTS = {
+    "everyone": 1, "roles": 1, "members": 0, "channel": 0,
+    "raid_threshold": RAID_THRESHOLD,
+    "raid_author_threshold": RAID_AUTHOR_THRESHOLD,
+}
+
+MIGRATIONS = (
+    # 1: guild preferences, ghost pings, and their daily rollups
+    (
+        PREFERENCES_QUERY, GHOSTPINGS_QUERY, *GHOSTPINGS_INDEXES,
+        DAILY_STATS_QUERY, AUTHOR_STATS_QUERY, CHANNEL_STATS_QUERY
+    ),
+    # 2: raid mode thresholds
+    (
+        "ALTER TABLE preferences "
+        f"ADD COLUMN raid_threshold integer DEFAULT {RAID_THRESHOLD};",
+        "ALTER TABLE preferences "
+        "ADD COLUMN raid_author_threshold integer "
+        f"DEFAULT {RAID_AUTHOR_THRESHOLD};",
+    ),
+)
+LATEST = len(MIGRATIONS)
+
+
+def version(connection):
+    """ Return the schema version of a DBConnection
+"""
+    return connection.connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(connection, migrations=MIGRATIONS):
+    """ Apply the pending migrations to a DBConnection, one transaction
+        each, and return the versions before and after
+        The version is read inside each transaction, so processes sharing
+        the database never apply a migration twice
+        Raises RuntimeError if the database is newer than the migrations
+"""
+    before = version(connection)
+    while True:
+        with connection.transaction():
+            current = version(connection)
+            if current > len(migrations):
+                raise RuntimeError(
+                    f"Database schema version {current} is newer than "
+                    f"the latest known version {len(migrations)}"
+                )
+            if current == len(migrations):
+                return before, current
+            for statement in migrations[current]:
+                connection.connection.execute(statement)
+            connection.connection.execute(
+                f"PRAGMA user_version={current + 1}"
+            )
+        logging.info("Migrated database to schema version %d", current + 1)
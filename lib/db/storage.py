@@ -0,0 +1,422 @@
+#! python3
+# storage.py
+
+"""
+Storage backends for guild preferences and ghost pings
+- Every backend has the methods of lib.db.db.DBConnection, from
+  get_preferences to history and guild_stats, so AsyncDBConnection and the
+  cogs work with any of them
+- sqlite: one SQLite file, lib.db.db.DBConnection
+- memory: dictionaries which are never persisted, for tests and benchmarks
+- partitioned: guilds split across several SQLite files by guild ID, so
+  each file has its own write lock
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import bisect
+import collections
+import contextlib
+import functools
+import heapq
+import os
+
+from lib.db import db, migrations
+
+BACKENDS = ("sqlite", "memory", "partitioned")
+
+DEFAULT_PREFERENCES = migrations.PREFERENCE_DEFAULTS
+PREFERENCES_ROW = ("GuildID", *db.PREFERENCE_COLUMNS)
+GHOSTPING_COLUMNS = (
+    "ID", "GuildID", "ChannelID", "AuthorID", "MessageID", "author",
+    "content", "members", "roles", "everyone", "created", "detected"
+)
+
+
+def factory(backend="sqlite", partitions=4):
+    """ Return a callable which creates a backend from a database path
+"""
+    if backend == "sqlite":
+        return db.DBConnection
+    if backend == "memory":
+        return MemoryStorage
+    if backend == "partitioned":
+        return functools.partial(PartitionedStorage, partitions=partitions)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def check_batch(batch):
+    """ Raise ValueError if a write-behind batch has an unknown operation
+"""
+    for operation, _ in batch:
+        if operation not in db.WRITE_OPERATIONS:
+            raise ValueError(f"Unknown write operation: {operation}")
+
+
+class MemoryStorage(db.Storage):
+    """ Keep preferences, ghost pings, and their rollups in dictionaries
+        path is ignored, nothing is written to disk
+        Writes apply immediately, so transaction() cannot roll them back
+"""
+    def __init__(self, path=None):
+        self.path = path
+        self.preferences = {}
+        self.last_id = 0
+        # Ghost pings of each guild in ID order, beside their IDs
+        self.ghostpings = collections.defaultdict(list)
+        self.ghostping_ids = collections.defaultdict(list)
+        # Rollups of each guild keyed by day, (day, AuthorID), and
+        # (day, ChannelID)
+        self.daily = collections.defaultdict(dict)
+        self.authors = collections.defaultdict(dict)
+        self.channels = collections.defaultdict(dict)
+
+    def close_connection(self):
+        """ Nothing to close
+"""
+
+    def migrate(self):
+        """ Dictionaries need no schema, so they are always up to date
+"""
+        return migrations.LATEST, migrations.LATEST
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Group writes like DBConnection.transaction, without rollback
+"""
+        yield self
+
+    def write_batch(self, batch):
+        """ Run (operation, rows) pairs of a write-behind batch
+"""
+        check_batch(batch)
+        for operation, rows in batch:
+            getattr(self, operation)(rows)
+
+    def insert_ghostpings(self, rows):
+        """ Insert ghost pings and count them in the daily, author, and
+            channel rollups of the UTC day they were detected
+"""
+        for row in rows:
+            self.last_id += 1
+            ping = dict(zip(GHOSTPING_COLUMNS, (self.last_id, *row)))
+            guild_id, day = ping["GuildID"], int(ping["detected"] // 86400)
+            self.ghostpings[guild_id].append(ping)
+            self.ghostping_ids[guild_id].append(self.last_id)
+            daily = self.daily[guild_id].setdefault(day, {
+                "GuildID": guild_id, "day": day, "pings": 0,
+                "members": 0, "roles": 0, "everyone": 0
+            })
+            daily["pings"] += 1
+            for column in ("members", "roles", "everyone"):
+                daily[column] += ping[column]
+            author = self.authors[guild_id].setdefault(
+                (day, ping["AuthorID"]), {"AuthorID": ping["AuthorID"]}
+            )
+            author["author"] = ping["author"]
+            author["pings"] = author.get("pings", 0) + 1
+            channel = self.channels[guild_id].setdefault(
+                (day, ping["ChannelID"]), {"ChannelID": ping["ChannelID"]}
+            )
+            channel["pings"] = channel.get("pings", 0) + 1
+
+    def history(self, guild_id, author_id=None, before=None, limit=10):
+        """ Return up to limit ghost pings of a guild, newest first, with
+            an ID below before
+"""
+        before = db.FIRST_PAGE if before is None else before
+        pings = self.ghostpings.get(guild_id, ())
+        end = bisect.bisect_left(self.ghostping_ids.get(guild_id, ()), before)
+        page = []
+        for i in range(end - 1, -1, -1):
+            if len(page) == limit:
+                break
+            if author_id is None or pings[i]["AuthorID"] == author_id:
+                page.append(dict(pings[i]))
+        return page
+
+    def guild_stats(self, guild_id, since, limit=10):
+        """ Return the daily totals, top authors, and top channels of a
+            guild from day since onwards
+"""
+        daily = [
+            dict(row) for day, row in self.daily.get(guild_id, {}).items()
+            if day >= since
+        ]
+        daily.sort(key=lambda row: row["day"], reverse=True)
+        authors, channels = {}, {}
+        for (day, author_id), row in self.authors.get(guild_id, {}).items():
+            if day >= since:
+                total = authors.setdefault(
+                    author_id, {"AuthorID": author_id, "author": None,
+                                "last_day": day, "pings": 0}
+                )
+                if day >= total["last_day"]:
+                    total["author"] = row["author"]
+                    total["last_day"] = day
+                total["pings"] += row["pings"]
+        for (day, channel_id), row in (
+                self.channels.get(guild_id, {}).items()
+        ):
+            if day >= since:
+                total = channels.setdefault(
+                    channel_id, {"ChannelID": channel_id, "pings": 0}
+                )
+                total["pings"] += row["pings"]
+        return {
+            "daily": daily,
+            "authors": heapq.nlargest(
+                limit, authors.values(), key=lambda row: row["pings"]
+            ),
+            "channels": heapq.nlargest(
+                limit, channels.values(), key=lambda row: row["pings"]
+            ),
+        }
+
+    def get_preferences(self, guild_id):
+        """ Return the preferences of a guild as a dict, or None
+"""
+        row = self.preferences.get(guild_id)
+        return None if row is None else dict(row)
+
+    def set_preference(self, guild_id, key, value):
+        """ Change one preference setting of a guild
+"""
+        if key not in db.PREFERENCE_COLUMNS:
+            raise ValueError(f"Unknown preference: {key}")
+        if guild_id in self.preferences:
+            self.preferences[guild_id][key] = value
+
+    def create_guild(self, guild_id):
+        """ Insert default preferences for a guild if it has none
+"""
+        if guild_id not in self.preferences:
+            self.reset_guild(guild_id)
+
+    def delete_guild(self, guild_id):
+        """ Delete the preferences of a guild
+"""
+        self.preferences.pop(guild_id, None)
+
+    def reset_guild(self, guild_id):
+        """ Replace the preferences of a guild with the defaults
+"""
+        self.preferences[guild_id] = {
+            "GuildID": guild_id, **DEFAULT_PREFERENCES
+        }
+
+    def iter_preferences(self, chunk_size=db.CHUNK_SIZE):
+        """ Yield every preferences row as a tuple, ordered by guild ID
+"""
+        for guild_id in sorted(self.preferences):
+            row = self.preferences[guild_id]
+            yield tuple(row[c] for c in PREFERENCES_ROW)
+
+    def import_preferences(self, rows, chunk_size=db.CHUNK_SIZE):
+        """ Insert or overwrite preferences from rows
+            Nothing is changed if reading rows raises
+"""
+        staged = {}
+        count = 0
+        for row in rows:
+            staged[row[0]] = dict(zip(PREFERENCES_ROW, row))
+            count += 1
+        self.preferences.update(staged)
+        return count
+
+    def reconcile_guilds(self, guild_ids, owns=None):
+        """ Match the preferences to the guilds the bot is in, see
+            DBConnection.reconcile_guilds
+"""
+        connected = set(guild_ids)
+        added = 0
+        for guild_id in connected:
+            if guild_id not in self.preferences:
+                self.reset_guild(guild_id)
+                added += 1
+        stale = [
+            i for i in self.preferences
+            if i not in connected and (owns is None or owns(i))
+        ]
+        for guild_id in stale:
+            del self.preferences[guild_id]
+        return added, len(stale), [
+            dict(self.preferences[i]) for i in connected
+        ]
+
+
+class PartitionedStorage(db.Storage):
+    """ Split guilds across partitions SQLite files named after path, e.g.
+        data/db/db-0.sqlite, so each file has its own write lock and
+        processes writing different guilds do not wait on each other
+        Queries of one guild use one partition
+        Writes spanning partitions commit once per partition
+"""
+    def __init__(self, path=db.DATABASE_PATH, partitions=4):
+        if partitions < 1:
+            raise ValueError("partitions must be at least 1")
+        root, extension = os.path.splitext(path)
+        self.partitions = [
+            db.DBConnection(
+                path if path == ":memory:" else f"{root}-{i}{extension}"
+            )
+            for i in range(partitions)
+        ]
+
+    def index(self, guild_id):
+        """ Return the index of the partition of a guild
+            The low bits of snowflakes are mostly zero, so the timestamp
+            bits are mixed in
+"""
+        return (guild_id ^ (guild_id >> 22)) % len(self.partitions)
+
+    def partition(self, guild_id):
+        """ Return the DBConnection of the partition of a guild
+"""
+        return self.partitions[self.index(guild_id)]
+
+    def close_connection(self):
+        """ Close every partition
+"""
+        for partition in self.partitions:
+            partition.close_connection()
+
+    def migrate(self):
+        """ Migrate every partition and return the oldest version before
+            and the version after
+"""
+        versions = [p.migrate() for p in self.partitions]
+        return min(v[0] for v in versions), migrations.LATEST
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Run the block inside a transaction on every partition
+            Partitions commit one after another when the block exits
+"""
+        with contextlib.ExitStack() as stack:
+            for partition in self.partitions:
+                stack.enter_context(partition.transaction())
+            yield self
+
+    def write_batch(self, batch):
+        """ Split a write-behind batch by partition and write each part in
+            one transaction
+            Rows are routed by row[0], so the rows of every write operation
+            must start with GuildID
+"""
+        check_batch(batch)
+        parts = collections.defaultdict(dict)
+        for operation, rows in batch:
+            for row in rows:
+                parts[self.index(row[0])].setdefault(
+                    operation, []
+                ).append(row)
+        for index, operations in parts.items():
+            self.partitions[index].write_batch(list(operations.items()))
+
+    def insert_ghostpings(self, rows):
+        """ Insert ghost pings into the partitions of their guilds
+"""
+        self.write_batch([("insert_ghostpings", rows)])
+
+    def history(self, guild_id, author_id=None, before=None, limit=10):
+        """ Return a page of the ghost pings of a guild
+"""
+        return self.partition(guild_id).history(
+            guild_id, author_id, before, limit
+        )
+
+    def guild_stats(self, guild_id, since, limit=10):
+        """ Return the ghost ping rollups of a guild
+"""
+        return self.partition(guild_id).guild_stats(guild_id, since, limit)
+
+    def get_preferences(self, guild_id):
+        """ Return the preferences of a guild as a dict, or None
+"""
+        return self.partition(guild_id).get_preferences(guild_id)
+
+    def set_preference(self, guild_id, key, value):
+        """ Change one preference setting of a guild
+"""
+        self.partition(guild_id).set_preference(guild_id, key, value)
+
+    def create_guild(self, guild_id):
+        """ Insert default preferences for a guild if it has none
+"""
+        self.partition(guild_id).create_guild(guild_id)
+
+    def delete_guild(self, guild_id):
+        """ Delete the preferences of a guild
+"""
+        self.partition(guild_id).delete_guild(guild_id)
+
+    def reset_guild(self, guild_id):
+        """ Replace the preferences of a guild with the defaults
+"""
+        self.partition(guild_id).reset_guild(guild_id)
+
+    def iter_preferences(self, chunk_size=db.CHUNK_SIZE):
+        """ Yield every preferences row as a tuple, ordered by guild ID
+"""
+        return heapq.merge(*(
+            p.iter_preferences(chunk_size) for p in self.partitions
+        ))
+
+    def import_preferences(self, rows, chunk_size=db.CHUNK_SIZE):
+        """ Insert or overwrite preferences from rows, chunk_size rows of a
+            partition at a time, in one transaction per partition
+            Nothing is committed if reading rows raises
+"""
+        chunks = [[] for _ in self.partitions]
+        count = 0
+        with self.transaction():
+            for row in rows:
+                index = self.index(row[0])
+                chunk = chunks[index]
+                chunk.append(row)
+                count += 1
+                if len(chunk) >= chunk_size:
+                    self.partitions[index].import_preferences(chunk)
+                    chunk.clear()
+            for partition, chunk in zip(self.partitions, chunks):
+                if chunk:
+                    partition.import_preferences(chunk)
+        return count
+
+    def reconcile_guilds(self, guild_ids, owns=None):
+        """ Match the preferences of every partition to the guilds the bot
+            is in, see DBConnection.reconcile_guilds
+"""
+        connected = [set() for _ in self.partitions]
+        for guild_id in guild_ids:
+            connected[self.index(guild_id)].add(guild_id)
+        added = removed = 0
+        preferences = []
+        for partition, guild_ids in zip(self.partitions, connected):
+            partition_added, partition_removed, partition_preferences = (
+                partition.reconcile_guilds(guild_ids, owns)
+            )
+            added += partition_added
+            removed += partition_removed
+            preferences.extend(partition_preferences)
+        return added, removed, preferences
@@ -0,0 +1,148 @@
+#! python3
+# transfer.py
+
+"""
+Streams the preferences table to and from JSON Lines or CSV files
+- Rows are read from and written to the file one at a time, so memory use
+  does not grow with the number of guilds
+- Imports are validated while streaming and roll back on the first bad row
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import csv
+import json
+import os
+
+from lib.db import migrations
+
+FORMATS = ("jsonl", "csv")
+COLUMNS = (
+    "GuildID", "everyone", "roles", "members", "channel", "raid_threshold",
+    "raid_author_threshold"
+)
+# Columns added after the first export format, filled with their defaults
+# when importing older files
+OPTIONAL = {
+    c: migrations.PREFERENCE_DEFAULTS[c]
+    for c in ("raid_threshold", "raid_author_threshold")
+}
+# Every column is an integer, so rows are formatted as JSON directly
+JSON_ROW = "{" + ",".join(f'"{c}":%d' for c in COLUMNS) + "}\n"
+
+
+def detect_format(path):
+    """ Return the format of a file from its extension
+"""
+    fmt = os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt == "json":
+        fmt = "jsonl"
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt or path}")
+    return fmt
+
+
+def write_rows(file, rows, fmt="jsonl"):
+    """ Write preferences rows to a text file and return how many
+"""
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    elif fmt == "jsonl":
+        for row in rows:
+            file.write(JSON_ROW % row)
+            count += 1
+    else:
+        raise ValueError(f"Unknown format: {fmt}")
+    return count
+
+
+def read_rows(file, fmt="jsonl"):
+    """ Yield preferences rows from a text file as tuples of integers
+        Raises ValueError naming the line of the first invalid row
+"""
+    if fmt == "csv":
+        reader = csv.reader(file)
+        header = next(reader, [])
+        missing = set(COLUMNS) - set(header) - set(OPTIONAL)
+        if missing:
+            raise ValueError(
+                f"Missing CSV columns: {', '.join(sorted(missing))}"
+            )
+        # Missing optional columns are read from defaults appended to every
+        # record
+        width = len(header)
+        defaults = [OPTIONAL[c] for c in COLUMNS if c not in header]
+        header = header + [c for c in COLUMNS if c not in header]
+        indexes = [header.index(c) for c in COLUMNS]
+        for record in reader:
+            if not record:
+                continue
+            if len(record) < width:
+                raise ValueError(
+                    f"Invalid row on line {reader.line_num}: "
+                    f"expected {width} values"
+                )
+            yield parse(record + defaults, reader.line_num, indexes)
+    elif fmt == "jsonl":
+        for line, text in enumerate(file, 1):
+            if not text.strip():
+                continue
+            try:
+                record = json.loads(text)
+            except ValueError as error:
+                raise ValueError(f"Invalid JSON on line {line}: {error}")
+            if isinstance(record, dict):
+                record = {**OPTIONAL, **record}
+            yield parse(record, line)
+    else:
+        raise ValueError(f"Unknown format: {fmt}")
+
+
+def parse(record, line, keys=COLUMNS):
+    """ Return a preferences row from the values of record at keys
+"""
+    try:
+        return tuple([int(record[k]) for k in keys])
+    except (IndexError, KeyError, TypeError, ValueError) as error:
+        raise ValueError(f"Invalid row on line {line}: {error!r}") from None
+
+
+def export_file(connection, path, fmt="jsonl"):
+    """ Write the preferences table of a DBConnection to path
+        Returns the number of rows written
+"""
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        return write_rows(file, connection.iter_preferences(), fmt)
+
+
+def import_file(connection, path, fmt="jsonl"):
+    """ Insert or overwrite preferences of a DBConnection from path in a
+        single transaction
+        Returns the number of rows written
+"""
+    with open(path, encoding="utf-8", newline="") as file:
+        return connection.import_preferences(read_rows(file, fmt))
@@ -0,0 +1,121 @@
+#! python3
+# writer.py
+
+"""
+Write-behind queue for data/db
+- Collects writes from the event handlers without waiting on the database
+- Commits the queued writes in one transaction per batch, at most once per
+  interval unless the batch fills up first
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import asyncio
+import logging
+import sqlite3
+
+
+class BatchWriter:
+    """ Queue rows for the write operations of a storage backend and run
+        them in batches through an AsyncDBConnection
+        Rows of the same operation keep their order, but a batch runs each
+        operation's rows together, so operations must not depend on each
+        other
+"""
+    def __init__(self, connection, interval=1.0, batch_size=500):
+        self.connection = connection
+        self.interval = interval
+        self.batch_size = batch_size
+        self.writes = 0
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+        self._batch = {}
+        self._queued = 0
+        self._timer = None
+        self._written = None
+        self._closed = False
+
+    def __len__(self):
+        return self._queued
+
+    def add(self, operation, row):
+        """ Queue one row for a write operation, e.g. "insert_ghostpings"
+            Rows added after close are counted and dropped, since events may
+            still arrive while the bot shuts down
+"""
+        if self._closed:
+            self.dropped += 1
+            logging.warning("Dropped %s row added after close", operation)
+            return
+        self._batch.setdefault(operation, []).append(row)
+        self._queued += 1
+        if self._queued >= self.batch_size:
+            self._submit()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(
+                self.interval, self._submit
+            )
+
+    def _submit(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._batch:
+            batch, count = list(self._batch.items()), self._queued
+            self._batch, self._queued = {}, 0
+            # Each batch is submitted to the single database thread as its
+            # task starts, so batches commit in the order they were queued
+            self._written = asyncio.ensure_future(self._write(batch, count))
+        return self._written
+
+    async def _write(self, batch, count):
+        try:
+            await self.connection.write_batch(batch)
+        except (sqlite3.Error, ValueError):
+            self.failures += count
+            logging.exception("Failed to write %d queued rows", count)
+        else:
+            self.writes += count
+            self.batches += 1
+
+    async def flush(self):
+        """ Write the queued rows now and wait for every earlier batch
+"""
+        written = self._submit()
+        if written is not None:
+            await written
+
+    async def close(self):
+        """ Write the queued rows and drop any added afterwards
+"""
+        self._closed = True
+        await self.flush()
+
+    def stats(self):
+        """ Return the queue length and write counters
+"""
+        return {
+            "queued": self._queued, "writes": self.writes,
+            "batches": self.batches, "failures": self.failures,
+            "dropped": self.dropped
+        }
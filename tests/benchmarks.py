@@ -0,0 +1,379 @@
+#! python3
+# benchmarks.py
+
+"""
+Benchmarks the ghost ping detection pipeline offline
+- Drives the AntiGhostPing cog with fake guilds, members, roles, channels,
+  and messages; alerts are sent to a stubbed channel
+- Measures throughput and p50/p99 latency of each stage across guild sizes,
+  mention counts, and preference combinations
+- Writes the results to a JSON file and optionally compares them with the
+  results of a previous run
+
+Usage (from the repository root):
+    python -m tests.benchmarks [--events N] [--output FILE] [--compare FILE]
+                               [--storage BACKEND]
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+
+import discord
+
+from lib.bot import coalescer, journal, metrics, raid, resolver, store
+from lib.cogs.antighostping import AntiGhostPing
+from lib.db import cache, db, storage, writer
+
+GUILD_SIZES = (100, 10000, 100000)
+MENTION_COUNTS = (1, 5, 20)
+PREFERENCES = {
+    "defaults": {"everyone": 1, "roles": 1, "members": 0},
+    "all": {"everyone": 1, "roles": 1, "members": 1},
+    "members": {"everyone": 0, "roles": 0, "members": 1},
+    "none": {"everyone": 0, "roles": 0, "members": 0},
+}
+STAGES = ("record", "parse", "detected", "delete")
+GUILD_ID = 81384788765712384
+CHANNEL_ID = 81384788765712385
+
+
+class FakeRole:
+    """ Stand-in for discord.Role
+"""
+    def __init__(self, role_id, name):
+        self.id = role_id
+        self.name = name
+
+
+class FakeMember:
+    """ Stand-in for discord.Member
+"""
+    def __init__(self, member_id, name, bot=False):
+        self.id = member_id
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+
+
+class FakeTextChannel:
+    """ Stand-in for discord.TextChannel whose send only counts calls
+"""
+    def __init__(self, channel_id, name):
+        self.id = channel_id
+        self.name = name
+        self.sent = 0
+
+    async def send(self, content=None, *, embed=None):
+        self.sent += 1
+
+
+class FakeGuild:
+    """ Stand-in for discord.Guild with ID-indexed members, roles, channels
+"""
+    def __init__(self, guild_id, size, roles=50):
+        self.id = guild_id
+        self.name = f"guild-{size}"
+        self._members = {
+            i: FakeMember(i, f"member-{i}") for i in range(1, size + 1)
+        }
+        self._roles = {
+            i: FakeRole(i, f"role-{i}")
+            for i in range(10 ** 9, 10 ** 9 + roles)
+        }
+        channel = FakeTextChannel(CHANNEL_ID, "general")
+        self._channels = {channel.id: channel}
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    @property
+    def roles(self):
+        return list(self._roles.values())
+
+    @property
+    def channels(self):
+        return list(self._channels.values())
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+    def get_role(self, role_id):
+        return self._roles.get(role_id)
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+    async def query_members(self, *, user_ids, limit, cache):
+        return [self._members[i] for i in user_ids if i in self._members]
+
+
+class FakeMessage:
+    """ Stand-in for discord.Message
+"""
+    def __init__(self, message_id, guild, author, mentions, role_mentions,
+                 everyone):
+        self.id = message_id
+        self.guild = guild
+        self.channel = guild.get_channel(CHANNEL_ID)
+        self.author = author
+        self.raw_mentions = mentions
+        self.raw_role_mentions = role_mentions
+        self.mention_everyone = everyone
+        self.content = " ".join(
+            [f"<@{i}>" for i in mentions]
+            + [f"<@&{i}>" for i in role_mentions]
+            + (["@everyone"] if everyone else [])
+        )
+
+
+class FakeHTTP:
+    """ Stand-in for discord.http.HTTPClient which only counts requests
+"""
+    def __init__(self):
+        self.requests = 0
+
+    async def request(self, route, **kwargs):
+        self.requests += 1
+
+
+class FakeBot:
+    """ Stand-in for lib.bot.BotRoot holding the detection subsystems
+"""
+    def __init__(self, guild, connection):
+        self.guild = guild
+        self.connection = connection
+        self.http = FakeHTTP()
+        self.metrics = metrics.BotMetrics(self)
+        self.preferences = cache.PreferencesCache(connection)
+        self.writer = writer.BatchWriter(connection)
+        self.journal = journal.MentionJournal(
+            os.path.join(tempfile.mkdtemp(), "mentions.journal")
+        )
+        self.message_store = store.MentionStore(journal=self.journal)
+        self.resolver = resolver.EntityResolver()
+        self.alerts = coalescer.AlertCoalescer(self, window=3600)
+        self.raids = raid.RaidMonitor(self)
+
+    def get_guild(self, guild_id):
+        return self.guild if guild_id == self.guild.id else None
+
+
+def snowflakes(start=datetime.datetime(2021, 1, 1)):
+    """ Yield increasing message IDs
+"""
+    epoch = int(start.timestamp() * 1000) - store.DISCORD_EPOCH
+    for i in itertools.count():
+        yield ((epoch + i) << 22) + i % 4096
+
+
+def summarize(samples, elapsed):
+    """ Return throughput and latency percentiles of timed samples
+"""
+    if not samples:
+        return None
+    samples = sorted(samples)
+    quantiles = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "count": len(samples),
+        "throughput": len(samples) / elapsed if elapsed else None,
+        "mean_us": statistics.mean(samples) * 1e6,
+        "p50_us": quantiles[49] * 1e6,
+        "p99_us": quantiles[98] * 1e6,
+    }
+
+
+async def run_scenario(guild, connection, preferences, mentions, events):
+    """ Time every stage of the pipeline for one scenario
+"""
+    await connection.delete_guild(guild.id)
+    await connection.create_guild(guild.id)
+    for key, value in PREFERENCES[preferences].items():
+        await connection.set_preference(guild.id, key, value)
+    # Time the alert of every ghost ping instead of a raid summary
+    for key in ("raid_threshold", "raid_author_threshold"):
+        await connection.set_preference(guild.id, key, 0)
+    bot = FakeBot(guild, connection)
+    cog = AntiGhostPing(bot)
+    members = list(guild._members)
+    roles = list(guild._roles)
+    author = FakeMember(0, "ghost-pinger")
+    ids = snowflakes()
+    samples = {stage: [] for stage in STAGES}
+    elapsed = dict.fromkeys(STAGES, 0.0)
+    for n in range(events):
+        message = FakeMessage(
+            next(ids), guild, author,
+            [members[(n + i) % len(members)]
+             for i in range(mentions - mentions // 2)],
+            [roles[(n + i) % len(roles)] for i in range(mentions // 2)],
+            n % 10 == 0
+        )
+        start = time.perf_counter()
+        await cog.on_message(message)
+        recorded = time.perf_counter()
+        record = bot.message_store.get(message.id)
+        flags = await cog.parse(guild, record)
+        parsed = time.perf_counter()
+        if flags:
+            await cog.detected(guild, record, flags)
+        detected = time.perf_counter()
+        await cog.on_raw_message_delete(discord.RawMessageDeleteEvent({
+            "id": message.id, "channel_id": CHANNEL_ID,
+            "guild_id": guild.id
+        }))
+        deleted = time.perf_counter()
+        timings = {
+            "record": recorded - start, "parse": parsed - recorded,
+            "delete": deleted - detected
+        }
+        if flags:
+            timings["detected"] = detected - parsed
+        for stage, timing in timings.items():
+            samples[stage].append(timing)
+            elapsed[stage] += timing
+    await bot.alerts.flush_all()
+    await bot.writer.close()
+    await bot.journal.close()
+    return {
+        "guild_size": len(members), "mentions": mentions,
+        "preferences": preferences,
+        "stages": {
+            stage: summarize(samples[stage], elapsed[stage])
+            for stage in STAGES
+        },
+        "alert_calls": bot.alerts.calls,
+    }
+
+
+async def run_benchmarks(events, guild_sizes=GUILD_SIZES,
+                         mention_counts=MENTION_COUNTS,
+                         preferences=tuple(PREFERENCES), backend="sqlite"):
+    """ Run every scenario against a backend and return the results
+"""
+    connection = db.AsyncDBConnection(
+        ":memory:", factory=storage.factory(backend)
+    )
+    await connection.migrate()
+    results = []
+    try:
+        for size in guild_sizes:
+            guild = FakeGuild(GUILD_ID, size)
+            for mentions, prefs in itertools.product(
+                    mention_counts, preferences
+            ):
+                result = await run_scenario(
+                    guild, connection, prefs, mentions, events
+                )
+                results.append(result)
+                delete = result["stages"]["delete"]
+                print(
+                    f"size={size:<7} mentions={mentions:<3} "
+                    f"prefs={prefs:<9} delete: "
+                    f"{delete['throughput']:>9.0f}/s "
+                    f"p50={delete['p50_us']:.1f}us "
+                    f"p99={delete['p99_us']:.1f}us"
+                )
+    finally:
+        connection.close_connection()
+    return {
+        "meta": {
+            "created": datetime.datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "discord.py": discord.__version__,
+            "events": events,
+            "storage": backend,
+        },
+        "results": results,
+    }
+
+
+def compare(previous, current, tolerance):
+    """ Return the scenarios whose p50 latency regressed beyond tolerance
+"""
+    def key(result):
+        return (
+            result["guild_size"], result["mentions"], result["preferences"]
+        )
+
+    baseline = {key(r): r for r in previous["results"]}
+    regressions = []
+    for result in current["results"]:
+        before = baseline.get(key(result))
+        if before is None:
+            continue
+        for stage, summary in result["stages"].items():
+            old = before["stages"].get(stage)
+            if not summary or not old:
+                continue
+            ratio = summary["p50_us"] / old["p50_us"]
+            if ratio > 1 + tolerance:
+                regressions.append((key(result), stage, ratio))
+    return regressions
+
+
+def main():
+    """ Run the benchmarks from the command line
+"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--output", default="benchmarks.json")
+    parser.add_argument("--compare", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument(
+        "--storage", choices=storage.BACKENDS, default="sqlite"
+    )
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(run_benchmarks(
+            args.events, backend=args.storage
+        ))
+    finally:
+        loop.close()
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as file:
+            previous = json.load(file)
+        regressions = compare(previous, results, args.tolerance)
+        for (size, mentions, prefs), stage, ratio in regressions:
+            print(
+                f"REGRESSION size={size} mentions={mentions} "
+                f"prefs={prefs} {stage}: {ratio:.2f}x slower"
+            )
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
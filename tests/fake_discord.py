@@ -0,0 +1,594 @@
+#! python3
+# fake_discord.py
+
+"""
+Local stand-in for the Discord gateway and REST API for load tests
+- Serves the gateway websocket and the REST routes BotRoot uses
+- Streams synthetic GUILD_CREATE, MESSAGE_CREATE and MESSAGE_DELETE events
+  at configurable rates, with a configurable mix of role, member, and
+  @everyone mentions
+- Records every request the bot makes and answers with 429 responses when
+  a channel exceeds its simulated rate limit
+- Measures the latency from each MESSAGE_DELETE to the alert which reports
+  it, and the number of API calls made
+- Reports the bot's time to ready and resident memory after startup
+
+Usage (from the repository root):
+    python -m tests.fake_discord [--duration S] [--rate N] [--guilds N]
+        [--members N] [--guild-rate N] [--mentions roles=1,members=1,...]
+        [--lazy-members]
+===============================================================================
+Copyright (c) 2021 Jacob Lee
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+===============================================================================
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import os
+import random
+import re
+import statistics
+import tempfile
+import time
+
+from aiohttp import web
+from discord.http import Route
+
+from lib.bot import BotRoot, metrics
+from lib.bot.store import DISCORD_EPOCH
+
+BOT_ID = 700000000000000000
+MARKER = re.compile(r"ghost-(\d+)")
+
+HELLO = 10
+IDENTIFY = 2
+HEARTBEAT = 1
+HEARTBEAT_ACK = 11
+REQUEST_MEMBERS = 8
+DISPATCH = 0
+# Members per GUILD_MEMBERS_CHUNK, as sent by Discord
+CHUNK_SIZE = 1000
+# Kinds of mentions a streamed message may contain
+MENTION_KINDS = ("roles", "members", "everyone")
+
+RecordedRequest = collections.namedtuple(
+    "RecordedRequest", ["time", "method", "path", "status", "body"]
+)
+
+
+def snowflake(offset=0):
+    """ Return a snowflake ID for the current time
+"""
+    return (int(time.time() * 1000) - DISCORD_EPOCH) << 22 | offset % 4096
+
+
+def user_data(user_id, name, bot=False):
+    """ Return a raw user object
+"""
+    return {
+        "id": str(user_id), "username": name, "discriminator": "0001",
+        "avatar": None, "bot": bot
+    }
+
+
+def parse_mix(text):
+    """ Parse kind=weight pairs such as roles=2,everyone=1 into a dict of
+        mention weights
+"""
+    mix = {}
+    for pair in text.split(","):
+        kind, _, weight = pair.partition("=")
+        if kind not in MENTION_KINDS:
+            raise argparse.ArgumentTypeError(f"Unknown mention kind: {kind}")
+        try:
+            mix[kind] = float(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                f"Invalid weight: {weight}"
+            ) from None
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("Every mention weight is zero")
+    return mix
+
+
+def json_response(data, status=200, headers=None):
+    """ Return a JSON response with the exact content type discord.py expects
+"""
+    return web.Response(
+        body=json.dumps(data).encode(), status=status,
+        headers={"Content-Type": "application/json", **(headers or {})}
+    )
+
+
+class FakeDiscord:
+    """ Serve the Discord gateway and REST API on a local port
+"""
+    def __init__(
+            self, guilds=1, members=100, channels=2, roles=5,
+            rate_limit=(5, 5.0), rate_limit_headers=True, seed=0,
+            guild_rate=None
+    ):
+        self.random = random.Random(seed)
+        # GUILD_CREATE events per second after READY, None for no delay
+        self.guild_rate = guild_rate
+        self._tasks = set()
+        self.rate_limit = rate_limit
+        self.rate_limit_headers = rate_limit_headers
+        self.requests = []
+        self.deleted_at = {}
+        self.latencies = {}
+        self.url = None
+        self._sockets = []
+        self._buckets = {}
+        self._sequence = itertools.count(1)
+        self._ids = itertools.count(1)
+        self._runner = None
+        self.guilds = [
+            self.make_guild(g, members, channels, roles)
+            for g in range(1, guilds + 1)
+        ]
+
+    def make_guild(self, number, members, channels, roles):
+        """ Return a raw GUILD_CREATE payload
+"""
+        guild_id = number << 32
+        now = datetime.datetime.utcnow().isoformat()
+        return {
+            "id": str(guild_id), "name": f"guild-{number}",
+            "owner_id": str(guild_id + 1), "unavailable": False,
+            "member_count": members + 1, "large": members > 250,
+            "icon": None, "splash": None, "features": [],
+            "roles": [
+                {"id": str(guild_id), "name": "@everyone",
+                 "permissions": 104324673, "position": 0,
+                 "color": 0, "hoist": False, "managed": False,
+                 "mentionable": False}
+            ] + [
+                {"id": str(guild_id + 1000 + r), "name": f"role-{r}",
+                 "permissions": 0, "position": r + 1, "color": 0,
+                 "hoist": False, "managed": False, "mentionable": True}
+                for r in range(roles)
+            ],
+            "channels": [
+                {"id": str(guild_id + 2000 + c), "name": f"channel-{c}",
+                 "type": 0, "position": c, "permission_overwrites": [],
+                 "nsfw": False, "topic": None, "parent_id": None}
+                for c in range(channels)
+            ],
+            "members": [
+                {"user": user_data(guild_id + 1 + m, f"member-{m}"),
+                 "roles": [], "joined_at": now, "deaf": False,
+                 "mute": False, "nick": None}
+                for m in range(members)
+            ] + [
+                {"user": user_data(BOT_ID, "anti-ghostping", bot=True),
+                 "roles": [], "joined_at": now, "deaf": False,
+                 "mute": False, "nick": None}
+            ],
+            "voice_states": [], "presences": [], "emojis": []
+        }
+
+    async def start(self, host="127.0.0.1", port=0):
+        """ Start serving and point discord.py at the local server
+"""
+        app = web.Application()
+        app.router.add_get("/gateway", self.gateway)
+        app.router.add_route("*", "/api/v7/{path:.*}", self.rest)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        Route.BASE = f"{self.url}/api/v7"
+        return self.url
+
+    async def stop(self):
+        """ Close every gateway connection and stop serving
+"""
+        for task in self._tasks:
+            task.cancel()
+        for socket in list(self._sockets):
+            await socket.close()
+        await self._runner.cleanup()
+
+    async def dispatch(self, event, data):
+        """ Send a DISPATCH event to every connected gateway socket
+"""
+        for socket in list(self._sockets):
+            await socket.send_json({
+                "op": DISPATCH, "t": event, "d": data,
+                "s": next(self._sequence)
+            })
+
+    async def gateway(self, request):
+        """ Handle one gateway websocket connection
+"""
+        socket = web.WebSocketResponse()
+        await socket.prepare(request)
+        await socket.send_json(
+            {"op": HELLO, "d": {"heartbeat_interval": 41250}}
+        )
+        async for message in socket:
+            payload = json.loads(message.data)
+            op, data = payload.get("op"), payload.get("d")
+            if op == HEARTBEAT:
+                await socket.send_json({"op": HEARTBEAT_ACK})
+            elif op == IDENTIFY:
+                await self.identify(socket, data)
+            elif op == REQUEST_MEMBERS:
+                await self.request_members(socket, data)
+        if socket in self._sockets:
+            self._sockets.remove(socket)
+        return socket
+
+    async def identify(self, socket, data):
+        """ Send READY to a new connection and start its GUILD_CREATE
+            stream
+"""
+        shard_id, shard_count = data.get("shard", [0, 1])
+        guilds = [
+            g for g in self.guilds
+            if (int(g["id"]) >> 22) % shard_count == shard_id
+        ]
+        await socket.send_json({
+            "op": DISPATCH, "t": "READY", "s": next(self._sequence),
+            "d": {
+                "v": 6, "session_id": f"session-{shard_id}",
+                "user": user_data(BOT_ID, "anti-ghostping", bot=True),
+                "guilds": [
+                    {"id": g["id"], "unavailable": True} for g in guilds
+                ],
+                "private_channels": [], "relationships": []
+            }
+        })
+        # Stream from a task, so the connection keeps answering heartbeats
+        # and member requests while guilds arrive
+        task = asyncio.ensure_future(self.create_guilds(socket, guilds))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def create_guilds(self, socket, guilds):
+        """ Send GUILD_CREATE for every guild at guild_rate per second,
+            then start dispatching events to the connection
+"""
+        start = time.perf_counter()
+        for n, guild in enumerate(guilds):
+            if self.guild_rate:
+                await asyncio.sleep(max(
+                    0, start + n / self.guild_rate - time.perf_counter()
+                ))
+            if guild["large"]:
+                # Like Discord, large guilds only include the bot's member
+                # and the rest must be requested in chunks
+                guild = dict(guild, members=guild["members"][-1:])
+            await socket.send_json({
+                "op": DISPATCH, "t": "GUILD_CREATE",
+                "s": next(self._sequence), "d": guild
+            })
+        self._sockets.append(socket)
+
+    async def wait_for_guilds(self):
+        """ Wait until every connection has received its GUILD_CREATE
+            stream
+"""
+        await asyncio.gather(*self._tasks)
+
+    async def request_members(self, socket, data):
+        """ Answer a member request with GUILD_MEMBERS_CHUNK events of up to
+            CHUNK_SIZE members
+"""
+        guild = next(g for g in self.guilds if g["id"] == str(
+            data["guild_id"]))
+        members = guild["members"]
+        if data.get("user_ids"):
+            user_ids = {str(i) for i in data["user_ids"]}
+            members = [m for m in members if m["user"]["id"] in user_ids]
+        chunks = [
+            members[i:i + CHUNK_SIZE]
+            for i in range(0, len(members), CHUNK_SIZE)
+        ] or [[]]
+        for index, chunk in enumerate(chunks):
+            await socket.send_json({
+                "op": DISPATCH, "t": "GUILD_MEMBERS_CHUNK",
+                "s": next(self._sequence),
+                "d": {
+                    "guild_id": guild["id"], "members": chunk,
+                    "chunk_index": index, "chunk_count": len(chunks),
+                    "nonce": data.get("nonce")
+                }
+            })
+
+    async def rest(self, request):
+        """ Record a REST request and answer it
+"""
+        path = "/" + request.match_info["path"]
+        body = await request.text()
+        if path in ("/gateway", "/gateway/bot"):
+            return self.record(request, path, body, json_response({
+                "url": self.url.replace("http", "ws", 1) + "/gateway",
+                "shards": 1,
+                "session_start_limit": {
+                    "total": 1000, "remaining": 1000,
+                    "reset_after": 0, "max_concurrency": 1
+                }
+            }))
+        if path == "/users/@me":
+            return self.record(request, path, body, json_response(
+                user_data(BOT_ID, "anti-ghostping", bot=True)
+            ))
+        match = re.fullmatch(r"/channels/(\d+)/messages", path)
+        if match and request.method == "POST":
+            return self.record(
+                request, path, body, self.create_message(
+                    int(match.group(1)), json.loads(body or "{}")
+                )
+            )
+        return self.record(request, path, body, json_response({}))
+
+    def record(self, request, path, body, response):
+        """ Store a request with the status of its response
+"""
+        self.requests.append(RecordedRequest(
+            time.perf_counter(), request.method, path, response.status, body
+        ))
+        return response
+
+    def create_message(self, channel_id, payload):
+        """ Answer a create message request, or 429 if rate limited
+"""
+        limit, period = self.rate_limit
+        now = time.monotonic()
+        sent = self._buckets.setdefault(channel_id, collections.deque())
+        while sent and now - sent[0] >= period:
+            sent.popleft()
+        if len(sent) >= limit:
+            reset_after = period - (now - sent[0])
+            return json_response(
+                {"message": "You are being rate limited.",
+                 "retry_after": reset_after * 1000, "global": False},
+                status=429, headers={
+                    "Via": "1.1 fake-discord",
+                    "X-RateLimit-Remaining": "0",
+                    "X-RateLimit-Reset-After": f"{reset_after:.3f}"
+                }
+            )
+        sent.append(now)
+        received = time.perf_counter()
+        for message_id in MARKER.findall(json.dumps(payload)):
+            message_id = int(message_id)
+            if message_id in self.deleted_at:
+                self.latencies.setdefault(
+                    message_id, received - self.deleted_at[message_id]
+                )
+        embeds = payload.get("embeds") or (
+            [payload["embed"]] if payload.get("embed") else []
+        )
+        data = self.message_data(
+            channel_id, user_data(BOT_ID, "anti-ghostping", bot=True),
+            payload.get("content") or "", embeds=embeds
+        )
+        if not self.rate_limit_headers:
+            return json_response(data)
+        return json_response(data, headers={
+            "X-RateLimit-Limit": str(limit),
+            "X-RateLimit-Remaining": str(limit - len(sent)),
+            "X-RateLimit-Reset-After": f"{period:.3f}"
+        })
+
+    def message_data(self, channel_id, author, content, guild_id=None,
+                     mentions=(), mention_roles=(), embeds=()):
+        """ Return a raw message object
+"""
+        data = {
+            "id": str(snowflake(next(self._ids))),
+            "channel_id": str(channel_id), "author": author,
+            "content": content, "timestamp":
+                datetime.datetime.utcnow().isoformat() + "+00:00",
+            "edited_timestamp": None, "tts": False,
+            "mention_everyone": "@everyone" in content,
+            "mentions": list(mentions), "mention_roles": list(mention_roles),
+            "attachments": [], "embeds": list(embeds), "pinned": False,
+            "type": 0
+        }
+        if guild_id is not None:
+            data["guild_id"] = str(guild_id)
+        return data
+
+    async def stream(self, duration, rate, mention_ratio=0.5,
+                     delete_ratio=0.5, delete_delay=0.5, mix=None):
+        """ Send MESSAGE_CREATE events at rate per second for duration
+            seconds, deleting a share of them after delete_delay seconds
+            mix weights the kinds of mention of messages with mentions,
+            by default only role mentions
+            Returns the number of ghost pings sent of each kind
+"""
+        mix = mix or {"roles": 1}
+        kinds = [k for k in MENTION_KINDS if mix.get(k)]
+        weights = [mix[k] for k in kinds]
+        ghost_pings = collections.Counter()
+        deletes = []
+        start = time.perf_counter()
+        for n in itertools.count():
+            due = start + n / rate
+            if due - start >= duration:
+                break
+            await asyncio.sleep(max(0, due - time.perf_counter()))
+            guild = self.random.choice(self.guilds)
+            channel = self.random.choice(guild["channels"])
+            author = self.random.choice(guild["members"])["user"]
+            mentions, roles = [], []
+            content, kind = "hello", None
+            if self.random.random() < mention_ratio:
+                kind = self.random.choices(kinds, weights)[0]
+            if kind == "roles":
+                role = self.random.choice(guild["roles"][1:])
+                roles.append(role["id"])
+                content = f"<@&{role['id']}>"
+            elif kind == "members":
+                # The last member is the bot
+                user = self.random.choice(guild["members"][:-1])["user"]
+                mentions.append(user)
+                content = f"<@{user['id']}>"
+            elif kind == "everyone":
+                content = "@everyone"
+            data = self.message_data(
+                channel["id"], author, content, guild_id=guild["id"],
+                mentions=mentions, mention_roles=roles
+            )
+            data["content"] = f"{content} ghost-{data['id']}"
+            await self.dispatch("MESSAGE_CREATE", data)
+            if self.random.random() < delete_ratio:
+                if kind is not None:
+                    ghost_pings[kind] += 1
+                deletes.append(asyncio.ensure_future(
+                    self.delete_later(data, delete_delay)
+                ))
+        await asyncio.gather(*deletes)
+        return ghost_pings
+
+    async def delete_later(self, data, delay):
+        """ Send MESSAGE_DELETE for a message after delay seconds
+"""
+        await asyncio.sleep(delay)
+        self.deleted_at[int(data["id"])] = time.perf_counter()
+        await self.dispatch("MESSAGE_DELETE", {
+            "id": data["id"], "channel_id": data["channel_id"],
+            "guild_id": data["guild_id"]
+        })
+
+    def summary(self, ghost_pings):
+        """ Return API call counts and alert latencies of the run
+            Member mentions are only alerted for guilds which turned on the
+            members preference
+"""
+        routes = collections.Counter(
+            f"{r.method} {re.sub(r'[0-9]+', '{id}', r.path)}"
+            for r in self.requests
+        )
+        latencies = sorted(self.latencies.values())
+        summary = {
+            "ghost_pings": sum(ghost_pings.values()),
+            "ghost_pings_by_kind": dict(ghost_pings),
+            "alerted": len(latencies),
+            "requests": len(self.requests),
+            "rate_limited": sum(r.status == 429 for r in self.requests),
+            "routes": dict(routes),
+        }
+        if len(latencies) > 1:
+            quantiles = statistics.quantiles(
+                latencies, n=100, method="inclusive"
+            )
+            summary.update({
+                "latency_p50_ms": quantiles[49] * 1000,
+                "latency_p99_ms": quantiles[98] * 1000,
+                "latency_max_ms": latencies[-1] * 1000,
+            })
+        return summary
+
+
+async def run_load_test(args):
+    """ Run BotRoot against the fake server and return the summary
+"""
+    server = FakeDiscord(
+        guilds=args.guilds, members=args.members,
+        rate_limit=(args.limit, args.period),
+        rate_limit_headers=not args.no_headers, guild_rate=args.guild_rate
+    )
+    await server.start()
+    directory = tempfile.mkdtemp()
+    bot = BotRoot(
+        alert_window=args.window,
+        database=os.path.join(directory, "db.sqlite"),
+        journal_path=os.path.join(directory, "mentions.journal"),
+        lazy_members=args.lazy_members
+    )
+    runner = asyncio.ensure_future(bot.start("fake-token"))
+    try:
+        await asyncio.wait_for(bot.wait_until_ready(), timeout=300)
+        # Slowly streamed guilds may arrive after the bot is ready
+        await server.wait_for_guilds()
+        startup = {
+            "members": bot.member_mode,
+            "ready_seconds": bot.ready_seconds,
+            "cached_members": sum(len(g.members) for g in bot.guilds),
+            "resident_mib": metrics.resident_memory() / 2 ** 20,
+        }
+        await asyncio.sleep(1)
+        ghost_pings = await server.stream(
+            args.duration, args.rate, delete_delay=args.delay,
+            mix=args.mentions
+        )
+        await asyncio.sleep(args.drain)
+        return dict(server.summary(ghost_pings), startup=startup)
+    finally:
+        await bot.close()
+        await runner
+        bot.connection.close_connection()
+        await server.stop()
+
+
+def main():
+    """ Run a load test from the command line
+"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--rate", type=float, default=50.0)
+    parser.add_argument("--guilds", type=int, default=2)
+    parser.add_argument("--members", type=int, default=100)
+    parser.add_argument(
+        "--guild-rate", type=float, default=None,
+        help="GUILD_CREATE events per second at startup (default: no delay)")
+    parser.add_argument(
+        "--mentions", type=parse_mix, default={"roles": 1},
+        help="weights of the kinds of mentions, e.g. "
+             "roles=2,members=1,everyone=1 (default: roles=1)")
+    parser.add_argument("--delay", type=float, default=0.5)
+    parser.add_argument("--drain", type=float, default=10.0)
+    parser.add_argument("--window", type=float, default=1.0)
+    parser.add_argument("--limit", type=int, default=5)
+    parser.add_argument("--period", type=float, default=5.0)
+    parser.add_argument(
+        "--no-headers", action="store_true",
+        help="omit rate limit headers so limits are only found by 429s")
+    parser.add_argument(
+        "--lazy-members", action="store_true",
+        help="run the bot without member chunking at startup")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        summary = loop.run_until_complete(run_load_test(args))
+    finally:
+        loop.close()
+    print(json.dumps(summary, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(summary, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
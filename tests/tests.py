@@ -26,7 +26,1669 @@ SOFTWARE.
 ===============================================================================
 """
 
+import asyncio
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
 import unittest
 
+import discord
+from discord.ext import commands
+
+from lib.bot import (
+    cluster, coalescer, journal, metrics, profiler, prompts, raid,
+    resolver, store, templates
+)
+from lib.cogs.antighostping import AntiGhostPing
+from lib.cogs.backup import Backup
+from lib.cogs.configuration import Configuration
+from lib.db import cache, db, migrations, storage, transfer, writer
+
+
+class FakeConnection:
+    """ Stand-in for lib.db.db.DBConnection serving a preferences table
+"""
+    def __init__(self, rows):
+        self.columns = ["GuildID", "everyone", "roles", "members", "channel"]
+        self.rows = rows
+        self.queries = 0
+
+    async def get_preferences(self, guild_id):
+        self.queries += 1
+        for row in self.rows:
+            if row[0] == guild_id:
+                return dict(zip(self.columns, row))
+        return None
+
+
+def run(coroutine):
+    """ Run a coroutine to completion on a fresh event loop
+"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class TestPreferencesCache(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = FakeConnection(
+            [(1, 1, 1, 0, 0), (2, 0, 1, 1, 10), (3, 1, 0, 0, 0)]
+        )
+        self.cache = cache.PreferencesCache(self.connection, maxsize=2)
+
+    def test_hit_after_miss(self):
+        self.assertEqual(run(self.cache.get(1))["roles"], 1)
+        self.assertEqual(run(self.cache.get(1))["roles"], 1)
+        self.assertEqual(self.connection.queries, 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_missing_guild(self):
+        self.assertIsNone(run(self.cache.get(4)))
+        self.assertNotIn(4, self.cache)
+
+    def test_lru_eviction(self):
+        run(self.cache.get(1))
+        run(self.cache.get(2))
+        run(self.cache.get(1))
+        run(self.cache.get(3))
+        self.assertIn(1, self.cache)
+        self.assertNotIn(2, self.cache)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_warm(self):
+        self.cache.warm([
+            {"GuildID": i, "everyone": 1, "roles": 1,
+             "members": 0, "channel": 0}
+            for i in range(5)
+        ])
+        self.assertEqual(len(self.cache), 2)
+        self.assertIn(4, self.cache)
+        self.assertEqual(run(self.cache.get(4))["roles"], 1)
+        self.assertEqual(self.connection.queries, 0)
+
+    def test_write_through(self):
+        run(self.cache.get(2))
+        self.cache.update(2, channel=20)
+        self.assertEqual(run(self.cache.get(2))["channel"], 20)
+        self.cache.invalidate(2)
+        self.assertEqual(run(self.cache.get(2))["channel"], 10)
+
+
+class TestAsyncDBConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = db.AsyncDBConnection(":memory:")
+
+    def tearDown(self):
+        self.connection.close_connection()
+
+    def test_loop_serves_during_slow_query(self):
+        slow_query = """
+        WITH RECURSIVE c(x) AS (
+            SELECT 1 UNION ALL SELECT x+1 FROM c WHERE x<500000
+        )
+        SELECT count(*) FROM c"""
+
+        async def ticker(ticks, done):
+            while not done.is_set():
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.005)
+
+        async def main():
+            ticks, done = [], asyncio.Event()
+            task = asyncio.ensure_future(ticker(ticks, done))
+            await asyncio.sleep(0)
+            start = time.perf_counter()
+            values = await self.connection.run(
+                self.connection.connection.execute_query, slow_query, "r"
+            )
+            elapsed = time.perf_counter() - start
+            done.set()
+            await task
+            return values, elapsed, ticks
+
+        values, elapsed, ticks = run(main())
+        self.assertEqual(values[0][0], 500000)
+        # The ticker must keep running for the duration of the query
+        self.assertGreater(len(ticks), elapsed / 0.005 / 4)
+        gaps = [b - a for a, b in zip(ticks, ticks[1:])]
+        self.assertLess(max(gaps), elapsed / 2)
+
+    def test_write_then_read(self):
+        run(self.connection.migrate())
+        run(self.connection.create_guild(1))
+        run(self.connection.set_preference(1, "members", 1))
+        preferences = run(self.connection.get_preferences(1))
+        self.assertEqual(preferences["members"], 1)
+
+    def test_every_backend_implements_storage(self):
+        for backend in storage.BACKENDS:
+            connection = db.AsyncDBConnection(
+                ":memory:", factory=storage.factory(backend)
+            )
+            try:
+                self.assertIsInstance(connection.connection, db.Storage)
+                run(connection.migrate())
+                run(connection.create_guild(1))
+                self.assertEqual(
+                    run(connection.get_preferences(1))["roles"], 1
+                )
+            finally:
+                connection.close_connection()
+
+
+class StorageTests:
+    """ Tests every storage backend must pass, mixed into one TestCase
+        per backend
+"""
+    def create(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.connection = self.create()
+
+    def tearDown(self):
+        self.connection.close_connection()
+
+    def test_typed_preferences(self):
+        self.connection.create_guild(1)
+        self.connection.create_guild(1)
+        self.connection.set_preference(1, "members", 1)
+        self.assertEqual(
+            self.connection.get_preferences(1),
+            {"GuildID": 1, "everyone": 1, "roles": 1,
+             "members": 1, "channel": 0, "raid_threshold": 20,
+             "raid_author_threshold": 8}
+        )
+        self.connection.delete_guild(1)
+        self.assertIsNone(self.connection.get_preferences(1))
+
+    def test_unknown_preference(self):
+        with self.assertRaises(ValueError):
+            self.connection.set_preference(1, "GuildID", 2)
+
+    def test_reset_guild_keeps_other_guilds(self):
+        for guild_id in (1, 2):
+            self.connection.create_guild(guild_id)
+            self.connection.set_preference(guild_id, "members", 1)
+        self.connection.reset_guild(1)
+        self.assertEqual(self.connection.get_preferences(1)["members"], 0)
+        self.assertEqual(self.connection.get_preferences(2)["members"], 1)
+
+    def test_export_import_preferences(self):
+        rows = [(i, i % 2, 1, 0, i * 10, i % 50, 8) for i in range(1, 2501)]
+        self.connection.import_preferences(rows, chunk_size=1000)
+        for fmt in transfer.FORMATS:
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, f"preferences.{fmt}")
+                self.assertEqual(
+                    transfer.export_file(self.connection, path, fmt), 2500
+                )
+                target = self.create()
+                target.create_guild(1)
+                self.assertEqual(
+                    transfer.import_file(target, path, fmt), 2500
+                )
+                self.assertEqual(list(target.iter_preferences()), rows)
+                target.close_connection()
+
+    def test_invalid_import_rolls_back(self):
+        self.connection.create_guild(1)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "preferences.jsonl")
+            with open(path, "w") as file:
+                file.write(
+                    '{"GuildID": 1, "everyone": 0, "roles": 0, '
+                    '"members": 1, "channel": 5}\n{"GuildID": 2}\n'
+                )
+            with self.assertRaisesRegex(ValueError, "line 2"):
+                transfer.import_file(self.connection, path, "jsonl")
+        self.assertEqual(list(self.connection.iter_preferences()), [
+            (1, 1, 1, 0, 0, 20, 8)
+        ])
+
+    def test_import_without_raid_columns(self):
+        files = {
+            "jsonl": '{"GuildID": 1, "everyone": 0, "roles": 0, '
+                     '"members": 1, "channel": 5}\n',
+            "csv": "GuildID,everyone,roles,members,channel\n1,0,0,1,5\n",
+        }
+        for fmt, text in files.items():
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, f"preferences.{fmt}")
+                with open(path, "w") as file:
+                    file.write(text)
+                self.assertEqual(
+                    transfer.import_file(self.connection, path, fmt), 1
+                )
+            self.assertEqual(list(self.connection.iter_preferences()), [
+                (1, 0, 0, 1, 5, 20, 8)
+            ])
+
+    def test_reconcile_guilds(self):
+        for guild_id in (1, 2, 3):
+            self.connection.create_guild(guild_id)
+        added, removed, preferences = self.connection.reconcile_guilds(
+            [2, 3, 4, 5], owns=lambda guild_id: guild_id != 1
+        )
+        self.assertEqual((added, removed), (2, 0))
+        self.assertEqual(
+            sorted(p["GuildID"] for p in preferences), [2, 3, 4, 5]
+        )
+        added, removed, _ = self.connection.reconcile_guilds([2, 3])
+        self.assertEqual((added, removed), (0, 3))
+
+    def insert_ghostpings(self, rows):
+        self.connection.write_batch([("insert_ghostpings", [
+            (guild, 10, author, 100 + i, "author", "<@2>", 1, 0, 0, i, i)
+            for i, (guild, author) in enumerate(rows)
+        ])])
+
+    def test_unknown_write_operation(self):
+        with self.assertRaises(ValueError):
+            self.connection.write_batch([("drop_tables", [(1,)])])
+
+    def test_history_pages_by_keyset(self):
+        self.insert_ghostpings([(1, 3), (1, 4), (2, 3)] * 5)
+        pages, before = [], None
+        while True:
+            page = self.connection.history(1, 3, before, limit=2)
+            if not page:
+                break
+            pages.append([r["MessageID"] for r in page])
+            before = page[-1]["ID"]
+        self.assertEqual(pages, [[112, 109], [106, 103], [100]])
+        self.assertEqual(len(self.connection.history(1, limit=100)), 10)
+        self.assertEqual(self.connection.history(2, limit=1)[0]["content"],
+                         "<@2>")
+
+    def test_guild_stats_rollups(self):
+        detections = [
+            # guild, day, author, channel, members, roles, everyone
+            (1, 100, 3, 10, 2, 0, 0), (1, 100, 3, 11, 1, 1, 0),
+            (1, 101, 4, 10, 0, 0, 1), (1, 90, 4, 10, 1, 0, 0),
+            (2, 101, 3, 20, 1, 0, 0),
+        ]
+        self.connection.insert_ghostpings([
+            (g, c, a, i, f"author-{a}", "", m, r, e, 0, d * 86400 + 5)
+            for i, (g, d, a, c, m, r, e) in enumerate(detections)
+        ])
+        stats = self.connection.guild_stats(1, since=95)
+        self.assertEqual(
+            [(d["day"], d["pings"], d["members"]) for d in stats["daily"]],
+            [(101, 1, 0), (100, 2, 3)]
+        )
+        self.assertEqual(
+            [(a["author"], a["pings"]) for a in stats["authors"]],
+            [("author-3", 2), ("author-4", 1)]
+        )
+        self.assertEqual(
+            [(c["ChannelID"], c["pings"]) for c in stats["channels"]],
+            [(10, 2), (11, 1)]
+        )
+        self.assertEqual(
+            self.connection.guild_stats(1, since=0)["authors"][0]["pings"],
+            2
+        )
+
+    def test_top_authors_use_newest_name(self):
+        self.connection.insert_ghostpings([
+            (1, 10, 3, 1, "zed", "", 1, 0, 0, 0, 100 * 86400),
+            (1, 10, 3, 2, "amy", "", 1, 0, 0, 0, 101 * 86400),
+            (1, 10, 3, 3, "zoe", "", 1, 0, 0, 0, 99 * 86400),
+        ])
+        author = self.connection.guild_stats(1, since=0)["authors"][0]
+        self.assertEqual((author["author"], author["pings"]), ("amy", 3))
+
+
+class TestDBConnection(StorageTests, unittest.TestCase):
+
+    def create(self):
+        connection = db.DBConnection(":memory:")
+        connection.migrate()
+        return connection
+
+    def test_execute_many(self):
+        self.connection.execute_many(
+            "INSERT INTO preferences (GuildID) VALUES (?)",
+            [(i,) for i in range(100)]
+        )
+        rows = self.connection.execute_query(
+            "SELECT count(*) AS n FROM preferences", "r")
+        self.assertEqual(rows[0]["n"], 100)
+
+    def test_reconcile_many_guilds(self):
+        self.connection.execute_many(
+            "INSERT INTO preferences (GuildID) VALUES (?)",
+            [(i,) for i in range(0, 60000, 2)]
+        )
+        start = time.perf_counter()
+        added, removed, preferences = self.connection.reconcile_guilds(
+            range(50000)
+        )
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertEqual((added, removed), (25000, 5000))
+        self.assertEqual(len(preferences), 50000)
+
+    def test_transaction_rolls_back(self):
+        with self.assertRaises(RuntimeError):
+            with self.connection.transaction():
+                self.connection.create_guild(1)
+                raise RuntimeError
+        self.assertIsNone(self.connection.get_preferences(1))
+
+    def test_history_uses_indexes(self):
+        for query, args in (
+                (db.SELECT_GUILD_HISTORY, (1, db.FIRST_PAGE, 10)),
+                (db.SELECT_AUTHOR_HISTORY, (1, 3, db.FIRST_PAGE, 10))
+        ):
+            plan = " ".join(
+                r["detail"] for r in self.connection.execute_query(
+                    "EXPLAIN QUERY PLAN " + query, "r", *args
+                )
+            )
+            self.assertIn("USING INDEX", plan)
+            self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_top_authors_use_primary_key(self):
+        plan = self.connection.execute_query(
+            "EXPLAIN QUERY PLAN " + db.SELECT_TOP_AUTHORS, "r", 1, 95, 10
+        )
+        self.assertIn("PRIMARY KEY", plan[0]["detail"])
+
+
+class TestMemoryStorage(StorageTests, unittest.TestCase):
+
+    def create(self):
+        return storage.MemoryStorage()
+
+
+class TestPartitionedStorage(StorageTests, unittest.TestCase):
+
+    def create(self):
+        connection = storage.PartitionedStorage(":memory:", partitions=3)
+        connection.migrate()
+        return connection
+
+    def test_guilds_are_split_across_files(self):
+        guild_ids = [snowflake(i, 86400 * i) for i in range(30)]
+        with tempfile.TemporaryDirectory() as directory:
+            connection = storage.PartitionedStorage(
+                os.path.join(directory, "db.sqlite"), partitions=3
+            )
+            connection.migrate()
+            connection.reconcile_guilds(guild_ids)
+            counts = [
+                p.execute_query("SELECT count(*) AS n FROM preferences",
+                                "r")[0]["n"]
+                for p in connection.partitions
+            ]
+            connection.close_connection()
+            self.assertEqual(
+                sorted(f for f in os.listdir(directory)
+                       if f.endswith(".sqlite")),
+                ["db-0.sqlite", "db-1.sqlite", "db-2.sqlite"]
+            )
+        self.assertEqual(sum(counts), 30)
+        self.assertTrue(all(counts), counts)
+
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = db.DBConnection(":memory:")
+
+    def tearDown(self):
+        self.connection.close_connection()
+
+    def test_migrate_once(self):
+        self.assertEqual(self.connection.migrate(), (0, migrations.LATEST))
+        self.assertEqual(
+            self.connection.migrate(),
+            (migrations.LATEST, migrations.LATEST)
+        )
+        self.connection.create_guild(1)
+        self.assertIsNotNone(self.connection.get_preferences(1))
+
+    def test_column_defaults_match_preference_defaults(self):
+        self.connection.migrate()
+        self.connection.create_guild(1)
+        preferences = self.connection.get_preferences(1)
+        del preferences["GuildID"]
+        self.assertEqual(preferences, migrations.PREFERENCE_DEFAULTS)
+
+    def test_unversioned_database_is_adopted(self):
+        self.connection.execute_query(migrations.PREFERENCES_QUERY, "w")
+        self.connection.create_guild(1)
+        self.connection.migrate()
+        self.assertEqual(
+            self.connection.get_preferences(1)["raid_threshold"],
+            migrations.RAID_THRESHOLD
+        )
+        self.assertEqual(
+            migrations.version(self.connection), migrations.LATEST
+        )
+
+    def test_failed_migration_rolls_back(self):
+        steps = (
+            ("CREATE TABLE a (x integer)",),
+            ("CREATE TABLE b (x integer)", "INSERT INTO missing VALUES (1)"),
+        )
+        with self.assertRaises(sqlite3.Error):
+            migrations.migrate(self.connection, steps)
+        self.assertEqual(migrations.version(self.connection), 1)
+        tables = [
+            r["name"] for r in self.connection.execute_query(
+                "SELECT name FROM sqlite_master WHERE type='table'", "r"
+            )
+        ]
+        self.assertEqual(tables, ["a"])
+
+    def test_newer_database_is_refused(self):
+        self.connection.execute_query(
+            f"PRAGMA user_version={migrations.LATEST + 1}", "w"
+        )
+        with self.assertRaises(RuntimeError):
+            self.connection.migrate()
+
+
+class TestImportTime(unittest.TestCase):
+    """ Importing the packages must not touch the disk and stay fast
+"""
+    MODULES = (
+        "lib", "lib.cogs", "lib.db", "lib.db.cache", "lib.db.db",
+        "lib.db.migrations", "lib.db.storage", "lib.db.transfer",
+        "lib.db.writer"
+    )
+    # Seconds spent in the lib modules themselves, excluding the standard
+    # library; about 3 ms when measured
+    BUDGET = 0.05
+
+    def test_import_has_no_io(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        script = (
+            "import builtins, sqlite3\n"
+            "def forbidden(*args, **kwargs):\n"
+            "    raise AssertionError(f'I/O at import time: {args}')\n"
+            "builtins.open = sqlite3.connect = forbidden\n"
+            f"import {', '.join(self.MODULES)}\n"
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            result = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", script],
+                cwd=directory, capture_output=True, text=True,
+                env=dict(os.environ, PYTHONPATH=root)
+            )
+            self.assertEqual(os.listdir(directory), [])
+        self.assertEqual(result.returncode, 0, result.stderr[-2000:])
+        # Lines are "import time: self [us] | cumulative | module"
+        elapsed = sum(
+            int(line[len("import time:"):].split("|")[0]) / 1e6
+            for line in result.stderr.splitlines()
+            if line.startswith("import time:")
+            and line.split("|")[-1].strip().startswith("lib")
+        )
+        self.assertLess(elapsed, self.BUDGET)
+
+
+class TestBatchWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = db.AsyncDBConnection(":memory:")
+        run(self.connection.migrate())
+
+    def tearDown(self):
+        self.connection.close_connection()
+
+    def count(self):
+        rows = run(self.connection.run(
+            self.connection.connection.execute_query,
+            "SELECT count(*) AS n FROM ghostpings", "r"
+        ))
+        return rows[0]["n"]
+
+    def test_writes_are_batched(self):
+        async def main():
+            batch_writer = writer.BatchWriter(
+                self.connection, interval=0.05, batch_size=4
+            )
+            for i in range(6):
+                batch_writer.add("insert_ghostpings", (
+                    1, 10, 3, i, "author", "<@2>", 1, 0, 0, 0, 0
+                ))
+            self.assertEqual(len(batch_writer), 2)
+            await asyncio.sleep(0.1)
+            await batch_writer.close()
+            return batch_writer.stats()
+
+        stats = run(main())
+        self.assertEqual(stats["writes"], 6)
+        self.assertEqual(stats["batches"], 2)
+        self.assertEqual(self.count(), 6)
+
+    def test_failed_batch_is_counted(self):
+        async def main():
+            batch_writer = writer.BatchWriter(self.connection)
+            batch_writer.add("insert_ghostpings", (1,))
+            await batch_writer.close()
+            return batch_writer.stats()
+
+        with self.assertLogs(level="ERROR"):
+            stats = run(main())
+        self.assertEqual(stats["failures"], 1)
+
+    def test_rows_added_after_close_are_dropped(self):
+        async def main():
+            batch_writer = writer.BatchWriter(self.connection)
+            await batch_writer.close()
+            batch_writer.add("insert_ghostpings", ())
+            return batch_writer.stats()
+
+        with self.assertLogs(level="WARNING"):
+            stats = run(main())
+        self.assertEqual(stats["dropped"], 1)
+        self.assertEqual(stats["queued"], 0)
+
+
+def make_message(message_id, guild_id=1, content="<@2>", mentions=(2,),
+                 role_mentions=(), everyone=False):
+    """ Build a minimal stand-in for discord.Message
+"""
+    return types.SimpleNamespace(
+        id=message_id, guild=types.SimpleNamespace(id=guild_id),
+        channel=types.SimpleNamespace(id=guild_id * 10),
+        author=types.SimpleNamespace(id=3, name="author", bot=False),
+        raw_mentions=list(mentions), raw_role_mentions=list(role_mentions),
+        mention_everyone=everyone, content=content
+    )
+
+
+class TestMentionStore(unittest.TestCase):
+
+    def test_ignores_messages_without_mentions(self):
+        message_store = store.MentionStore()
+        self.assertIsNone(
+            message_store.add(make_message(1, content="hi", mentions=()))
+        )
+        self.assertEqual(len(message_store), 0)
+
+    def test_record_fields(self):
+        message_store = store.MentionStore(content_limit=4)
+        message_store.add(make_message(
+            175928847299117063, content="<@2> <@&5>", role_mentions=(5,)
+        ))
+        record = message_store.pop(175928847299117063)
+        self.assertEqual(record.mentions, (2,))
+        self.assertEqual(record.role_mentions, (5,))
+        self.assertEqual(record.content, "<@2>")
+        self.assertEqual(
+            record.created_at.strftime("%Y-%m-%d"), "2016-04-30"
+        )
+        self.assertEqual(message_store.size, 0)
+
+    def test_removed_mentions(self):
+        before = store.MentionRecord.from_message(make_message(
+            1, content="<@2> <@4> <@&5>", mentions=(2, 4), role_mentions=(5,)
+        ))
+        after = store.MentionRecord.from_data({
+            "id": "1", "guild_id": "1", "channel_id": "10",
+            "author": {"id": "3", "username": "author"},
+            "content": "<@4> <@&5>", "mentions": [{"id": "4"}],
+            "mention_roles": ["5"], "mention_everyone": False
+        })
+        removed = before.removed(after)
+        self.assertEqual(removed.mentions, (2,))
+        self.assertEqual(removed.role_mentions, ())
+        self.assertIsNone(after.removed(after))
+        self.assertEqual(before.removed(None).mentions, (2, 4))
+
+    def test_from_data_requires_mentions(self):
+        self.assertIsNone(store.MentionRecord.from_data({
+            "id": "1", "guild_id": "1", "channel_id": "10",
+            "author": {"id": "3", "username": "author"}, "content": "hi",
+            "mentions": [], "mention_roles": [], "mention_everyone": False
+        }))
+
+    def test_from_data_rejects_partial_payload(self):
+        with self.assertRaises(ValueError):
+            store.MentionRecord.from_data({
+                "id": "1", "guild_id": "1", "channel_id": "10",
+                "content": "<@2>", "mentions": [{"id": "2"}]
+            })
+
+    def test_per_guild_limit(self):
+        message_store = store.MentionStore(max_per_guild=2)
+        for i in range(1, 4):
+            message_store.add(make_message(i))
+        message_store.add(make_message(4, guild_id=2))
+        self.assertNotIn(1, message_store)
+        self.assertEqual(len(message_store), 3)
+
+    def test_global_memory_limit(self):
+        record_size = store.MentionRecord.from_message(
+            make_message(1)).sizeof()
+        message_store = store.MentionStore(max_bytes=record_size * 3)
+        for i in range(1, 6):
+            message_store.add(make_message(i, guild_id=i))
+        self.assertEqual(len(message_store), 3)
+        self.assertNotIn(2, message_store)
+        self.assertIn(5, message_store)
+
+
+def snowflake(n, age=0):
+    """ Return a message ID created age seconds ago
+"""
+    milliseconds = int((time.time() - age) * 1000) - store.DISCORD_EPOCH
+    return (milliseconds << 22) + n
+
+
+class TestMentionJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "mentions.journal")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def journal(self, **options):
+        return journal.MentionJournal(self.path, **options)
+
+    async def replay(self, **options):
+        mention_journal = self.journal(**options)
+        records = await mention_journal.load()
+        await mention_journal.close()
+        return [r.id for r in records]
+
+    async def write(self, messages, removed=(), **options):
+        mention_journal = self.journal(**options)
+        message_store = store.MentionStore(journal=mention_journal)
+        for message in messages:
+            message_store.add(message)
+        for message_id in removed:
+            message_store.pop(message_id)
+        await mention_journal.close()
+        return mention_journal
+
+    def test_records_survive_restart(self):
+        ids = [snowflake(i) for i in range(3)]
+        written = run(self.write(
+            [make_message(i) for i in ids], removed=[ids[1]]
+        ))
+        self.assertEqual(written.stats()["batches"], 1)
+        self.assertEqual(run(self.replay()), [ids[0], ids[2]])
+        with open(self.path) as file:
+            record = store.MentionRecord.from_row(json.loads(
+                file.readline()
+            ))
+        self.assertEqual(record.mentions, (2,))
+
+    def test_partial_line_and_retention(self):
+        old, new = snowflake(1, age=7200), snowflake(2)
+        run(self.write([make_message(old), make_message(new)]))
+        with open(self.path, "a") as file:
+            file.write('[1234,1,10,3,"auth')
+        self.assertEqual(run(self.replay(retention=3600)), [new])
+
+    def test_limits_applied_on_replay(self):
+        ids = [snowflake(i) for i in range(3)]
+        run(self.write([make_message(i) for i in ids]))
+        self.assertEqual(run(self.replay(max_per_guild=2)), ids[1:])
+
+    def test_compaction(self):
+        ids = [snowflake(i) for i in range(100)]
+        run(self.write(
+            [make_message(i) for i in ids], removed=ids[:90],
+            batch_size=10
+        ))
+
+        async def compact():
+            mention_journal = self.journal()
+            await mention_journal.compact()
+            await mention_journal.close()
+        run(compact())
+        with open(self.path) as file:
+            self.assertEqual(len(file.readlines()), 10)
+        self.assertEqual(run(self.replay()), ids[90:])
+
+
+class FakeChannel:
+    """ Stand-in for discord.TextChannel recording sent embeds
+"""
+    def __init__(self, channel_id=10, name="general"):
+        self.id = channel_id
+        self.name = name
+        self.sent = []
+
+    async def send(self, content=None, *, embed=None):
+        self.sent.append([embed])
+
+
+class FakeHTTP:
+    """ Stand-in for discord.http.HTTPClient recording raw requests
+"""
+    def __init__(self):
+        self.requests = []
+
+    async def request(self, route, **kwargs):
+        self.requests.append((route, kwargs))
+
+
+class TestAlertCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = types.SimpleNamespace(http=FakeHTTP())
+        self.alerts = coalescer.AlertCoalescer(self.bot, window=0.01)
+        self.channel = FakeChannel()
+
+    def alert(self, i, content="x"):
+        embed = discord.Embed(title=f"alert {i}", description=content)
+        self.alerts.add(self.channel, embed, (f"alert {i}", content))
+
+    def test_single_alert_uses_channel_send(self):
+        async def main():
+            self.alert(1)
+            await asyncio.sleep(0.05)
+
+        run(main())
+        self.assertEqual(len(self.channel.sent), 1)
+        self.assertEqual(self.alerts.stats()["saved"], 0)
+
+    def test_burst_shares_one_message(self):
+        async def main():
+            for i in range(10):
+                self.alert(i)
+            await asyncio.sleep(0.05)
+
+        run(main())
+        self.assertEqual(len(self.bot.http.requests), 1)
+        payload = self.bot.http.requests[0][1]["json"]
+        self.assertEqual(len(payload["embeds"]), 10)
+        self.assertEqual(self.alerts.stats()["saved"], 9)
+
+    def test_large_burst_is_compacted(self):
+        async def main():
+            for i in range(60):
+                self.alert(i)
+            await asyncio.sleep(0.05)
+
+        run(main())
+        payload = self.bot.http.requests[0][1]["json"]
+        self.assertEqual(
+            [len(e["fields"]) for e in payload["embeds"]], [25, 25, 10]
+        )
+        self.assertEqual(self.alerts.calls, 1)
+
+    def test_batches_respect_message_length(self):
+        embeds = [
+            discord.Embed(title="t", description="x" * 2000)
+            for _ in range(5)
+        ]
+        batches = list(self.alerts.batches(embeds))
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+
+
+class FakeOwner:
+    """ Stand-in for the discord.Member owning a guild
+"""
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, content):
+        self.messages.append(content)
+
+
+class GuildChannel(FakeChannel):
+    """ FakeChannel in a guild with the given bot permissions, whose sends
+        raise the queued errors first
+"""
+    def __init__(self, channel_id, guild, allowed=True, errors=()):
+        super().__init__(channel_id, f"channel-{channel_id}")
+        self.guild = guild
+        self.allowed = allowed
+        self.errors = list(errors)
+
+    def permissions_for(self, member):
+        return discord.Permissions(
+            read_messages=True, send_messages=self.allowed, embed_links=True
+        )
+
+    async def send(self, content=None, *, embed=None):
+        if self.errors:
+            raise self.errors.pop(0)
+        await super().send(content, embed=embed)
+
+
+def http_error(cls, status):
+    """ Create a discord.HTTPException subclass as raised by discord.py
+"""
+    return cls(types.SimpleNamespace(status=status, reason=""), "error")
+
+
+class TestAlertRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.owner = FakeOwner()
+        self.guild = types.SimpleNamespace(
+            id=1, name="guild", me=object(), owner=self.owner, owner_id=5
+        )
+        self.alerts = coalescer.AlertCoalescer(
+            types.SimpleNamespace(http=FakeHTTP()), window=0.01,
+            backoff=0.001
+        )
+
+    def alert(self, channel, fallback=None):
+        embed = discord.Embed(title="alert")
+        self.alerts.add(channel, embed, ("alert", "x"), fallback=fallback)
+
+    def test_missing_permission_falls_back_without_requests(self):
+        denied = GuildChannel(10, self.guild, allowed=False)
+        origin = GuildChannel(11, self.guild)
+
+        async def main():
+            for _ in range(3):
+                self.alert(denied, origin)
+            await asyncio.sleep(0.05)
+
+        run(main())
+        self.assertEqual(denied.sent, [])
+        requests = self.alerts.bot.http.requests
+        self.assertEqual([r.channel_id for r, _ in requests], [11])
+        self.assertEqual(self.alerts.stats()["rerouted"], 3)
+        self.assertEqual(self.owner.messages, [])
+
+    def test_owner_notified_once_when_no_channel_works(self):
+        denied = GuildChannel(10, self.guild, allowed=False)
+
+        async def main():
+            for _ in range(5):
+                self.alert(denied, denied)
+            await asyncio.sleep(0.05)
+
+        run(main())
+        self.assertEqual(len(self.owner.messages), 1)
+        self.assertIn("channel-10", self.owner.messages[0])
+        self.assertEqual(self.alerts.stats()["dropped"], 5)
+
+    def test_forbidden_channel_is_skipped(self):
+        channel = GuildChannel(
+            10, self.guild, errors=[http_error(discord.Forbidden, 403)]
+        )
+        origin = GuildChannel(11, self.guild)
+
+        async def main():
+            self.alert(channel, origin)
+            await asyncio.sleep(0.05)
+            self.alert(channel, origin)
+            await asyncio.sleep(0.05)
+
+        run(main())
+        self.assertEqual(self.alerts.calls, 3)
+        self.assertEqual(len(origin.sent), 2)
+        self.assertIn(10, self.alerts.denied)
+        run(self.alerts.on_guild_channel_update(channel, channel))
+        self.assertTrue(self.alerts.sendable(channel))
+
+    def test_transient_errors_are_retried(self):
+        channel = GuildChannel(10, self.guild, errors=[
+            http_error(discord.DiscordServerError, 500),
+            asyncio.TimeoutError()
+        ])
+
+        async def main():
+            self.alert(channel)
+            await asyncio.sleep(0.1)
+
+        run(main())
+        self.assertEqual(len(channel.sent), 1)
+        self.assertEqual(self.alerts.calls, 3)
+
+
+class FakeMessage:
+    """ Stand-in for discord.Message recording edited embeds
+"""
+    def __init__(self, channel, embed):
+        self.channel = channel
+        self.embeds = [embed]
+
+    async def edit(self, *, embed=None):
+        self.embeds.append(embed)
+
+
+class SummaryChannel(GuildChannel):
+    """ GuildChannel returning and recording the messages it sends
+"""
+    def __init__(self, channel_id, guild):
+        super().__init__(channel_id, guild)
+        self.messages = []
+
+    async def send(self, content=None, *, embed=None):
+        await super().send(content, embed=embed)
+        self.messages.append(FakeMessage(self, embed))
+        return self.messages[-1]
+
+
+class TestRaidMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.guild = types.SimpleNamespace(
+            id=1, name="guild", me=object(), owner=FakeOwner(), owner_id=5
+        )
+        self.channel = SummaryChannel(10, self.guild)
+        bot = types.SimpleNamespace(
+            alerts=coalescer.AlertCoalescer(
+                types.SimpleNamespace(http=FakeHTTP())
+            )
+        )
+        self.raids = raid.RaidMonitor(
+            bot, edit_interval=0.01, clock=lambda: self.now
+        )
+        self.preferences = {"raid_threshold": 3, "raid_author_threshold": 0}
+
+    def ping(self, author_id=1):
+        record = types.SimpleNamespace(
+            author_id=author_id, author_name=f"member-{author_id}"
+        )
+        return self.raids.record(
+            self.guild, record, self.preferences, self.channel, self.channel
+        )
+
+    def test_ring_counter_window(self):
+        counter = raid.RingCounter(window=60, buckets=12)
+        counter.add(0)
+        counter.add(30, 2)
+        self.assertEqual(counter.total(30), 3)
+        self.assertEqual(counter.total(62), 2)
+        self.assertEqual(counter.total(95), 0)
+        # Reused buckets forget their previous counts
+        counter.add(120)
+        self.assertEqual(counter.total(120), 1)
+
+    def test_counters_are_bounded(self):
+        self.raids.max_counters = 4
+        self.preferences["raid_threshold"] = 100
+        for author_id in range(10):
+            self.ping(author_id)
+        self.assertEqual(len(self.raids._counters), 4)
+
+    def test_raid_summary_is_edited_in_place(self):
+        async def main():
+            self.assertEqual([self.ping(i) for i in range(4)], [
+                False, False, True, True
+            ])
+            await asyncio.sleep(0.03)
+            for _ in range(5):
+                self.assertTrue(self.ping(2))
+            await asyncio.sleep(0.03)
+            self.now += 61
+            await asyncio.sleep(0.03)
+
+        run(main())
+        # Two alerted ghost pings, then one summary message edited in place
+        self.assertEqual(len(self.channel.sent), 1)
+        self.assertEqual(len(self.channel.messages[0].embeds), 3)
+        self.assertEqual(self.raids.stats(), {
+            "active": 0, "started": 1, "summarized": 7, "edits": 2
+        })
+
+    def test_raid_ends_with_final_summary(self):
+        async def main():
+            for _ in range(3):
+                self.ping()
+            await asyncio.sleep(0.03)
+            self.now += 61
+            await asyncio.sleep(0.03)
+            return self.ping()
+
+        self.assertFalse(run(main()))
+        first, last = self.channel.messages[0].embeds
+        self.assertIn("started after 3", first.description)
+        self.assertIn("ended", last.description)
+        # The first two ghost pings were alerted before raid mode
+        self.assertEqual(last.fields[0].value, "1")
+
+    def test_author_threshold(self):
+        self.preferences = {"raid_threshold": 0, "raid_author_threshold": 2}
+
+        async def main():
+            alerted = [self.ping(1), self.ping(2), self.ping(1)]
+            await self.raids.close()
+            return alerted
+
+        self.assertEqual(run(main()), [False, False, True])
+        self.assertEqual(self.raids.raids, {})
+        self.assertIn("ended", self.channel.sent[0][0].description)
+
+    def test_disabled_thresholds(self):
+        self.preferences = {"raid_threshold": 0, "raid_author_threshold": 0}
+        self.assertFalse(any(self.ping() for _ in range(50)))
+        self.assertEqual(len(self.raids._counters), 0)
+
+
+class FakeGuild:
+    """ Stand-in for discord.Guild with ID-indexed roles and members
+"""
+    def __init__(self, guild_id=1, roles=(), members=(), uncached=()):
+        self.id = guild_id
+        self.roles = {r.id: r for r in roles}
+        self.members = {m.id: m for m in members}
+        self.uncached = {m.id: m for m in uncached}
+        self.member_queries = []
+
+    def get_role(self, role_id):
+        return self.roles.get(role_id)
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+    def get_channel(self, channel_id):
+        return None
+
+    async def query_members(self, *, user_ids, limit, cache):
+        self.member_queries.append(user_ids)
+        return [self.uncached[i] for i in user_ids if i in self.uncached]
+
+
+def make_member(member_id, name):
+    """ Build a minimal stand-in for discord.Member
+"""
+    return types.SimpleNamespace(id=member_id, display_name=name)
+
+
+class TestEmbedTemplates(unittest.TestCase):
+
+    def test_render_does_not_consume_placeholders(self):
+        template = templates.EmbedTemplate.load(
+            os.path.join("data", "Configuration", "join_message.txt"),
+            "Thank you"
+        )
+        first = template.render({"name": "one", "id": 1})
+        second = template.render({"name": "two {0}", "id": 2})
+        self.assertIn("**one** (ID: `1`)", first.fields[0].value)
+        self.assertIn("**two {0}** (ID: `2`)", second.fields[0].value)
+
+    def test_render_truncates_to_limits(self):
+        template = templates.EmbedTemplate(
+            "{title}", [("Message", "{message}")]
+        )
+        embed = template.render(
+            {"title": "t" * 300, "message": "m" * 2000},
+            fields=[("", "")]
+        )
+        self.assertEqual(len(embed.title), templates.MAX_TITLE)
+        self.assertEqual(len(embed.fields[0].value), 1024)
+        self.assertTrue(embed.fields[0].value.endswith(templates.ELLIPSIS))
+        self.assertEqual(embed.fields[1].name, templates.BLANK)
+
+    def test_fit_embed_length_and_fields(self):
+        embed = discord.Embed(title="t", description="d" * 3000)
+        for i in range(30):
+            embed.add_field(name=f"field {i}", value="v" * 1000)
+        embed = templates.fit(embed)
+        self.assertEqual(len(embed.fields), templates.MAX_FIELDS)
+        self.assertLessEqual(len(embed), templates.MAX_EMBED_LENGTH)
+        self.assertLessEqual(len(embed.description), 2048)
+        self.assertEqual(embed.fields[24].name, "field 24")
+
+
+def reply(guild_id, channel_id, author_id, content):
+    """ Create a stand-in for a guild discord.Message
+"""
+    return types.SimpleNamespace(
+        guild=types.SimpleNamespace(id=guild_id),
+        channel=types.SimpleNamespace(id=channel_id),
+        author=types.SimpleNamespace(id=author_id), content=content
+    )
+
+
+class TestPromptManager(unittest.TestCase):
+
+    def setUp(self):
+        self.prompts = prompts.PromptManager(timeout=0.05)
+
+    def test_reply_routed_only_to_its_session(self):
+        async def main():
+            with self.prompts.open(1, 10, 100) as session:
+                waiter = asyncio.ensure_future(
+                    session.wait(lambda m: m.content == "ON")
+                )
+                await asyncio.sleep(0)
+                for message in (
+                        reply(2, 10, 100, "ON"), reply(1, 11, 100, "ON"),
+                        reply(1, 10, 101, "ON"), reply(1, 10, 100, "maybe"),
+                        reply(1, 10, 100, "ON")
+                ):
+                    await self.prompts.on_message(message)
+                return await waiter
+
+        message = run(main())
+        self.assertEqual(
+            (message.guild.id, message.channel.id, message.author.id),
+            (1, 10, 100)
+        )
+        self.assertEqual(len(self.prompts), 0)
+
+    def test_one_session_per_channel(self):
+        session = self.prompts.open(1, 10, 100)
+        with self.assertRaises(prompts.PromptBusy):
+            self.prompts.open(1, 10, 101)
+        self.prompts.open(1, 11, 101)
+        session.__exit__(None, None, None)
+        self.prompts.open(1, 10, 101)
+        self.assertEqual(len(self.prompts), 2)
+
+    def test_wait_times_out_and_idle_sessions_expire(self):
+        async def main():
+            session = self.prompts.open(1, 10, 100)
+            with self.assertRaises(asyncio.TimeoutError):
+                await session.wait()
+            await asyncio.sleep(0.06)
+
+        run(main())
+        self.assertEqual(self.prompts.expire(), 1)
+        self.prompts.open(1, 10, 101)
+
+
+class TestEntityResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.resolver = resolver.EntityResolver(maxsize=3)
+        self.guild = FakeGuild(
+            roles=[types.SimpleNamespace(id=5, name="mods")],
+            members=[make_member(2, "bob")],
+            uncached=[make_member(3, "carol"), make_member(4, "dave")]
+        )
+
+    def test_role_names(self):
+        self.assertEqual(
+            self.resolver.role_names(self.guild, [5, 6]),
+            ["mods", "Unknown Role (6)"]
+        )
+
+    def test_uncached_members_fetched_in_one_batch(self):
+        names = run(self.resolver.member_names(self.guild, [2, 3, 4, 9]))
+        self.assertEqual(names, ["bob", "carol", "dave", "Unknown Member (9)"])
+        self.assertEqual(self.guild.member_queries, [[3, 4, 9]])
+        run(self.resolver.member_names(self.guild, [3, 4]))
+        self.assertEqual(len(self.guild.member_queries), 1)
+
+    def test_member_update_invalidates(self):
+        run(self.resolver.member_names(self.guild, [3]))
+        before = types.SimpleNamespace(display_name="carol")
+        after = types.SimpleNamespace(
+            id=3, display_name="caz", guild=self.guild
+        )
+        run(self.resolver.on_member_update(before, after))
+        self.guild.uncached[3] = make_member(3, "caz")
+        self.assertEqual(
+            run(self.resolver.member_names(self.guild, [3])), ["caz"]
+        )
+
+    def test_names_expire_after_ttl(self):
+        self.resolver.ttl = 0.05
+        run(self.resolver.member_names(self.guild, [3]))
+        self.guild.uncached[3] = make_member(3, "caz")
+        self.assertEqual(
+            run(self.resolver.member_names(self.guild, [3])), ["carol"]
+        )
+        time.sleep(0.1)
+        self.assertEqual(
+            run(self.resolver.member_names(self.guild, [3])), ["caz"]
+        )
+        self.assertEqual(len(self.guild.member_queries), 2)
+
+
+class RecordingWriter:
+    """ Stand-in for lib.db.writer.BatchWriter recording queued rows
+"""
+    def __init__(self):
+        self.rows = []
+
+    def add(self, operation, row):
+        self.rows.append((operation, row))
+
+
+class RecordingAlerts:
+    """ Stand-in for lib.bot.coalescer.AlertCoalescer recording alerts
+"""
+    def __init__(self):
+        self.alerts = []
+
+    def add(self, channel, embed, field, fallback=None):
+        self.alerts.append((channel, embed))
+
+
+class CogGuild(FakeGuild):
+    """ FakeGuild with FakeChannels
+"""
+    def __init__(self, guild_id=1, channel_ids=(10,), **options):
+        super().__init__(guild_id, **options)
+        self.channels = {
+            i: FakeChannel(i, f"channel-{i}") for i in channel_ids
+        }
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+
+class CogBot:
+    """ Stand-in for lib.bot.BotRoot holding what AntiGhostPing uses
+"""
+    def __init__(self, guild, rows):
+        self.guild = guild
+        self.metrics = metrics.BotMetrics(self)
+        self.preferences = cache.PreferencesCache(FakeConnection(rows))
+        self.message_store = store.MentionStore()
+        self.resolver = resolver.EntityResolver()
+        self.writer = RecordingWriter()
+        self.alerts = RecordingAlerts()
+        self.raids = raid.RaidMonitor(self)
+
+    def get_guild(self, guild_id):
+        return self.guild if guild_id == self.guild.id else None
+
+
+class CogTestCase(unittest.TestCase):
+    """ Run AntiGhostPing in guild 1 with channels 10, 20, and 30, where
+        members 2 and 4 are cached and member mentions are flagged
+"""
+    preferences = (1, 1, 1, 1, 0)
+
+    def setUp(self):
+        self.guild = CogGuild(channel_ids=(10, 20, 30), members=[
+            make_member(2, "target"), make_member(4, "other")
+        ])
+        self.bot = CogBot(self.guild, [self.preferences])
+        self.cog = AntiGhostPing(self.bot)
+
+    @staticmethod
+    def message(message_id, channel_id=10, author_id=3, mentions=(2,),
+                bot=False):
+        message = make_message(
+            message_id, content=" ".join(f"<@{i}>" for i in mentions),
+            mentions=mentions
+        )
+        message.channel = types.SimpleNamespace(id=channel_id)
+        message.author = types.SimpleNamespace(
+            id=author_id, name=f"author-{author_id}", bot=bot
+        )
+        return message
+
+    def send(self, message):
+        run(self.cog.on_message(message))
+
+    def delete(self, message_id, cached=None):
+        run(self.cog.on_raw_message_delete(types.SimpleNamespace(
+            guild_id=self.guild.id, message_id=message_id,
+            cached_message=cached
+        )))
+
+    def bulk(self, messages, stored=()):
+        for message in stored:
+            self.send(message)
+        run(self.cog.on_raw_bulk_message_delete(types.SimpleNamespace(
+            guild_id=self.guild.id,
+            message_ids={m.id for m in (*messages, *stored)},
+            cached_messages=list(messages)
+        )))
+
+    @property
+    def alerts(self):
+        return self.bot.alerts.alerts
+
+    @staticmethod
+    def field(embed, name):
+        return {f.name: f.value for f in embed.fields}.get(name)
+
+
+class TestRawMessageDelete(CogTestCase):
+
+    def test_stored_message_alerts_once(self):
+        self.send(self.message(1))
+        self.delete(1)
+        self.delete(1)
+        self.assertEqual(len(self.alerts), 1)
+        channel, embed = self.alerts[0]
+        self.assertEqual(channel.id, 10)
+        self.assertEqual(self.field(embed, "Members Mentioned"), "target")
+        self.assertEqual(len(self.bot.writer.rows), 1)
+
+    def test_store_miss_is_ignored(self):
+        self.delete(1)
+        self.assertEqual(self.alerts, [])
+        self.assertEqual(self.bot.writer.rows, [])
+
+    def test_store_miss_falls_back_to_cached_message(self):
+        self.delete(1, cached=self.message(1))
+        self.assertEqual(len(self.alerts), 1)
+        self.assertEqual(
+            self.field(self.alerts[0][1], "Member"), "author-3"
+        )
+
+    def test_bot_authors_are_ignored(self):
+        message = self.message(1, bot=True)
+        self.send(message)
+        self.assertEqual(len(self.bot.message_store), 0)
+        self.delete(1, cached=message)
+        self.assertEqual(self.alerts, [])
+
+
+class TestRawBulkMessageDelete(CogTestCase):
+
+    def test_one_summary_per_notification_channel(self):
+        self.bulk([self.message(1, 10), self.message(2, 20)], stored=[
+            self.message(3, 10), self.message(4, 10, mentions=())
+        ])
+        self.assertEqual(
+            sorted(channel.id for channel, _ in self.alerts), [10, 20]
+        )
+        self.assertEqual(len(self.bot.writer.rows), 3)
+        self.assertEqual(self.bot.metrics.detections.total(), 3)
+
+
+class TestRawBulkMessageDeleteSummary(CogTestCase):
+    preferences = (1, 1, 1, 1, 30)
+
+    def test_members_are_counted_once(self):
+        self.bulk([
+            self.message(1, 10), self.message(2, 20),
+            self.message(3, 20), self.message(4, 10, author_id=5)
+        ])
+        self.assertEqual(len(self.alerts), 1)
+        channel, embed = self.alerts[0]
+        self.assertEqual(channel.id, 30)
+        self.assertEqual(embed.description, (
+            "4 deleted messages from 2 members contained mentions"
+        ))
+        self.assertEqual(len(embed.fields), 3)
+
+    def test_entries_beyond_fields_are_summarized(self):
+        self.bulk([
+            self.message(i, 10 + 10 * (i % 2), author_id=i % 13)
+            for i in range(1, 27)
+        ])
+        embed = self.alerts[0][1]
+        self.assertIn("from 13 members", embed.description)
+        self.assertEqual(len(embed.fields), 25)
+        self.assertEqual(
+            self.field(embed, "Not Listed"),
+            "2 more member and channel entries"
+        )
+
+
+class TestRawMessageEdit(CogTestCase):
+
+    def edit(self, message_id, content, mentions):
+        run(self.cog.on_raw_message_edit(types.SimpleNamespace(
+            message_id=message_id, cached_message=None, data={
+                "id": str(message_id), "guild_id": "1", "channel_id": "10",
+                "author": {"id": "3", "username": "author-3"},
+                "content": content,
+                "mentions": [{"id": str(i)} for i in mentions],
+                "mention_roles": [], "mention_everyone": False
+            }
+        )))
+
+    def test_edit_alerts_removed_mentions_only(self):
+        self.send(self.message(1, mentions=(2, 4)))
+        self.edit(1, "<@4>", (4,))
+        self.assertEqual(len(self.alerts), 1)
+        embed = self.alerts[0][1]
+        self.assertEqual(self.field(embed, "Members Mentioned"), "target")
+        self.assertEqual(self.field(embed, "Edited To"), "<@4>")
+
+    def test_edit_replaces_stored_record(self):
+        self.send(self.message(1, mentions=(2, 4)))
+        self.edit(1, "<@4>", (4,))
+        record = self.bot.message_store.pop(1)
+        self.assertEqual(record.mentions, (4,))
+        self.assertEqual(record.content, "<@4>")
+
+    def test_delete_after_edit_reports_remaining_mentions(self):
+        self.send(self.message(1, mentions=(2, 4)))
+        self.edit(1, "<@4>", (4,))
+        self.delete(1)
+        self.assertEqual([
+            self.field(embed, "Members Mentioned")
+            for _, embed in self.alerts
+        ], ["target", "other"])
+
+    def test_edit_without_removed_mentions(self):
+        self.send(self.message(1, mentions=(2,)))
+        self.edit(1, "<@2> <@4>", (2, 4))
+        self.assertEqual(self.alerts, [])
+
+    def test_partial_edit_keeps_stored_record(self):
+        self.send(self.message(1, mentions=(2,)))
+        run(self.cog.on_raw_message_edit(types.SimpleNamespace(
+            message_id=1, cached_message=None, data={
+                "id": "1", "guild_id": "1", "channel_id": "10",
+                "content": "<@2>"
+            }
+        )))
+        self.assertEqual(self.alerts, [])
+        self.delete(1)
+        self.assertEqual(len(self.alerts), 1)
+        self.assertEqual(
+            self.field(self.alerts[0][1], "Members Mentioned"), "target"
+        )
+
+
+class TestConfigure(unittest.TestCase):
+
+    def can_run(self, administrator):
+        async def bot_can_run(ctx):
+            return True
+
+        cog = Configuration(types.SimpleNamespace(can_run=bot_can_run))
+        permissions = discord.Permissions(administrator=administrator)
+        ctx = types.SimpleNamespace(
+            bot=cog.bot, command=None, guild=object(), author=object(),
+            channel=types.SimpleNamespace(
+                permissions_for=lambda member: permissions
+            )
+        )
+        return run(cog.configure.can_run(ctx))
+
+    def test_configure_requires_administrator(self):
+        with self.assertRaises(commands.MissingPermissions):
+            self.can_run(False)
+        self.assertTrue(self.can_run(True))
+
+
+class TestShardRanges(unittest.TestCase):
+
+    def test_ranges_cover_every_shard_once(self):
+        ranges = cluster.shard_ranges(10, 3)
+        self.assertEqual(ranges, [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]])
+
+    def test_more_clusters_than_shards(self):
+        self.assertEqual(cluster.shard_ranges(2, 4), [[0], [1]])
+
+    def test_clusters_have_their_own_journal(self):
+        paths = []
+
+        class ClusterBot:
+            def __init__(self, **options):
+                paths.append(options["journal_path"])
+                self.connection = types.SimpleNamespace(
+                    close_connection=lambda: None
+                )
+
+            async def start(self, token):
+                pass
+
+        original = cluster.BotRoot
+        cluster.BotRoot = ClusterBot
+        try:
+            for cluster_id in (0, 1):
+                cluster.run_cluster("token", cluster_id, [cluster_id], 2)
+        finally:
+            cluster.BotRoot = original
+            asyncio.set_event_loop(None)
+        self.assertEqual(paths, [
+            os.path.join("data", "db", "mentions-0.journal"),
+            os.path.join("data", "db", "mentions-1.journal")
+        ])
+
+
+class TestBackup(unittest.TestCase):
+
+    def test_import_refused_in_cluster_mode(self):
+        sent = []
+        imported = []
+
+        async def send(content):
+            sent.append(content)
+
+        async def import_preferences(path, fmt):
+            imported.append(path)
+            return 0
+
+        bot = types.SimpleNamespace(
+            shard_ids=[0, 1], connection=types.SimpleNamespace(
+                import_preferences=import_preferences
+            )
+        )
+        ctx = types.SimpleNamespace(
+            message=types.SimpleNamespace(attachments=[]),
+            channel=types.SimpleNamespace(send=send)
+        )
+        cog = Backup(bot)
+        run(cog.import_preferences.callback(cog, ctx, "preferences.jsonl"))
+        self.assertEqual(imported, [])
+        self.assertIn("clusters", sent[0])
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render_counter_and_histogram(self):
+        registry = metrics.Registry()
+        events = registry.register(
+            metrics.Counter("events", "Events handled", ["event"])
+        )
+        latency = registry.register(metrics.Histogram(
+            "latency_seconds", "Latency", buckets=(0.1, 1.0)
+        ))
+        events.labels("delete").inc()
+        events.labels("delete").inc(2)
+        for value in (0.05, 0.5, 5.0):
+            latency.observe(value)
+        text = registry.render()
+        self.assertIn("# TYPE events counter", text)
+        self.assertIn('events_total{event="delete"} 3', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn("latency_seconds_count 3", text)
+
+    def test_gauge_with_labels(self):
+        gauge = metrics.Gauge(
+            "latency", "Latency", lambda: [((0,), 0.5), ((1,), 0.25)],
+            ["shard"]
+        )
+        self.assertIn('latency{shard="1"} 0.25', gauge.render())
+        self.assertFalse(hasattr(gauge, "labels"))
+
+    def test_metric_is_abstract(self):
+        with self.assertRaises(TypeError):
+            metrics.Metric("m", "m")
+        with self.assertRaises(TypeError):
+            metrics.LabelledMetric("m", "m")
+
+    def test_children_created_while_rendering(self):
+        histogram = metrics.Histogram("h", "h", ["operation"])
+        done = threading.Event()
+
+        def observe():
+            for i in range(20000):
+                histogram.labels(i).observe(0.1)
+            done.set()
+
+        thread = threading.Thread(target=observe)
+        thread.start()
+        while not done.is_set():
+            histogram.render()
+            histogram.children()
+        thread.join()
+        self.assertEqual(len(histogram.children()), 20000)
+
+    def test_duplicate_metric(self):
+        registry = metrics.Registry()
+        registry.register(metrics.Counter("events", "Events"))
+        with self.assertRaises(ValueError):
+            registry.register(metrics.Counter("events", "Events"))
+
+    def test_resident_memory(self):
+        self.assertGreater(metrics.resident_memory(), 2 ** 20)
+
+    def test_quantile(self):
+        histogram = metrics.Histogram("h", "h", buckets=(1, 2, 3))
+        for value in (0.5, 1.5, 1.5, 2.5):
+            histogram.observe(value)
+        self.assertEqual(histogram.labels().quantile(0.5), 2)
+        self.assertEqual(histogram.labels().quantile(0.99), 3)
+
+
+def busy_handler(seconds):
+    """ Keep the event loop busy the way a slow event handler would
+"""
+    end = time.perf_counter() + seconds
+    blocks = []
+    while time.perf_counter() < end:
+        blocks.append(bytearray(1024))
+    return blocks
+
+
+class TestProfiler(unittest.TestCase):
+
+    async def session(self, mode):
+        session = profiler.Profiler(limit=10)
+        task = asyncio.ensure_future(session.profile(0.3, mode))
+        await asyncio.sleep(0.05)
+        self.assertTrue(session.running)
+        blocks = busy_handler(0.1)
+        report = await task
+        self.assertFalse(session.running)
+        return report, blocks
+
+    def test_cprofile(self):
+        report, _ = run(self.session("cprofile"))
+        self.assertIn("busy_handler", report)
+        self.assertIn("Allocation Sites", report)
+        self.assertIn("tests.py", report.split("Allocation Sites")[1])
+
+    def test_sample(self):
+        report, _ = run(self.session("sample"))
+        self.assertIn("busy_handler", report)
+        self.assertIn("samples every", report)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            run(profiler.Profiler().profile(0.1, "perf"))
+
+    def test_cancelled_session_stops_tracing(self):
+        async def main():
+            task = asyncio.ensure_future(profiler.Profiler().profile(10))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        run(main())
+        self.assertFalse(tracemalloc.is_tracing())
+
+
 if __name__ == '__main__':
     unittest.main()